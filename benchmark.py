@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Times the upload path against the local stand-in server in fake_youtube.py
+so chunk sizes and worker counts can be tuned without spending any quota.
+Random files are written to a temporary directory and uploaded with
+`upload_video.upload_row`, and with the `bulk_upload_video.process` driver
+for the concurrency runs, under whatever latency, bandwidth and faults are
+asked for. Throughput, calls per file and the time lost recovering from
+injected errors are printed for each setting.
+
+Example:
+     $ python benchmark.py --size 32 --latency 0.05 --bandwidth 10 \\
+            --chunksizes -1 1 8 --workers 1 2 4 --error-rate 0.05
+
+@author: rick
+"""
+
+import io
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import contextlib
+from argparse import ArgumentParser
+
+import bulk_upload_video
+from fake_youtube import FakeYouTube, local_service
+from metrics import UploadMetrics, percentile
+from projects import Project, ProjectPool
+from upload_video import upload_options, upload_row
+from quota import is_quota_error
+
+MB = 1024 * 1024
+
+
+def make_files(directory, count, size):
+    '''
+    Write `count` files of random bytes, `size` bytes each.
+    '''
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'DVR_bench_{i:03d}.mp4')
+        with open(path, 'wb') as f:
+            left = size
+            while left:
+                block = os.urandom(min(left, MB))
+                f.write(block)
+                left -= len(block)
+        paths.append(path)
+    return paths
+
+
+def upload_once(server, youtube, path, chunksize, adaptive=False,
+                pipeline=False, mapped=False):
+    '''
+    Upload one file and return its metrics along with the server's counts.
+    '''
+    server.reset_counts()
+    m = UploadMetrics(os.path.basename(path), path, os.path.getsize(path))
+    options = upload_options(file=path, title=os.path.basename(path),
+                             chunksize=chunksize, adaptive=adaptive,
+                             pipeline=pipeline, mmap=mapped)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = upload_row(youtube, m.uid, options, metrics=m)
+    m.finished = time.time()
+    return result, m, server.requests
+
+
+def bench_chunks(server, paths, chunksizes, adaptive, faults, pipeline=False,
+                 mapped=False):
+    '''
+    Upload every file once per chunk size, first on a clean connection then
+    with the injected faults, and print a line for each.
+    '''
+    youtube = local_service(server.url)
+    settings = [(c, False, None) for c in chunksizes]
+    if adaptive:
+        settings.append((-1, True, None))
+    if pipeline:
+        settings += [(c, False, 'piped') for c in chunksizes if c > 0]
+    if mapped:
+        settings += [(c, False, 'mapped') for c in chunksizes if c > 0]
+    print('\nchunk size      faults   MB/s p50   MB/s p95   calls/file'
+          '   retries   recovery s')
+    for chunksize, adapt, source in settings:
+        label = 'adaptive' if adapt else \
+            ('whole' if chunksize < 0 else f'{chunksize / MB:g} MB')
+        if source:
+            label += ' ' + source
+        clean = None
+        for faulty in ([False, True] if faults else [False]):
+            server.error_rate = faults['error_rate'] if faulty else 0.0
+            server.drop_rate = faults['drop_rate'] if faulty else 0.0
+            rates, calls, retries, seconds = [], [], 0, 0.0
+            for path in paths:
+                result, m, requests = upload_once(server, youtube, path,
+                                                  chunksize, adapt,
+                                                  source == 'piped',
+                                                  source == 'mapped')
+                if not result.ok:
+                    print(f'  {path} failed: {result.error}')
+                    continue
+                rates.append(m.rate / MB)
+                calls.append(requests)
+                retries += m.retries
+                seconds += m.elapsed
+            if not rates:
+                continue
+            recovery = '' if not faulty or clean is None else \
+                f'{seconds - clean:10.1f}'
+            if not faulty:
+                clean = seconds
+            print(f'{label:<14}{"yes" if faulty else "no":>8}'
+                  f'{percentile(rates, 50):11.2f}{percentile(rates, 95):11.2f}'
+                  f'{sum(calls) / len(calls):13.1f}{retries:10d}   {recovery}')
+    server.error_rate = server.drop_rate = 0.0
+
+
+def bench_workers(server, paths, workers, chunksize, directory):
+    '''
+    Run the bulk driver over a table of every file once per worker count.
+    '''
+    table = os.path.join(directory, 'bench.csv')
+    with open(table, 'w') as f:
+        f.write('UID,NewforMapViewer,Path,DateCollected,StudyName,'
+                'Youtube name\n')
+        for i, path in enumerate(paths):
+            f.write(f'{i},yes,{path},2010-06-21,BENCH,'
+                    f'{os.path.basename(path)}\n')
+    total = sum(os.path.getsize(p) for p in paths)
+    print('\nworkers   seconds   MB/s total   calls/file')
+    for n in workers:
+        # every run gets a clean ledger and caches so nothing is skipped
+        run_dir = tempfile.mkdtemp(dir=directory)
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+        os.mkdir('.logging')
+        server.reset_counts()
+        started = time.time()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pool = ProjectPool([Project(
+                    'bench', budget=10 ** 9,
+                    connect=lambda args: local_service(server.url))])
+                bulk_upload_video.process(table, workers=n,
+                                          chunksize=chunksize, projects=pool)
+        finally:
+            os.chdir(cwd)
+        seconds = time.time() - started
+        print(f'{n:<8}{seconds:9.1f}{total / MB / seconds:13.2f}'
+              f'{server.requests / len(paths):13.1f}')
+
+
+def bench_quota(server, path):
+    '''
+    Check that a quotaExceeded answer is spotted before any bytes are sent.
+    '''
+    youtube = local_service(server.url)
+    server.quota_after = 0
+    started = time.time()
+    result, m, requests = upload_once(server, youtube, path, -1)
+    server.quota_after = None
+    print(f'\nquotaExceeded: detected={is_quota_error(result.error)} '
+          f'after {time.time() - started:.2f}s, {requests} call(s), '
+          f'{server.bytes_received} bytes sent')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--size', type=float, default=32,
+                        help='MB in each test file')
+    parser.add_argument('--files', type=int, default=4,
+                        help='number of test files')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='MB/s allowed on each connection')
+    parser.add_argument('--chunksizes', type=float, nargs='+',
+                        default=[-1, 1, 8],
+                        help='MB per request to try, -1 for the whole file')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='also try adaptive chunk sizing')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='also try each chunk size with the read-ahead '
+                        'pipeline')
+    parser.add_argument('--mmap', action='store_true',
+                        help='also try each chunk size sent from a memory '
+                        'map')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='worker counts to try with the bulk driver')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance a chunk gets a 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='chance a chunk has its connection dropped')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='socket timeout in seconds for the client')
+    args = parser.parse_args()
+
+    if args.timeout:
+        socket.setdefaulttimeout(args.timeout)
+    bandwidth = args.bandwidth * MB if args.bandwidth else None
+    server = FakeYouTube(latency=args.latency, bandwidth=bandwidth).start()
+    directory = tempfile.mkdtemp(prefix='yt_bench_')
+    faults = None
+    if args.error_rate or args.drop_rate:
+        faults = dict(error_rate=args.error_rate, drop_rate=args.drop_rate)
+    try:
+        paths = make_files(directory, args.files, int(args.size * MB))
+        chunksizes = [int(c * MB) if c > 0 else -1 for c in args.chunksizes]
+        bench_chunks(server, paths, chunksizes, args.adaptive, faults,
+                     args.pipeline, args.mmap)
+        bench_workers(server, paths, args.workers, -1, directory)
+        bench_quota(server, paths[0])
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+    sys.exit(0)
@@ -2,24 +2,33 @@
 
 #!/usr/bin/python
 
-import http.client
-import httplib2
 import os
-import random
 import sys
 import time
 import logging
 import getpass
-import pandas as pd
-from datetime import datetime as dt
-from argparse import Namespace, ArgumentParser, RawDescriptionHelpFormatter
-
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-from apiclient.http import MediaFileUpload
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client.tools import argparser, run_flow
+from datetime import datetime as dt, timedelta
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from upload_video import (upload_options, upload_row, refresh_credentials,
+                          UploadResult, CHUNKSIZE)
+from errors import classify, UploadError, SWITCH, REAUTH, DEFER
+from leases import Leases, leased, DONE
+from status import StatusServer
+from table import read_table
+from templates import render_text
+from validate import validate_files
+from dedup import channel_index, table_duplicates, find_duplicate
+from mirror import Mirror
+from processing import StatusTracker
+from ledger import Ledger, fingerprint, STARTED, FAILED, UPLOADED, DEFERRED
+from metrics import MetricsLog
+from scheduler import Scheduler, POLICIES
+from upload_engine import UploadEngine
+from projects import ProjectPool, ProjectServices
+from shaping import Shaper, parse_window
+from transcode import Transcoder, find_ffmpeg, is_valid_profile, REMUX
+from quota import DAILY_BUDGET, INSERT_COST, seconds_until_reset
 
 DESCRIPTION = '''
     Reads in a table that describe each video recorded that will be uploaded
@@ -31,181 +40,40 @@ DESCRIPTION = '''
 EPILOG = '''Example:
      $ python process_table.py /home/rick/projects/youtube_upload/table.xlsx'''
 
-# text in the caption, args to format are drawn in from the table
-TEXT = (f"Published on { dt.now().strftime('%B %d, %Y') }\n\n"
+# templates of the title and the text in the caption, fields are filled from
+# the columns of the table, see templates.py for the others
+TITLE = '{Youtube name}'
+TEXT = ("Published on {published}\n\n"
 "NOTE: No captions are provided because all sound is underwater or background"
-"noise.\n\n\nThis video was collected in {0} as part of the EPA Environmental "
+"noise.\n\n\nThis video was collected in {year} as part of the EPA "
+"Environmental "
 "Assessment Research Programs.\n\n\nFor more information about EPA: "
 "http://www.epa.gov/ We accept comments according to out comment policy: "
 "http://blog.epa.gov/blog/comment-policy/")
 
-# Explicitly tell the underlying HTTP transport library not to retry, since
-# we are handling retry logic ourselves.
-httplib2.RETRIES = 1
-
-# Maximum number of times to retry before giving up.
-MAX_RETRIES = 10
-
-# Always retry when these exceptions are raised.
-RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, http.client.NotConnected,
-  http.client.IncompleteRead, http.client.ImproperConnectionState,
-  http.client.CannotSendRequest, http.client.CannotSendHeader,
-  http.client.ResponseNotReady, http.client.BadStatusLine)
-
-# Always retry when an apiclient.errors.HttpError with one of these status
-# codes is raised.
-RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
-
-# The CLIENT_SECRETS_FILE variable specifies the name of a file that contains
-# the OAuth 2.0 information for this application, including its client_id and
-# client_secret. You can acquire an OAuth 2.0 client ID and client secret from
-# the Google API Console at
-# https://console.developers.google.com/.
-# Please ensure that you have enabled the YouTube Data API for your project.
-# For more information about using OAuth2 to access the YouTube Data API, see:
-#   https://developers.google.com/youtube/v3/guides/authentication
-# For more information about the client_secrets.json file format, see:
-#   https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
-CLIENT_SECRETS_FILE = "client_secrets.json"
-
-# This OAuth 2.0 access scope allows an application to upload files to the
-# authenticated user's YouTube channel, but doesn't allow other types of access.
-YOUTUBE_UPLOAD_SCOPE = "https://www.googleapis.com/auth/youtube.upload"
-YOUTUBE_API_SERVICE_NAME = "youtube"
-YOUTUBE_API_VERSION = "v3"
-
-# This variable defines a message to display if the CLIENT_SECRETS_FILE is
-# missing.
-MISSING_CLIENT_SECRETS_MESSAGE = """
-WARNING: Please configure OAuth 2.0
-
-To make this sample run you will need to populate the client_secrets.json file
-found at:
-
-   %s
-
-with information from the API Console
-https://console.developers.google.com/
-
-For more information about the client_secrets.json file format, please visit:
-https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
-""" % os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                   CLIENT_SECRETS_FILE))
-
-VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
-
-
-def get_authenticated_service(args):
-  flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
-    scope=YOUTUBE_UPLOAD_SCOPE,
-    message=MISSING_CLIENT_SECRETS_MESSAGE)
-
-  storage = Storage("%s-oauth2.json" % sys.argv[0])
-  credentials = storage.get()
-
-  if credentials is None or credentials.invalid:
-    credentials = run_flow(flow, storage, args)
-
-  return build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-    http=credentials.authorize(httplib2.Http()))
-
-def initialize_upload(youtube, options):
-  tags = None
-  if options.keywords:
-    tags = options.keywords.split(",")
-
-  body=dict(
-    snippet=dict(
-      title=options.title,
-      description=options.description,
-      tags=tags,
-      categoryId=options.category
-    ),
-    status=dict(
-      privacyStatus=options.privacyStatus
-    )
-  )
-
-  # Call the API's videos.insert method to create and upload the video.
-  insert_request = youtube.videos().insert(
-    part=",".join(list(body.keys())),
-    body=body,
-    # The chunksize parameter specifies the size of each chunk of data, in
-    # bytes, that will be uploaded at a time. Set a higher value for
-    # reliable connections as fewer chunks lead to faster uploads. Set a lower
-    # value for better recovery on less reliable connections.
-    #
-    # Setting "chunksize" equal to -1 in the code below means that the entire
-    # file will be uploaded in a single HTTP request. (If the upload fails,
-    # it will still be retried where it left off.) This is usually a best
-    # practice, but if you're using Python older than 2.6 or if you're
-    # running on App Engine, you should set the chunksize to something like
-    # 1024 * 1024 (1 megabyte).
-    media_body=MediaFileUpload(options.file, chunksize=-1, resumable=True)
-  )
-
-  resumable_upload(insert_request)
-
-# This method implements an exponential backoff strategy to resume a
-# failed upload.
-def resumable_upload(insert_request):
-  response = None
-  error = None
-  retry = 0
-  while response is None:
-    try:
-      print("Uploading file...")
-      status, response = insert_request.next_chunk()
-      if response is not None:
-        if 'id' in response:
-          print("Video id '%s' was successfully uploaded." % response['id'])
-        else:
-          exit("The upload failed with an unexpected response: %s" % response)
-    except HttpError as e:
-      if e.resp.status in RETRIABLE_STATUS_CODES:
-        error = "A retriable HTTP error %d occurred:\n%s" % (e.resp.status,
-                                                             e.content)
-      else:
-        raise
-    except RETRIABLE_EXCEPTIONS as e:
-      error = "A retriable error occurred: %s" % e
-
-    if error is not None:
-      print(error)
-      retry += 1
-      if retry > MAX_RETRIES:
-        exit("No longer attempting to retry.")
-
-      max_sleep = 2 ** retry
-      sleep_seconds = random.random() * max_sleep
-      print("Sleeping %f seconds and then retrying..." % sleep_seconds)
-      time.sleep(sleep_seconds)
-
-def process(fn):
-
-    if fn.split('.')[-1] == 'xlsx':
-        is_xl = True
-        tbl = pd.read_excel(fn)
-
-    if fn.split('.')[-1] == 'csv':
-        is_xl = False
-        tbl = pd.read_csv(fn)
-        tbl.DateCollected = tbl.DateCollected.str.slice(stop=4)
+
+def process(fn, budget=DAILY_BUDGET, workers=1, max_rate=None, chunksize=None,
+            adaptive=False, hash_files=True, dedup=True, metrics_fn=None,
+            order='table', deadline=None, projects=None, pipeline=False,
+            mmap=False, title=TITLE, description=TEXT, transcode=None,
+            ffmpeg=None, shaper=None, leases=None, status_port=None):
+
+    # only the 'yes' rows of the columns we use, cached after the first read
+    tbl = read_table(fn)
 
     uid_col = 'UID'
     path_col = 'Path'
-    date_col = 'DateCollected'
-    tbl = tbl.loc[tbl.NewforMapViewer == 'yes']
 
     validate_column_uniqueness([uid_col, path_col], tbl)
 
-    tbl.set_index('UID', inplace=True, drop=False)
-    for uid, location in tbl.Path.iteritems():
-        miss = 0
-        # print ('HERE:', location)
-        if not os.path.exists(location):
-            print (f"UID: <{uid}> doesn't exist in the given location:")
-            print ('\t' + f"{location}")
+    files = validate_files(tbl.Path, hash_files)
+    miss = 0
+    for uid, info in files.items():
+        if info.error is not None:
+            print (f"UID: <{uid}> doesn't exist or can't be read in the given "
+                   "location:")
+            print ('\t' + f"{info.path}")
+            logging.error('UID: %s -- %s', uid, info.error)
             miss += 1
     if miss:
         print ('Either find these files and update, '
@@ -213,37 +81,354 @@ def process(fn):
         logging.critical('Failed due to videos missing from where '
                          'they were stated to be!')
         sys.exit()
+    text = render_text(tbl, title, description)
     print ('Table validation passed, begin calling YouTube API...')
-    args = Namespace(   auth_host_name='localhost',
-                        auth_host_port=[8080, 8090],
-                        category='28', # 28 is Sciecnce & Technology
-                        description='bologna',
-                        file='/a/bogus/path/to/file.mp4',
-                        keywords='',
-                        logging_level='ERROR',
-                        noauth_local_webserver=False,
-                        privacyStatus='unlisted',
-                        title='testes')
-    youtube = get_authenticated_service(args)
-    for uid, row in tbl.iterrows():
-        desc = TEXT.format(row[date_col].year if is_xl else row[date_col])
-        args.description=desc
-        args.file=row.Path
-        args.title=row['Youtube name']
-        print(args)
-        try:
-            initialize_upload(youtube, args)
-        except HttpError as e:
-            # this is where the 403 error was thrown and where the sleep will
-            # have to go. mid-loop
-            wait_time = (60*30) #extra half hour to be sure
-            print("An HTTP error %d occurred:\n%s" % (e.resp.status, e.content))
-            for chunk in range(50):
-                print(chunk)
-                time.sleep(wait_time)
-            youtube = get_authenticated_service(args)
-            initialize_upload(youtube, args)
-        logging.info('%s -- UID: %s successfully uploaded.', dt.now(), row.UID)
+    uploader = BulkUploader(budget, workers, max_rate, chunksize, adaptive,
+                            dedup, metrics_fn, order, deadline, projects,
+                            pipeline, mmap, transcode, ffmpeg, shaper, leases,
+                            status_port)
+    # videos YouTube couldn't process since the last run go up again in
+    # this one, see processing.py
+    uploader.check_processing()
+    results = uploader.upload(tbl, files, text)
+    uploader.close()
+    return results
+
+
+class BulkUploader:
+    '''
+    Everything that is kept from one batch of rows to the next: the ledger,
+    the project pool and its quota, the index of the channel, the metrics of
+    the run, the pool of upload threads with their authorized services, the
+    processes converting videos, the leases shared with other machines and
+    the server showing the status of the run, if any.
+    `process` uploads a single table with one, watch.py keeps one going for
+    as long as it runs.
+
+    Parameters are the same as `process`.
+    '''
+
+    def __init__(self, budget=DAILY_BUDGET, workers=1, max_rate=None,
+                 chunksize=None, adaptive=False, dedup=True, metrics_fn=None,
+                 order='table', deadline=None, projects=None, pipeline=False,
+                 mmap=False, transcode=None, ffmpeg=None, shaper=None,
+                 leases=None, status_port=None):
+        # rate limits that can change while uploads run, see shaping.py
+        shaper = shaper or Shaper(max_rate)
+        if chunksize is None:
+            # a lease taken over by another machine stops the upload at the
+            # next chunk, and the status shows the bytes sent a chunk at a
+            # time, there has to be more than one
+            chunked = (shaper.active or adaptive or pipeline or mmap
+                       or leases is not None or status_port is not None)
+            chunksize = CHUNKSIZE if chunked else -1
+        self.args = upload_options(chunksize=chunksize, adaptive=adaptive,
+                                   pipeline=pipeline, mmap=mmap)
+        self.order = order
+        self.deadline = deadline
+        self.ledger = Ledger()
+        # uploads are spread over every project in the pool, see projects.py
+        self.pool = projects or ProjectPool.single(budget)
+        self.pool.authorize(self.args)
+        self.metrics = MetricsLog(metrics_fn or
+                                  f".logging/metrics_"
+                                  f"{dt.now().strftime('%s')}.jsonl")
+        # when the channel's upload limit was hit nothing is sent until then
+        self.held_until = None
+        self.index = None
+        if dedup:
+            # only what changed on the channel since the last run is fetched
+            mirror = Mirror()
+            self.index = channel_index(self.pool.first.service(self.args),
+                                       self.pool.first.quota, mirror)
+            mirror.close()
+        # follows the uploaded videos through YouTube's processing
+        self.tracker = StatusTracker(self.ledger, self.pool.first.quota)
+        args = self.args
+        self.engine = UploadEngine(lambda: ProjectServices(args), workers,
+                                   shaper=shaper)
+        # videos are converted in other processes while earlier ones upload
+        self.transcoder = None
+        if transcode:
+            self.transcoder = Transcoder(ffmpeg or find_ffmpeg(), transcode)
+        # rows are claimed from the other machines before they're sent, see
+        # leases.py
+        self.leases = leases.start() if leases is not None else None
+        # how the run is going, see status.py
+        self.status_server = None
+        if status_port is not None:
+            self.status_server = StatusServer(self.status, status_port).start()
+
+    def upload(self, tbl, files, text):
+        '''
+        Upload every row of `tbl` that isn't up yet.
+
+        Parameters
+        ----------
+        tbl : DataFrame
+            Rows to upload, indexed by UID.
+        files : dict
+            UID -> FileInfo of every row, from `validate_files`.
+        text : VideoText
+            Titles and descriptions of every row.
+
+        Returns
+        -------
+        results : dict
+            UID -> UploadResult of each row that was sent.
+        '''
+        ledger, pool, metrics = self.ledger, self.pool, self.metrics
+        dupes = table_duplicates(files)
+
+        def jobs():
+            for uid, row in tbl.iterrows():
+                fp = fingerprint(row.Path)
+                if ledger.is_done(uid, fp):
+                    print (f"UID: <{uid}> already uploaded, skipping.")
+                    continue
+                video_id = self.leases and self.leases.done(uid, fp)
+                if video_id:
+                    print (f"UID: <{uid}> already uploaded by another "
+                           "machine, skipping.")
+                    ledger.record(uid, fp, row.Path, UPLOADED, video_id)
+                    continue
+                dupe = find_duplicate(uid, fp, text.title(uid), files[uid],
+                                      ledger, self.index, dupes)
+                if dupe is not None:
+                    reason, video_id = dupe
+                    print (f"UID: <{uid}> {reason}, skipping.")
+                    logging.warning('UID: %s -- %s, skipping.', uid, reason)
+                    if video_id is not None:
+                        ledger.record(uid, fp, row.Path, UPLOADED, video_id)
+                    continue
+                options = upload_options(**vars(self.args))
+                options.title = text.title(uid)
+                options.file=row.Path
+                options.sha256=files[uid].sha256
+                metrics.queue(files[uid].size)
+                yield uid, (uid, fp, options)
+
+        def upload(services, job, progress):
+            uid, fp, options = job
+            source = options.file
+            if self.held_until is not None and time.time() < self.held_until:
+                metrics.skip(files[uid].size)
+                ledger.record(uid, fp, source, DEFERRED)
+                return UploadResult(uid, None, 0, UploadError(
+                    "The channel's upload limit was reached earlier",
+                    'upload_limit', DEFER))
+            leases = self.leases
+            if leases is not None:
+                holder = leases.claim(uid, fp)
+                if holder == DONE:
+                    # finished elsewhere since the table was read
+                    if self.transcoder is not None:
+                        self.transcoder.discard(uid)
+                    metrics.skip(files[uid].size)
+                    video_id = leases.done(uid, fp)
+                    print (f"UID: <{uid}> already uploaded by another "
+                           "machine, skipping.")
+                    ledger.record(uid, fp, source, UPLOADED, video_id)
+                    return UploadResult(uid, video_id, 0, None)
+                if holder is not None:
+                    # left alone here, it's picked up again if the other
+                    # machine gives it back
+                    metrics.skip(files[uid].size)
+                    print (f"UID: <{uid}> being uploaded by {holder}, "
+                           "skipping.")
+                    logging.info('%s -- UID: %s claimed by %s', dt.now(), uid,
+                                 holder)
+                    return UploadResult(uid, None, 0, UploadError(
+                        f'Claimed by {holder}', 'claimed', DEFER))
+                progress = leased(leases, uid, fp, progress)
+            try:
+                result = send(services, uid, fp, options, progress)
+            except BaseException:
+                if leases is not None:
+                    leases.release(uid, fp)
+                raise
+            if leases is not None:
+                if result.ok:
+                    leases.complete(uid, fp, result.video_id)
+                else:
+                    leases.release(uid, fp)
+            return result
+
+        def send(services, uid, fp, options, progress):
+            source = options.file
+            ledger.record(uid, fp, source, STARTED)
+            session = ledger.session(uid, fp)
+            if self.leases is not None:
+                session = self.leases.session(uid, fp, session)
+            size = files[uid].size
+            if self.transcoder is not None:
+                options.file = self.transcoder.result(uid, source)
+                if options.file != source:
+                    # a saved session only resumes the same converted bytes,
+                    # so it's not shared, another machine's may differ
+                    session = ledger.session(uid, fingerprint(options.file))
+                    size = os.path.getsize(options.file)
+                    options.sha256 = None
+            m = metrics.start(uid, options.file, size)
+            reauthorized = False
+            while True:
+                if session.uri is not None:
+                    # a saved session was paid for when it was opened, it
+                    # goes on with the same project, or any one if another
+                    # machine opened it
+                    project = pool.get(session.project) or pool.first
+                else:
+                    project = pool.reserve(INSERT_COST)
+                    while project is None:
+                        waiting = time.time()
+                        m.waiting = True
+                        pool.wait_for_reset()
+                        m.waiting = False
+                        m.waited(time.time() - waiting)
+                        project = pool.reserve(INSERT_COST)
+                    session.project = project.name
+                m.project = project.name
+                # rendered now so the date is the day it goes up
+                options.description = text.description(uid)
+                result = upload_row(services[project], uid, options, progress,
+                                    session, m)
+                if result.ok:
+                    break
+                outcome = classify(result.error)
+                print(f"UID: <{uid}> {outcome.kind} error: {outcome.detail}")
+                if outcome.action == SWITCH:
+                    # the 403 is thrown here, move on to a project that has
+                    # quota left or hold the queue until the reset if none do
+                    pool.exhaust(project)
+                elif outcome.action == REAUTH and not reauthorized:
+                    refresh_credentials(force=True)
+                    reauthorized = True
+                else:
+                    break
+            if not result.ok:
+                # the rest of the table carries on whatever went wrong here
+                status = DEFERRED if outcome.action == DEFER else FAILED
+                if outcome.kind == 'upload_limit':
+                    # the limit is the channel's, every other row would hit
+                    # it too
+                    self.held_until = time.time() + seconds_until_reset()
+                    print ("The channel's upload limit was reached, the rest "
+                           "of the rows are left for later.")
+                m.error = outcome.kind
+                metrics.finish(m, status)
+                ledger.record(uid, fp, source, status)
+                log = logging.warning if status == DEFERRED else logging.error
+                log('%s -- UID: %s %s (%s): %s', dt.now(), uid, status,
+                    outcome.kind, outcome.detail)
+                return result
+            metrics.finish(m, UPLOADED)
+            ledger.record(uid, fp, source, UPLOADED, result.video_id,
+                          result.bytes_sent)
+            if options.file != source:
+                # only kept to resume a half-sent upload
+                self.transcoder.remove(options.file)
+            logging.info('%s -- UID: %s successfully uploaded.', dt.now(), uid)
+            return result
+
+        priorities = tbl.Priority.to_dict() if 'Priority' in tbl else None
+        sizes = {uid: info.size for uid, info in files.items()}
+        scheduler = Scheduler(self.order, sizes, priorities, pool, INSERT_COST,
+                              self.deadline, lambda: metrics.throughput)
+        # in table order the rows are looked at as the uploads get to them,
+        # not all before the first is sent
+        queued = scheduler(jobs())
+        if self.transcoder is not None:
+            # converted in the order they'll go up so the first uploads wait
+            # the least
+            queued = self.transcoder.ahead(queued, files)
+        return self.engine.run(queued, upload)
+
+    def check_processing(self):
+        '''
+        Look at the uploaded videos that are due a check, see processing.py.
+
+        Returns
+        -------
+        list
+            UIDs put back in the queue because YouTube couldn't process them.
+        '''
+        if not self.tracker.due():
+            return []
+        requeued = self.tracker.poll(self.pool.first.service(self.args))
+        for uid, video_id in requeued:
+            # or the broken video would count as already being on the channel
+            if self.index is not None:
+                self.index.remove(video_id)
+            # or as uploaded by another machine
+            if self.leases is not None:
+                self.leases.requeue(uid, video_id)
+        return [uid for uid, _ in requeued]
+
+    def status(self):
+        '''
+        How the run is going: the queue, the uploads going now, the totals
+        so far and the quota left in every project.
+
+        Returns
+        -------
+        dict
+        '''
+        status = self.metrics.snapshot()
+        held = None
+        if self.held_until is not None and time.time() < self.held_until:
+            held = round(self.held_until - time.time())
+        reset = seconds_until_reset()
+        status['quota'] = dict(
+            remaining=self.pool.remaining,
+            reset_seconds=round(reset),
+            reset_at=(dt.now() + timedelta(seconds=reset)).isoformat(
+                timespec='seconds'),
+            held_seconds=held,
+            projects=[dict(name=p.name, remaining=p.quota.remaining,
+                           budget=p.quota.budget)
+                      for p in self.pool.projects])
+        return status
+
+    def close(self):
+        if self.status_server is not None:
+            self.status_server.stop()
+        if self.transcoder is not None:
+            self.transcoder.close()
+        self.engine.close()
+        if self.leases is not None:
+            self.leases.close()
+        self.ledger.close()
+        self.metrics.summary()
+
+def parse_deadline(arg):
+    '''
+    Turn an HH:MM time into the next time the clock reads that.
+
+    Parameters
+    ----------
+    arg : string
+        Time of day as HH:MM, or None.
+
+    Returns
+    -------
+    datetime or None
+    '''
+    if not arg:
+        return None
+    now = dt.now()
+    deadline = dt.combine(now.date(), dt.strptime(arg, '%H:%M').time())
+    if deadline <= now:
+        deadline += timedelta(days=1)
+    return deadline
+
+def read_template(fn, default=TEXT):
+    '''
+    The template in the file `fn`, or `default` if no file was given.
+    '''
+    if not fn:
+        return default
+    with open(fn) as f:
+        return f.read()
 
 def is_valid_file(parser, arg):
     '''
@@ -303,7 +488,75 @@ if __name__ == '__main__':
              epilog=EPILOG)
     parser.add_argument("file", help="path/to/xl/or/csv/table.xlsx",
                         type=lambda x: is_valid_file(parser, x))
+    parser.add_argument("--quota", type=int, default=DAILY_BUDGET,
+                        help="daily quota units available to the project")
+    parser.add_argument("--projects", default=None,
+                        help="JSON file listing the projects to spread "
+                        "uploads over, see projects.py")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of videos to upload at the same time")
+    parser.add_argument("--max-rate", type=float, default=None,
+                        help="cap on the upload rate in MB/s for the run")
+    parser.add_argument("--upload-rate", type=float, default=None,
+                        help="cap on the rate of each upload in MB/s")
+    parser.add_argument("--window", action="append", default=[],
+                        metavar="HH:MM-HH:MM=RATE",
+                        help="different cap for part of the day, in MB/s or "
+                        "as a percentage of --max-rate, e.g. 08:00-18:00=20%%")
+    parser.add_argument("--limits", default=None,
+                        help="JSON file of rate limits, read again whenever "
+                        "it's saved, see shaping.py")
+    parser.add_argument("--chunksize", type=float, default=None,
+                        help="MB sent per request, the whole file by default")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="grow or shrink chunks to suit the connection")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="read and hash the next chunk while the current "
+                        "one is sent")
+    parser.add_argument("--mmap", action="store_true",
+                        help="send chunks from a memory map of the file so "
+                        "memory use stays at about one chunk per upload")
+    parser.add_argument("--transcode", default=None, metavar="PROFILE",
+                        help="'remux' to copy the streams into a new mp4, or "
+                        "a video bitrate such as 2500k to re-encode at, "
+                        "before uploading")
+    parser.add_argument("--ffmpeg", default=None,
+                        help="ffmpeg binary used by --transcode, the one on "
+                        "the PATH by default")
+    parser.add_argument("--title-template", default=TITLE,
+                        help="title of each video, {fields} are columns of "
+                        "the table")
+    parser.add_argument("--description-template", default=None,
+                        help="file holding the template of the description")
+    parser.add_argument("--leases", default=None,
+                        help="SQLite file on a share where machines working "
+                        "on the same videos claim rows, see leases.py")
+    parser.add_argument("--status-port", type=int, default=None,
+                        help="port on localhost to serve the status of the "
+                        "run on, as JSON and Prometheus metrics, see "
+                        "status.py")
+    parser.add_argument("--no-hash", action="store_true",
+                        help="don't hash files that haven't been seen before")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="don't check the channel for videos already up")
+    parser.add_argument("--order", choices=POLICIES, default='table',
+                        help="order rows are uploaded in, 'fit' packs what's "
+                        "left of today's quota")
+    parser.add_argument("--deadline", default=None,
+                        help="HH:MM, don't start uploads that won't be done "
+                        "by then")
     args = parser.parse_args()
+    try:
+        windows = [parse_window(w) for w in args.window]
+    except ValueError as e:
+        parser.error(str(e))
+    if any(str(w.rate).endswith('%') for w in windows) and not args.max_rate:
+        parser.error("A percentage --window needs a --max-rate.")
+    if args.transcode and not is_valid_profile(args.transcode):
+        parser.error(f"--transcode takes '{REMUX}' or a bitrate, not "
+                     f"{args.transcode}")
+    if args.transcode and not find_ffmpeg(args.ffmpeg):
+        parser.error(f"Can't find {args.ffmpeg or 'ffmpeg'} to transcode with.")
     if not os.path.exists('./.logging'):
         os.mkdir('./.logging')
     script_name = sys.argv[0].split('.')[0].split(os.sep)[-1]
@@ -318,7 +571,26 @@ if __name__ == '__main__':
         print ('Please run this file in the directory where it is located!\n'
                 'so that the .logging/ directory can be found if needed later!')
         sys.exit()
-    process(args.file)
+    max_rate = args.max_rate * 1024 * 1024 if args.max_rate else None
+    upload_rate = args.upload_rate * 1024 * 1024 if args.upload_rate else None
+    shaper = Shaper(max_rate, upload_rate, windows, args.limits)
+    chunksize = int(args.chunksize * 1024 * 1024) if args.chunksize else None
+    projects = None
+    if args.projects:
+        projects = ProjectPool.load(args.projects, args.quota)
+        logging.info('PROJECTS: %s',
+                     ', '.join(p.name for p in projects.projects))
+    leases = None
+    if args.leases:
+        leases = Leases(args.leases)
+        logging.info('LEASES: %s as %s', args.leases, leases.owner)
+    process(args.file, args.quota, args.workers, max_rate, chunksize,
+            args.adaptive, not args.no_hash, not args.no_dedup,
+            fn[:-len('.log')] + '.jsonl', args.order,
+            parse_deadline(args.deadline), projects, args.pipeline,
+            args.mmap, args.title_template,
+            read_template(args.description_template), args.transcode,
+            find_ffmpeg(args.ffmpeg), shaper, leases, args.status_port)
     logging.info('Script finished successfully')
 
 
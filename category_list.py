@@ -11,36 +11,23 @@ Created on Mon Dec 23 16:20:06 2019
 # See instructions for running these code samples locally:
 # https://developers.google.com/explorer-help/guides/code_samples#python
 
-import os
-
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
-import googleapiclient.errors
-
-scopes = ["https://www.googleapis.com/auth/youtube.readonly"]
+from upload_video import get_authenticated_service, upload_options
+from mirror import Mirror
 
 def main():
-    # Disable OAuthlib's HTTPS verification when running locally.
-    # *DO NOT* leave this option enabled in production.
-    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
-
-    api_service_name = "youtube"
-    api_version = "v3"
-    client_secrets_file = "client_secrets.json"
-
-    # Get credentials and create an API client
-    flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
-        client_secrets_file, scopes)
-    credentials = flow.run_console()
-    youtube = googleapiclient.discovery.build(
-        api_service_name, api_version, credentials=credentials)
-
-    request = youtube.videoCategories().list(
-        
-    )
-    response = request.execute()
-
-    print(response)
+    # uses the token store and discovery cache shared with the upload scripts,
+    # the OAuth flow only runs if there aren't any stored credentials yet
+    youtube = get_authenticated_service(upload_options())
+
+    # the categories are kept in the mirror of the channel and only fetched
+    # again when YouTube says they've changed
+    mirror = Mirror()
+    mirror.sync_categories(youtube)
+    mirror.conn.commit()
+    for category_id, title, assignable in mirror.categories():
+        print(f"{category_id:>3}  {title}" + ("" if assignable else
+                                              "  (can't be assigned)"))
+    mirror.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Picks the size of each chunk sent in a resumable upload. Chunks grow while
+the connection is fast and steady so that fewer requests are made, and shrink
+after an error so that less has to be sent again over a flaky link.
+
+@author: rick
+"""
+
+# the upload protocol wants chunks in multiples of 256 KB
+CHUNK_UNIT = 256 * 1024
+
+MIN_CHUNKSIZE = CHUNK_UNIT
+MAX_CHUNKSIZE = 128 * 1024 * 1024
+DEFAULT_CHUNKSIZE = 8 * 1024 * 1024
+
+# how long a single chunk should take to send when things are going well
+TARGET_SECONDS = 30.0
+
+
+def round_chunk(size):
+    '''
+    Round a chunk size down to a multiple of `CHUNK_UNIT` inside the limits.
+    '''
+    size = int(size) // CHUNK_UNIT * CHUNK_UNIT
+    return min(max(size, MIN_CHUNKSIZE), MAX_CHUNKSIZE)
+
+
+class AdaptiveChunker:
+    '''
+    Sizes chunks from the measured throughput so each one takes about
+    `target` seconds, at most doubling after a success and halving after any
+    error.
+
+    Parameters
+    ----------
+    initial : int
+        Size of the first chunk in bytes.
+    target : float
+        Number of seconds each chunk should take to send.
+    '''
+
+    def __init__(self, initial=DEFAULT_CHUNKSIZE, target=TARGET_SECONDS):
+        self.size = round_chunk(initial)
+        self.target = target
+        self.errors = 0
+
+    def success(self, nbytes, seconds):
+        '''
+        Record a chunk of `nbytes` that took `seconds` to be accepted.
+        '''
+        if nbytes <= 0 or seconds <= 0:
+            return
+        self.errors = 0
+        wanted = nbytes / seconds * self.target
+        self.size = round_chunk(min(wanted, self.size * 2))
+
+    def failure(self):
+        '''
+        Record a chunk that had to be retried.
+        '''
+        self.errors += 1
+        self.size = round_chunk(self.size / 2)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Finds videos that are already on the channel before any bytes are sent.
+YouTube won't take the same video twice but only says so after the whole file
+has gone up and the insert quota is spent, and some of the videos in the table
+were uploaded by hand. An index of the channel's uploads is built up front,
+from their titles and the name and size of the file each was uploaded from,
+and rows are checked against it along with the ledger's fingerprints. Rows in
+the table that point at identical files under different UIDs are flagged too.
+If the channel can't be listed, e.g. because the day's quota is gone when a
+run is restarted, the run carries on checking against the ledger alone.
+
+@author: rick
+"""
+
+import os
+import logging
+from datetime import datetime as dt
+
+from apiclient.errors import HttpError
+
+from errors import classify, RETRIABLE_EXCEPTIONS, SWITCH
+
+# most ids or items the API hands back in one call
+PAGE_SIZE = 50
+
+# quota cost of a list call
+LIST_COST = 1
+
+
+def uploads_playlist(youtube):
+    '''
+    Id of the playlist that holds every upload of the authorized channel.
+    '''
+    response = youtube.channels().list(part='contentDetails',
+                                       mine=True).execute()
+    items = response.get('items', [])
+    if not items:
+        return None
+    return items[0]['contentDetails']['relatedPlaylists']['uploads']
+
+
+def channel_index(youtube, quota=None, mirror=None):
+    '''
+    Index the channel, from a synced mirror if one is given, see mirror.py.
+    Errors listing the channel don't stop the run: the mirror is indexed as
+    it was last synced, or without one the rows are only checked against the
+    ledger.
+
+    Parameters
+    ----------
+    youtube : Resource
+        Authenticated YouTube service.
+    quota : QuotaTracker, optional
+        Charged for every list call made, and emptied if YouTube says the
+        day's quota is gone.
+    mirror : Mirror, optional
+        Local copy of the channel to sync and index.
+
+    Returns
+    -------
+    ChannelIndex or None
+    '''
+    try:
+        if mirror is None:
+            return ChannelIndex.build(youtube, quota)
+        mirror.sync(youtube, quota, playlists=False, categories=False)
+    except (HttpError,) + RETRIABLE_EXCEPTIONS as e:
+        outcome = classify(e)
+        if outcome.action == SWITCH and quota is not None:
+            # so the uploads wait for the reset rather than each finding out
+            quota.exhaust()
+        fallback = ('the mirror as last synced' if mirror is not None
+                    else 'the ledger alone')
+        print (f"Couldn't list the channel ({outcome.kind}), checking for "
+               f"videos already up against {fallback}.")
+        logging.warning("%s -- Couldn't list the channel (%s): %s, using %s",
+                        dt.now(), outcome.kind, outcome.detail, fallback)
+        if mirror is None:
+            return None
+    return ChannelIndex.from_mirror(mirror)
+
+
+class ChannelIndex:
+    '''
+    Lookup of the channel's videos by title and by the (file name, size) of
+    the file they were uploaded from.
+    '''
+
+    def __init__(self):
+        self.titles = {}
+        self.files = {}
+
+    def add(self, video_id, title=None, file_name=None, file_size=None):
+        if title:
+            self.titles.setdefault(title.strip(), video_id)
+        if file_name and file_size:
+            self.files.setdefault((file_name, int(file_size)), video_id)
+
+    @classmethod
+    def build(cls, youtube, quota=None):
+        '''
+        Page through the channel's uploads, 50 at a time, then fetch the
+        file details for each page of ids in a single call.
+
+        Parameters
+        ----------
+        youtube : Resource
+            Authenticated YouTube service.
+        quota : QuotaTracker, optional
+            Charged for every list call made.
+
+        Returns
+        -------
+        ChannelIndex
+        '''
+        index = cls()
+        playlist = uploads_playlist(youtube)
+        calls = 1
+        token = None
+        while playlist:
+            page = youtube.playlistItems().list(part='snippet',
+                                                playlistId=playlist,
+                                                maxResults=PAGE_SIZE,
+                                                pageToken=token).execute()
+            ids = [item['snippet']['resourceId']['videoId']
+                   for item in page.get('items', [])]
+            calls += 1
+            if ids:
+                videos = youtube.videos().list(part='snippet,fileDetails',
+                                               id=','.join(ids),
+                                               maxResults=PAGE_SIZE).execute()
+                calls += 1
+                for video in videos.get('items', []):
+                    details = video.get('fileDetails', {})
+                    index.add(video['id'], video['snippet'].get('title'),
+                              details.get('fileName'),
+                              details.get('fileSize'))
+            token = page.get('nextPageToken')
+            if not token:
+                break
+        if quota is not None:
+            quota.charge(calls * LIST_COST)
+        logging.info('Indexed %d videos on the channel with %d calls',
+                     len(index.titles), calls)
+        return index
+
+    def remove(self, video_id):
+        '''
+        Forget a video, e.g. one that failed processing and is going up
+        again.
+        '''
+        for lookup in (self.titles, self.files):
+            for key in [k for k, v in lookup.items() if v == video_id]:
+                del lookup[key]
+
+    @classmethod
+    def from_mirror(cls, mirror):
+        '''
+        Index the videos in a synced local mirror of the channel, see
+        mirror.py, which costs no quota beyond the sync itself.
+
+        Parameters
+        ----------
+        mirror : Mirror
+
+        Returns
+        -------
+        ChannelIndex
+        '''
+        index = cls()
+        for video_id, title, file_name, file_size in mirror.videos():
+            index.add(video_id, title, file_name, file_size)
+        logging.info('Indexed %d videos from the mirror of the channel',
+                     len(index.titles))
+        return index
+
+    def match(self, title=None, path=None, size=None):
+        '''
+        Id of a video on the channel that looks like this one, if any.
+
+        Parameters
+        ----------
+        title : string, optional
+            Title the row would be uploaded with.
+        path : string, optional
+            Location of the file to be uploaded.
+        size : int, optional
+            Size of that file in bytes.
+
+        Returns
+        -------
+        string or None
+        '''
+        if isinstance(title, str) and title.strip() in self.titles:
+            return self.titles[title.strip()]
+        if path and size:
+            name = os.path.basename(path.replace('\\', '/'))
+            return self.files.get((name, int(size)))
+        return None
+
+
+def table_duplicates(files):
+    '''
+    Find rows that point at identical files under different UIDs.
+
+    Parameters
+    ----------
+    files : dict
+        UID -> FileInfo from `validate.validate_files`.
+
+    Returns
+    -------
+    dupes : dict
+        UID -> the first UID in the table with the same contents.
+    '''
+    first = {}
+    dupes = {}
+    for uid, info in files.items():
+        if info.sha256 is None:
+            continue
+        if info.sha256 in first:
+            dupes[uid] = first[info.sha256]
+        else:
+            first[info.sha256] = uid
+    return dupes
+
+
+def find_duplicate(uid, fp, title, info, ledger, index=None, dupes=None):
+    '''
+    Check a row against everything that says it's already been uploaded.
+
+    Parameters
+    ----------
+    uid : string
+        UID of the row in the table.
+    fp : string
+        Fingerprint of the file, see `ledger.fingerprint`.
+    title : string
+        Title the row would be uploaded with.
+    info : FileInfo
+        Result of validating the row's file.
+    ledger : Ledger
+        Record of past uploads.
+    index : ChannelIndex, optional
+        Videos already on the channel.
+    dupes : dict, optional
+        Result of `table_duplicates`.
+
+    Returns
+    -------
+    tuple or None
+        (reason, video_id) if the row shouldn't be uploaded, video_id is None
+        when there isn't a known video for it.
+    '''
+    if dupes and uid in dupes:
+        return f'is the same file as UID {dupes[uid]}', None
+    earlier = ledger.find(fp)
+    if earlier is not None:
+        return f'was already uploaded as UID {earlier[0]}', earlier[1]
+    if index is not None:
+        video_id = index.match(title, info.path, info.size)
+        if video_id is not None:
+            return 'is already on the channel', video_id
+    return None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Decides what to do about an error from YouTube. Google puts a `domain` and a
+`reason` in the payload of every error, and they say far more than the status
+code does: a 403 can mean the project is out of quota, the channel has hit
+its upload limit, or the request just isn't allowed. Each error is turned
+into an `Outcome`, a kind of problem along with the action to take:
+
+    RETRY   send the chunk again after backing off
+    REAUTH  refresh the access token, then send the chunk again
+    SWITCH  the project is out of quota, carry on with another one
+    DEFER   leave the row for a later run, it should go then
+    FAIL    the row won't go as it is, mark it failed and carry on
+
+so one bad file or bad title only costs its own row and the rest of the
+table keeps moving.
+
+@author: rick
+"""
+
+import http.client
+from collections import namedtuple
+
+import httplib2
+from apiclient.errors import HttpError
+from oauth2client.client import AccessTokenRefreshError
+
+from quota import error_reasons
+
+RETRY = 'retry'
+REAUTH = 'reauth'
+SWITCH = 'switch'
+DEFER = 'defer'
+FAIL = 'fail'
+
+# Always retry when these exceptions are raised.
+RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError,
+                        http.client.NotConnected, http.client.IncompleteRead,
+                        http.client.ImproperConnectionState,
+                        http.client.CannotSendRequest,
+                        http.client.CannotSendHeader,
+                        http.client.ResponseNotReady,
+                        http.client.BadStatusLine)
+
+# Always retry when an apiclient.errors.HttpError with one of these status
+# codes is raised.
+RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+
+# problems with the file itself, which sending again won't fix
+FILE_ERRORS = (FileNotFoundError, IsADirectoryError, NotADirectoryError,
+               PermissionError)
+
+# domains of the 403s that mean a project's quota is gone for the day
+QUOTA_DOMAINS = ('youtube.quota', 'usageLimits')
+
+# reason in the error payload -> (kind, action), ahead of the status code
+REASONS = {
+    'quotaExceeded': ('quota', SWITCH),
+    'dailyLimitExceeded': ('quota', SWITCH),
+    'rateLimitExceeded': ('rate_limit', RETRY),
+    'userRateLimitExceeded': ('rate_limit', RETRY),
+    'uploadLimitExceeded': ('upload_limit', DEFER),
+    'duplicate': ('duplicate', FAIL),
+    'authError': ('auth', REAUTH),
+    'invalidCredentials': ('auth', REAUTH),
+    'expired': ('auth', REAUTH),
+    'backendError': ('server', RETRY),
+    'internalError': ('server', RETRY),
+    'forbidden': ('forbidden', FAIL),
+}
+for _reason in ('invalidTitle', 'invalidDescription', 'invalidTags',
+                'invalidCategoryId', 'invalidFilename', 'invalidPublishAt',
+                'invalidRecordingDetails', 'invalidVideoGameRating',
+                'invalidVideoMetadata', 'defaultLanguageNotSet',
+                'mediaBodyRequired'):
+    REASONS[_reason] = ('invalid_metadata', FAIL)
+
+
+class Outcome(namedtuple('Outcome', 'kind action detail')):
+    """What went wrong, what to do about it and the message to show."""
+
+
+class UploadError(Exception):
+    """The upload couldn't be completed, `kind` and `action` say why and what
+    to do about the row."""
+
+    def __init__(self, message, kind='unknown', action=DEFER):
+        super().__init__(message)
+        self.kind = kind
+        self.action = action
+
+
+def http_outcome(e, session=True):
+    '''
+    Outcome of an HttpError, from its reasons first and its status second.
+    A 404 or 410 only means the resumable session expired when `session` is
+    set, otherwise what was asked for isn't there.
+    '''
+    status = e.resp.status
+    reasons = error_reasons(e)
+    detail = f'HTTP {status}: ' + (', '.join(str(reason) for _, reason
+                                             in reasons) or 'no reason given')
+    for domain, reason in reasons:
+        if reason in REASONS:
+            kind, action = REASONS[reason]
+            return Outcome(kind, action, detail)
+    if status == 403 and any(domain in QUOTA_DOMAINS for domain, _ in reasons):
+        return Outcome('quota', SWITCH, detail)
+    if status == 401:
+        return Outcome('auth', REAUTH, detail)
+    if status in (404, 410):
+        if not session:
+            return Outcome('not_found', FAIL, detail)
+        # the resumable session has expired on YouTube's end
+        return Outcome('session_expired', RETRY, detail)
+    if status == 429:
+        return Outcome('rate_limit', RETRY, detail)
+    if status in RETRIABLE_STATUS_CODES:
+        return Outcome('server', RETRY, detail)
+    if status == 400:
+        return Outcome('bad_request', FAIL, detail)
+    if status == 403:
+        return Outcome('forbidden', FAIL, detail)
+    return Outcome('unknown', FAIL, detail)
+
+
+def classify(e, session=True):
+    '''
+    Decide what to do about an error raised while uploading.
+
+    Parameters
+    ----------
+    e : Exception
+        Raised by the API client or by `resumable_upload`.
+    session : bool
+        Whether the error came from a resumable upload, False for any other
+        call such as the ones metadata.py batches up.
+
+    Returns
+    -------
+    Outcome
+    '''
+    if isinstance(e, HttpError):
+        return http_outcome(e, session)
+    if isinstance(e, UploadError):
+        return Outcome(e.kind, e.action, str(e))
+    if isinstance(e, AccessTokenRefreshError):
+        # the token was revoked or the client deleted, it needs a person
+        return Outcome('auth', FAIL, f'Refreshing the token failed: {e}')
+    if isinstance(e, FILE_ERRORS):
+        return Outcome('file', FAIL, str(e))
+    if isinstance(e, RETRIABLE_EXCEPTIONS):
+        return Outcome('network', RETRY, repr(e))
+    return Outcome('unknown', FAIL, repr(e))
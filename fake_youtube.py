@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the YouTube upload endpoint so the upload code can be timed
+without spending any quota. It speaks enough of the resumable upload protocol
+for the API client: the POST that opens a session, PUTs of each chunk
+answered with 308 and the range received, status queries with
+`Content-Range: bytes */size`, and the final response holding the video id.
+Latency, bandwidth, 5xx errors, dropped connections, expired sessions,
+quotaExceeded errors and errors for particular titles can all be injected.
+
+Example:
+     $ python fake_youtube.py --port 8765 --latency 0.05 --bandwidth 10
+
+@author: rick
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from apiclient.discovery import build_from_document
+from apiclient.http import build_http
+
+from upload_video import (YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
+                          DISCOVERY_CACHE_DIR)
+
+QUOTA_ERROR = json.dumps({'error': {
+    'errors': [{'domain': 'youtube.quota', 'reason': 'quotaExceeded',
+                'message': 'The request cannot be completed because you '
+                           'have exceeded your quota.'}],
+    'code': 403,
+    'message': 'The request cannot be completed because you have exceeded '
+               'your quota.'}}).encode()
+
+BLOCK_SIZE = 64 * 1024
+
+
+def error_body(status, reason, domain='youtube.video'):
+    '''
+    JSON payload of an error the way Google sends it.
+    '''
+    return json.dumps({'error': {
+        'errors': [{'domain': domain, 'reason': reason, 'message': reason}],
+        'code': status, 'message': reason}}).encode()
+
+
+class FakeYouTube(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded HTTP server holding the state of every upload session.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on, 0 picks a free one.
+    latency : float
+        Seconds added before answering every request.
+    bandwidth : float, optional
+        Bytes per second each connection is allowed to send.
+    error_rate : float
+        Chance that a chunk is answered with a 503.
+    drop_rate : float
+        Chance that a chunk is cut off partway and the connection closed.
+    quota_after : int, optional
+        Number of uploads allowed before every new one gets quotaExceeded.
+    expire_rate : float
+        Chance that a chunk finds its session gone, answered with a 404.
+    rejects : dict, optional
+        Title -> (status, reason) answered to the insert of that video.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None, error_rate=0.0,
+                 drop_rate=0.0, quota_after=None, expire_rate=0.0,
+                 rejects=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.quota_after = quota_after
+        self.expire_rate = expire_rate
+        self.rejects = rejects or {}
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.reset_counts()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = 0
+            self.inserts = 0
+            self.errors = 0
+            self.drops = 0
+            self.expired = 0
+            self.bytes_received = 0
+
+    def handle_error(self, request, client_address):
+        # dropped connections are on purpose
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self, drop=False, keep=True):
+        '''
+        Read the request body at no more than the allowed bandwidth, when
+        `drop` is set stop halfway and close the connection. Unless `keep` is
+        set only the number of bytes read is returned, so the server's memory
+        doesn't count against the client's in a benchmark.
+        '''
+        srv = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        stop = length // 2 if drop else length
+        read = 0
+        started = time.monotonic()
+        chunks = []
+        while read < stop:
+            block = self.rfile.read(min(BLOCK_SIZE, stop - read))
+            if not block:
+                break
+            if keep:
+                chunks.append(block)
+            read += len(block)
+            if srv.bandwidth:
+                ahead = read / srv.bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        with srv.lock:
+            srv.bytes_received += read
+        return b''.join(chunks) if keep else read
+
+    def _begin(self):
+        srv = self.server
+        with srv.lock:
+            srv.requests += 1
+        if srv.latency:
+            time.sleep(srv.latency)
+
+    def do_GET(self):
+        self._begin()
+        # list calls made by the dedup stage, the channel is always empty
+        self._reply(200, json.dumps({'items': []}).encode())
+
+    def do_POST(self):
+        self._begin()
+        srv = self.server
+        body = self._read_body()
+        if '/upload/' not in self.path:
+            self._reply(404)
+            return
+        with srv.lock:
+            over = (srv.quota_after is not None
+                    and srv.inserts >= srv.quota_after)
+            if not over:
+                srv.inserts += 1
+        if over:
+            self._reply(403, QUOTA_ERROR)
+            return
+        metadata = json.loads(body or b'{}')
+        title = metadata.get('snippet', {}).get('title')
+        if title in srv.rejects:
+            status, reason = srv.rejects[title]
+            self._reply(status, error_body(status, reason))
+            return
+        session = uuid.uuid4().hex
+        size = int(self.headers.get('X-Upload-Content-Length', 0) or 0)
+        with srv.lock:
+            srv.sessions[session] = dict(size=size, received=0,
+                                         metadata=metadata)
+        self._reply(200, headers={'Location': '%s/upload/session/%s'
+                                              % (srv.url, session)})
+
+    def do_PUT(self):
+        self._begin()
+        srv = self.server
+        key = self.path.rsplit('/', 1)[-1]
+        if key in srv.sessions and random.random() < srv.expire_rate:
+            with srv.lock:
+                srv.sessions.pop(key, None)
+                srv.expired += 1
+        session = srv.sessions.get(key)
+        if session is None:
+            self._read_body()
+            self._reply(404)
+            return
+        content_range = self.headers.get('Content-Range', '')
+        status_query = re.match(r'bytes \*/(\d+|\*)', content_range)
+        if status_query:
+            self._read_body()
+            self._progress(session)
+            return
+        drop = random.random() < srv.drop_rate
+        if drop:
+            self._read_body(drop=True)
+            with srv.lock:
+                srv.drops += 1
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        received = self._read_body(keep=False)
+        if random.random() < srv.error_rate:
+            with srv.lock:
+                srv.errors += 1
+            self._reply(503, b'{"error": {"code": 503}}')
+            return
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+        start = int(match.group(1)) if match else 0
+        if match and match.group(3) != '*':
+            session['size'] = int(match.group(3))
+        if start == session['received']:
+            session['received'] += received
+        self._progress(session)
+
+    def _progress(self, session):
+        if session['size'] and session['received'] >= session['size']:
+            if 'id' not in session:
+                session['id'] = uuid.uuid4().hex[:11]
+            body = dict(kind='youtube#video', id=session['id'],
+                        snippet=session['metadata'].get('snippet', {}))
+            self._reply(200, json.dumps(body).encode())
+        elif session['received']:
+            self._reply(308, headers={'Range': 'bytes=0-%d'
+                                               % (session['received'] - 1)})
+        else:
+            self._reply(308)
+
+
+def discovery_document():
+    '''
+    The YouTube discovery document, from the copy bundled with the API client
+    or else from the on-disk cache filled by `get_authenticated_service`.
+    '''
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        doc = get_static_doc(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION)
+    except ImportError:
+        doc = None
+    if doc is None:
+        import glob
+        for path in glob.glob(f'{DISCOVERY_CACHE_DIR}/*youtube*v3*.json'):
+            with open(path) as f:
+                doc = f.read()
+    if doc is None:
+        raise RuntimeError('No discovery document for YouTube, run any of '
+                           'the upload scripts once while online.')
+    return json.loads(doc)
+
+
+def local_service(url):
+    '''
+    A YouTube service that sends every request to the server at `url`.
+    '''
+    doc = discovery_document()
+    doc['rootUrl'] = url + '/'
+    doc['mtlsRootUrl'] = url + '/'
+    doc['baseUrl'] = url + '/' + doc.get('servicePath', '')
+    return build_from_document(doc, http=build_http())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='fake_youtube.py')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='MB/s allowed on each connection')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance a chunk gets a 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='chance a chunk has its connection dropped')
+    parser.add_argument('--quota-after', type=int, default=None,
+                        help='uploads allowed before quotaExceeded')
+    args = parser.parse_args()
+    bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth else None
+    server = FakeYouTube(args.port, args.latency, bandwidth, args.error_rate,
+                         args.drop_rate, args.quota_after)
+    print(f'Fake YouTube listening on {server.url}')
+    server.serve_forever()
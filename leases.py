@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Lets several machines work through the same videos without uploading any of
+them twice. Each field office runs the uploader on its own copy of the table,
+and before a row is sent it's claimed in a SQLite file on a share every
+machine can reach. A claim is a lease that runs out after `LEASE_SECONDS`
+unless the machine holding it keeps renewing it, which a background thread
+does while the upload runs. When a machine dies its leases run out and the
+rows go back to the pool for the others to take, and once a row is up it's
+marked done in the shared file so nobody sends it again. An upload whose
+lease was taken over after all, say the machine lost the share for longer
+than a lease, is stopped at its next chunk.
+
+The URI of each resumable session is kept with the lease as well, so the
+machine that takes over a row from one that died carries on with the same
+session rather than starting a second upload. If the dead machine had sent
+the last chunk but not lived to mark the row done, YouTube answers with the
+video it already has and it isn't uploaded twice.
+
+Rows are claimed by UID and the fingerprint of the file, like the ledger,
+and the leases are timed with each machine's own clock so the clocks need to
+be kept in sync to within a fraction of `LEASE_SECONDS`.
+
+Example:
+     $ python bulk_upload_video.py table.xlsx --leases //fileserver/youtube/leases.sqlite
+
+@author: rick
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from datetime import datetime as dt
+
+from errors import UploadError, DEFER
+
+# seconds a claim lasts without being renewed
+LEASE_SECONDS = 5 * 60
+
+# how many times a lease is renewed within its length
+RENEWALS = 3
+
+# seconds to wait on another machine holding the file locked
+BUSY_TIMEOUT = 60
+
+CLAIMED = 'claimed'
+DONE = 'done'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS leases (
+        uid         TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        owner       TEXT,
+        status      TEXT NOT NULL,
+        expires     REAL,
+        video_id    TEXT,
+        session     TEXT,
+        updated     TEXT,
+        PRIMARY KEY (uid, fingerprint)
+    )'''
+
+
+def node_name():
+    '''
+    Name this process claims rows under, unique across the machines.
+    '''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Leases:
+    '''
+    Claims on rows kept in a SQLite file shared between machines.
+
+    Parameters
+    ----------
+    fn : string
+        Path of the shared SQLite file.
+    owner : string, optional
+        Name claims are made under, see `node_name`.
+    ttl : float
+        Seconds a claim lasts without being renewed.
+    '''
+
+    def __init__(self, fn, owner=None, ttl=LEASE_SECONDS):
+        self.fn = fn
+        self.owner = owner or node_name()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # the journal has to stay beside the file, WAL doesn't work over
+        # network shares
+        self.conn = sqlite3.connect(fn, timeout=BUSY_TIMEOUT,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        self.held = set()
+        self.lost = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _transaction(self, fn):
+        # IMMEDIATE takes the write lock up front so two machines can't both
+        # read a row as free and then both claim it
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self.conn)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def done(self, uid, fp):
+        '''
+        Id of the video if another machine has already uploaded the row.
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT video_id FROM leases WHERE '
+                                    'uid = ? AND fingerprint = ? AND '
+                                    'status = ?', (str(uid), fp, DONE))
+            row = row.fetchone()
+        return row[0] if row else None
+
+    def claim(self, uid, fp):
+        '''
+        Take the row if nobody holds a live lease on it and it isn't done.
+
+        Returns
+        -------
+        string or None
+            None if the row was claimed, otherwise who has it or 'done'.
+        '''
+        key = (str(uid), fp)
+
+        def claim(conn):
+            now = time.time()
+            row = conn.execute('SELECT owner, status, expires FROM leases '
+                               'WHERE uid = ? AND fingerprint = ?',
+                               key).fetchone()
+            if row is not None:
+                owner, status, expires = row
+                if status == DONE:
+                    return DONE
+                if owner != self.owner and expires > now:
+                    return owner
+            conn.execute('INSERT INTO leases VALUES (?, ?, ?, ?, ?, NULL, '
+                         'NULL, ?) ON CONFLICT (uid, fingerprint) DO UPDATE '
+                         'SET owner = excluded.owner, status = '
+                         'excluded.status, expires = excluded.expires, '
+                         'updated = excluded.updated',
+                         key + (self.owner, CLAIMED, now + self.ttl,
+                                dt.now().isoformat()))
+            return None
+
+        holder = self._transaction(claim)
+        if holder is None:
+            self.held.add(key)
+            self.lost.discard(key)
+        return holder
+
+    def complete(self, uid, fp, video_id):
+        '''
+        Mark the row uploaded so no machine sends it again.
+        '''
+        key = (str(uid), fp)
+        self._transaction(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO leases VALUES '
+            '(?, ?, ?, ?, NULL, ?, NULL, ?)',
+            key + (self.owner, DONE, video_id, dt.now().isoformat())))
+        self.held.discard(key)
+
+    def release(self, uid, fp):
+        '''
+        Give the row back to the pool after it failed here.
+        '''
+        key = (str(uid), fp)
+        self._transaction(lambda conn: conn.execute(
+            'DELETE FROM leases WHERE uid = ? AND fingerprint = ? AND '
+            'owner = ? AND status = ?', key + (self.owner, CLAIMED)))
+        self.held.discard(key)
+
+    def requeue(self, uid, video_id):
+        '''
+        Give back a row marked done whose video YouTube couldn't process, so
+        it can be uploaded again, see processing.py.
+        '''
+        self._transaction(lambda conn: conn.execute(
+            'DELETE FROM leases WHERE uid = ? AND video_id = ? AND status = ?',
+            (str(uid), video_id, DONE)))
+
+    def session(self, uid, fp, local):
+        '''
+        The resumable session of a claimed row, shared through the lease.
+
+        Parameters
+        ----------
+        uid, fp
+            The row, as claimed.
+        local : ledger.UploadSession
+            The session this machine's ledger has for the row, a session left
+            by another machine is used when it has none.
+
+        Returns
+        -------
+        SharedSession
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT session FROM leases WHERE uid = ? '
+                                    'AND fingerprint = ?', (str(uid), fp))
+            row = row.fetchone()
+        shared = row[0] if row else None
+        if local.uri is None and shared:
+            print (f'UID: <{uid}> carrying on the upload of another machine.')
+            logging.info('%s -- UID: %s resuming session of another machine',
+                         dt.now(), uid)
+            # the client asks YouTube how far it got before sending anything,
+            # the insert was paid for by a project of the other machine
+            local.uri, local.offset, local.project = shared, 0, None
+        return SharedSession(self, uid, fp, local, shared)
+
+    def share(self, uid, fp, uri):
+        '''
+        Keep the session URI of a row this machine holds with its lease.
+        '''
+        self._transaction(lambda conn: conn.execute(
+            'UPDATE leases SET session = ? WHERE uid = ? AND fingerprint = ? '
+            'AND owner = ? AND status = ?',
+            (uri, str(uid), fp, self.owner, CLAIMED)))
+
+    def is_lost(self, uid, fp):
+        '''
+        Whether the lease on a row being uploaded here has gone to another
+        machine.
+        '''
+        return (str(uid), fp) in self.lost
+
+    def renew(self):
+        '''
+        Push back the expiry of every lease held, noting any that another
+        machine has taken over in the meantime.
+        '''
+        held = list(self.held)
+
+        def renew(conn):
+            conn.execute('UPDATE leases SET expires = ?, updated = ? WHERE '
+                         'owner = ? AND status = ?',
+                         (time.time() + self.ttl, dt.now().isoformat(),
+                          self.owner, CLAIMED))
+            mine = set(conn.execute('SELECT uid, fingerprint FROM leases '
+                                    'WHERE owner = ?', (self.owner,)))
+            return [key for key in held if key not in mine]
+
+        for key in self._transaction(renew):
+            if key in self.held:
+                print(f'UID: <{key[0]}> was claimed by another machine.')
+                logging.warning('%s -- UID: %s lease lost', dt.now(), key[0])
+                self.held.discard(key)
+                self.lost.add(key)
+
+    def _renew_forever(self):
+        while not self.stopped.wait(self.ttl / RENEWALS):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                # the share may be back before the leases run out
+                logging.warning('%s -- Leases not renewed: %r', dt.now(), e)
+
+    def start(self):
+        '''
+        Keep renewing the leases in a background thread.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._renew_forever,
+                                           daemon=True, name='lease-renewer')
+            self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for uid, fp in list(self.held):
+            self.release(uid, fp)
+        self.conn.close()
+
+
+def leased(leases, uid, fp, progress=None):
+    '''
+    Wrap the progress callback of an upload so it stops once another machine
+    has taken over the row's lease.
+    '''
+    def report(status):
+        if leases.is_lost(uid, fp):
+            raise UploadError('The lease was taken over by another machine',
+                              'lease_lost', DEFER)
+        if progress is not None:
+            progress(status)
+    return report
+
+
+class SharedSession:
+    '''
+    A `ledger.UploadSession` that also keeps its URI in the lease file, so
+    another machine can carry on with it. Only the URI is shared, the offset
+    is asked of YouTube when a session is resumed.
+    '''
+
+    def __init__(self, leases, uid, fp, local, shared=None):
+        self.leases = leases
+        self.uid = uid
+        self.fp = fp
+        self.local = local
+        self.shared = shared
+
+    @property
+    def uri(self):
+        return self.local.uri
+
+    @property
+    def offset(self):
+        return self.local.offset
+
+    @property
+    def project(self):
+        return self.local.project
+
+    @project.setter
+    def project(self, name):
+        self.local.project = name
+
+    def save(self, uri, offset):
+        self.local.save(uri, offset)
+        if uri != self.shared:
+            self.leases.share(self.uid, self.fp, uri)
+            self.shared = uri
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.leases.share(self.uid, self.fp, None)
+            self.shared = None
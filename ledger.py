@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Durable record of every upload attempt made by the table drivers. Each row is
+keyed by the UID from the table plus a fingerprint of the file found at its
+`Path`, so a rerun after quota exhaustion can skip what already went up and
+a file that was replaced on disk will be uploaded again.
+
+@author: rick
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime as dt
+
+# lives next to the .logging/ directory, the drivers are run from here
+LEDGER_FILE = '.upload_ledger.sqlite'
+
+# bytes read from the head and the tail of each file for the fingerprint
+SAMPLE_SIZE = 1024 * 1024
+
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+STARTED = 'started'
+# couldn't go this time for reasons that should clear up, see errors.py
+DEFERRED = 'deferred'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS uploads (
+        uid         TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        path        TEXT,
+        status      TEXT NOT NULL,
+        video_id    TEXT,
+        bytes_sent  INTEGER DEFAULT 0,
+        updated     TEXT,
+        PRIMARY KEY (uid, fingerprint)
+    )'''
+
+SESSION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        uid         TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        uri         TEXT NOT NULL,
+        offset      INTEGER DEFAULT 0,
+        updated     TEXT,
+        project     TEXT,
+        PRIMARY KEY (uid, fingerprint)
+    )'''
+
+# what YouTube made of each uploaded video, see processing.py
+PROCESSING_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS processing (
+        video_id    TEXT PRIMARY KEY,
+        uid         TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        status      TEXT NOT NULL,
+        reason      TEXT,
+        checks      INTEGER DEFAULT 0,
+        next_check  REAL,
+        updated     TEXT
+    )'''
+
+
+def fingerprint(path):
+    '''
+    Cheap content fingerprint of a video file. Hashes the size of the file
+    along with the first and last `SAMPLE_SIZE` bytes so that multi-GB videos
+    don't need to be read in full on every run.
+
+    Parameters
+    ----------
+    path : string
+        Absolute path to the video file.
+
+    Returns
+    -------
+    string
+        Hex digest identifying the content of the file.
+    '''
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE * 2:
+            f.seek(-SAMPLE_SIZE, os.SEEK_END)
+            h.update(f.read(SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+class Ledger:
+    '''
+    SQLite backed journal of uploads. The set of finished (uid, fingerprint)
+    pairs is read once when opened so that checking a row is a set lookup.
+    Writes are serialized so one ledger can be shared by upload threads.
+    '''
+
+    def __init__(self, fn=LEDGER_FILE):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        self.conn.execute(SESSION_SCHEMA)
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(sessions)')]
+        if 'project' not in columns:
+            # ledgers from before the project was kept with the session
+            self.conn.execute('ALTER TABLE sessions ADD COLUMN project TEXT')
+        self.conn.execute(PROCESSING_SCHEMA)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS uploads_fingerprint '
+                          'ON uploads (fingerprint)')
+        self.conn.commit()
+        cur = self.conn.execute('SELECT uid, fingerprint FROM uploads '
+                                'WHERE status = ?', (UPLOADED,))
+        self.done = set(cur.fetchall())
+
+    def is_done(self, uid, fp):
+        '''
+        Check whether this UID has already been uploaded with this content.
+
+        Parameters
+        ----------
+        uid : string
+            UID of the row in the table.
+        fp : string
+            Fingerprint of the file, see `fingerprint`.
+
+        Returns
+        -------
+        bool
+        '''
+        return (str(uid), fp) in self.done
+
+    def record(self, uid, fp, path, status, video_id=None, bytes_sent=0):
+        '''
+        Write the outcome of an upload attempt, replacing any earlier attempt
+        of the same UID and content.
+
+        Parameters
+        ----------
+        uid : string
+            UID of the row in the table.
+        fp : string
+            Fingerprint of the file, see `fingerprint`.
+        path : string
+            Location the file was uploaded from.
+        status : string
+            One of `UPLOADED`, `FAILED`, `DEFERRED` or `STARTED`.
+        video_id : string, optional
+            Id of the video returned from YouTube.
+        bytes_sent : int, optional
+            Number of bytes of the file that were sent.
+
+        Returns
+        -------
+        None.
+        '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO uploads VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?)',
+                              (str(uid), fp, path, status, video_id,
+                               bytes_sent, dt.now().isoformat()))
+            self.conn.commit()
+            if status == UPLOADED:
+                self.done.add((str(uid), fp))
+            else:
+                self.done.discard((str(uid), fp))
+
+    def video_id(self, uid):
+        '''
+        Look up the YouTube id of the most recent successful upload of a UID.
+
+        Parameters
+        ----------
+        uid : string
+            UID of the row in the table.
+
+        Returns
+        -------
+        string or None
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT video_id FROM uploads '
+                                    'WHERE uid = ? AND status = ? '
+                                    'ORDER BY updated DESC',
+                                    (str(uid), UPLOADED))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def uploaded(self):
+        '''
+        Every UID that has been uploaded and the id of its latest video.
+
+        Returns
+        -------
+        dict
+            uid -> video_id
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT uid, video_id FROM uploads '
+                                    'WHERE status = ? AND video_id IS NOT NULL '
+                                    'ORDER BY updated', (UPLOADED,))
+            return dict(cur.fetchall())
+
+    def find(self, fp):
+        '''
+        Look for a finished upload of the same content under any UID.
+
+        Parameters
+        ----------
+        fp : string
+            Fingerprint of the file, see `fingerprint`.
+
+        Returns
+        -------
+        tuple or None
+            (uid, video_id) of the earlier upload.
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT uid, video_id FROM uploads '
+                                    'WHERE fingerprint = ? AND status = ?',
+                                    (fp, UPLOADED))
+            return cur.fetchone()
+
+    def unchecked(self, now, settled):
+        '''
+        Uploaded videos whose processing hasn't finished and that are due
+        to be looked at again, never looked at ones first.
+
+        Parameters
+        ----------
+        now : float
+            Epoch seconds, videos with a check due by then are returned.
+        settled : iterable
+            Processing statuses that are final.
+
+        Returns
+        -------
+        list
+            (video_id, uid, fingerprint, checks) tuples.
+        '''
+        settled = tuple(settled)
+        with self.lock:
+            cur = self.conn.execute(
+                'SELECT u.video_id, u.uid, u.fingerprint, '
+                'COALESCE(p.checks, 0) FROM uploads u LEFT JOIN processing p '
+                'ON p.video_id = u.video_id WHERE u.status = ? '
+                'AND u.video_id IS NOT NULL AND (p.video_id IS NULL OR '
+                f'(p.status NOT IN ({",".join("?" * len(settled))}) '
+                'AND p.next_check <= ?)) ORDER BY p.next_check IS NOT NULL, '
+                'p.next_check', (UPLOADED,) + settled + (now,))
+            return cur.fetchall()
+
+    def next_check(self, settled):
+        '''
+        Epoch seconds of the soonest check due, None if nothing is waiting
+        on YouTube.
+        '''
+        settled = tuple(settled)
+        with self.lock:
+            cur = self.conn.execute(
+                'SELECT MIN(COALESCE(p.next_check, 0)) FROM uploads u '
+                'LEFT JOIN processing p ON p.video_id = u.video_id '
+                'WHERE u.status = ? AND u.video_id IS NOT NULL AND '
+                '(p.video_id IS NULL OR p.status NOT IN '
+                f'({",".join("?" * len(settled))}))', (UPLOADED,) + settled)
+            return cur.fetchone()[0]
+
+    def record_processing(self, video_id, uid, fp, status, reason=None,
+                          checks=0, next_check=None):
+        '''
+        Write what YouTube says about an uploaded video.
+        '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO processing VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?)',
+                              (video_id, str(uid), fp, status, reason, checks,
+                               next_check, dt.now().isoformat()))
+            self.conn.commit()
+
+    def processing_failures(self, uid, statuses):
+        '''
+        Number of the UID's videos that ended up in one of `statuses`.
+        '''
+        statuses = tuple(statuses)
+        with self.lock:
+            cur = self.conn.execute(
+                'SELECT COUNT(*) FROM processing WHERE uid = ? AND status IN '
+                f'({",".join("?" * len(statuses))})', (str(uid),) + statuses)
+            return cur.fetchone()[0]
+
+    def requeue(self, uid, fp):
+        '''
+        Put an uploaded row back in the queue, for a video YouTube couldn't
+        process.
+        '''
+        with self.lock:
+            self.conn.execute('UPDATE uploads SET status = ?, updated = ? '
+                              'WHERE uid = ? AND fingerprint = ?',
+                              (FAILED, dt.now().isoformat(), str(uid), fp))
+            self.conn.commit()
+            self.done.discard((str(uid), fp))
+
+    def session(self, uid, fp):
+        '''
+        The resumable upload session saved for this UID and content, if a
+        previous run was stopped partway through the file.
+
+        Parameters
+        ----------
+        uid : string
+            UID of the row in the table.
+        fp : string
+            Fingerprint of the file, see `fingerprint`.
+
+        Returns
+        -------
+        UploadSession
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT uri, offset, project FROM '
+                                    'sessions WHERE uid = ? AND '
+                                    'fingerprint = ?', (str(uid), fp))
+            row = cur.fetchone()
+        uri, offset, project = row if row else (None, 0, None)
+        return UploadSession(self, str(uid), fp, uri, offset, project)
+
+    def close(self):
+        self.conn.close()
+
+
+class UploadSession:
+    '''
+    Session URI and confirmed byte offset of a resumable upload, written back
+    to the ledger after every chunk so a crashed process continues mid-file.
+    `project` is the name of the project that opened the session and paid
+    for its insert, see projects.py.
+    '''
+
+    def __init__(self, ledger, uid, fp, uri=None, offset=0, project=None):
+        self.ledger = ledger
+        self.uid = uid
+        self.fp = fp
+        self.uri = uri
+        self.offset = offset
+        self.project = project
+
+    def save(self, uri, offset):
+        self.uri, self.offset = uri, offset
+        with self.ledger.lock:
+            self.ledger.conn.execute('INSERT OR REPLACE INTO sessions (uid, '
+                                     'fingerprint, uri, offset, updated, '
+                                     'project) VALUES (?, ?, ?, ?, ?, ?)',
+                                     (self.uid, self.fp, uri, offset,
+                                      dt.now().isoformat(), self.project))
+            self.ledger.conn.commit()
+
+    def clear(self):
+        self.uri, self.offset = None, 0
+        with self.ledger.lock:
+            self.ledger.conn.execute('DELETE FROM sessions WHERE uid = ? '
+                                     'AND fingerprint = ?', (self.uid, self.fp))
+            self.ledger.conn.commit()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Serves the chunks of an upload straight out of the page cache. The DVR files
+run to 500 MB and more, and with a few uploads going at once the copies of
+each chunk made on the way to the socket add up on a small machine.
+`MappedMedia` maps only the part of the file that the current chunk covers
+and hands the API client a `memoryview` of it, which the socket sends without
+copying. The window is unmapped once the next chunk is asked for, so an
+upload never holds much more than one chunk of its file in memory no matter
+how big the file is.
+
+@author: rick
+"""
+
+import os
+import mmap
+
+from apiclient.http import MediaUpload
+
+
+def map_range(fd, begin, end, willneed=False):
+    '''
+    Map bytes `begin` to `end` of an open file.
+
+    Parameters
+    ----------
+    fd : file
+        File opened for reading.
+    begin, end : int
+        Range of the file to map, `end` no further than the end of the file.
+    willneed : bool
+        Ask the kernel to start reading the range in now.
+
+    Returns
+    -------
+    memoryview
+        Unmapped once the last view of it is gone.
+    '''
+    if end <= begin:
+        return memoryview(b'')
+    # maps have to start on a multiple of the allocation granularity
+    start = begin - begin % mmap.ALLOCATIONGRANULARITY
+    window = mmap.mmap(fd.fileno(), end - start, access=mmap.ACCESS_READ,
+                       offset=start)
+    if willneed and hasattr(mmap, 'MADV_WILLNEED'):
+        window.madvise(mmap.MADV_WILLNEED)
+    return memoryview(window)[begin - start:end - start]
+
+
+class MappedMedia(MediaUpload):
+    '''
+    Resumable media that returns each chunk as a view of a memory map.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the file to upload.
+    chunksize : int
+        Bytes sent per request, and the most of the file mapped at once.
+    mimetype : string, optional
+        Sent as the content type of the upload.
+    '''
+
+    def __init__(self, filename, chunksize, mimetype='application/octet-stream'):
+        if chunksize <= 0:
+            raise ValueError('A mapped upload needs a chunk size.')
+        self._filename = filename
+        self._chunksize = chunksize
+        self._mimetype = mimetype
+        self._fd = open(filename, 'rb')
+        self._size = os.fstat(self._fd.fileno()).st_size
+        self._window = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        '''
+        View of `length` bytes from `begin`, shorter at the end of the file.
+        '''
+        # dropping the old view unmaps it as soon as the client has let go of
+        # it too
+        self._window = map_range(self._fd, begin,
+                                 min(begin + length, self._size))
+        return self._window
+
+    def close(self):
+        self._window = None
+        self._fd.close()
+
+    def to_json(self):
+        raise NotImplementedError('MappedMedia is not serializable.')
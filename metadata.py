@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Brings the videos already on the channel in line with the table. The title,
+description, tags, category and privacy of each uploaded row are rendered
+from the same templates the bulk uploader uses and compared against what
+YouTube has, and only the videos that differ are updated. Rows with a
+Playlist column are added to that playlist if they aren't in it yet. The
+changes go out in batch requests, up to 50 calls in each round trip, and any
+call in a batch that hits a retriable error is tried again on its own in the
+next batch rather than the whole batch being sent again.
+
+The ledger is shared by the scripts that upload, which each have their own
+templates and category, so the script the table was uploaded with has to be
+given or its videos would be retitled with the other one's.
+
+Run from the directory the uploads were made in, so the ledger is found:
+     $ python metadata.py table.xlsx --driver bulk_upload_video --dry-run
+     $ python metadata.py table.xlsx --driver process_table --batch-size 50
+
+@author: rick
+"""
+
+import os
+import sys
+import time
+import random
+import getpass
+import logging
+from datetime import datetime as dt, timezone
+from argparse import ArgumentParser
+
+from apiclient.errors import HttpError
+
+from upload_video import (get_authenticated_service, upload_options,
+                          UploadError, DEFAULT_OPTIONS, MAX_RETRIES,
+                          VALID_PRIVACY_STATUSES, YOUTUBE_SCOPES,
+                          YOUTUBE_MANAGE_SCOPE)
+from errors import classify, RETRY, RETRIABLE_EXCEPTIONS
+import bulk_upload_video
+import process_table
+from bulk_upload_video import TITLE, TEXT, read_template
+from templates import VideoText
+from table import read_table
+from ledger import Ledger
+from dedup import PAGE_SIZE, LIST_COST
+from quota import QuotaTracker, is_quota_error, DAILY_BUDGET
+
+# most calls sent in one batch request
+BATCH_SIZE = 50
+
+# quota cost of videos().update and playlistItems().insert
+UPDATE_COST = 50
+PLAYLIST_INSERT_COST = 50
+
+# script the table was uploaded with -> (title, description, category) it
+# uploaded the videos with
+DRIVERS = {
+    'bulk_upload_video': (bulk_upload_video.TITLE, bulk_upload_video.TEXT,
+                          DEFAULT_OPTIONS['category']),
+    'process_table': (process_table.TITLE, process_table.TEXT,
+                      process_table.CATEGORY),
+}
+
+# fields of each part that are sent back with an update, anything else in the
+# part is read-only
+SNIPPET_FIELDS = ('title', 'description', 'tags', 'categoryId',
+                  'defaultLanguage')
+STATUS_FIELDS = ('privacyStatus', 'embeddable', 'license',
+                 'publicStatsViewable', 'publishAt', 'selfDeclaredMadeForKids')
+
+
+class Call:
+    '''
+    One API call to be made in a batch.
+
+    Parameters
+    ----------
+    key : string
+        Names the call in the results and the log.
+    cost : int
+        Quota units the call is charged.
+    build : callable
+        Called with the service to make the HttpRequest, again for each try.
+    '''
+
+    def __init__(self, key, cost, build):
+        self.key = key
+        self.cost = cost
+        self.build = build
+
+    def __repr__(self):
+        return f'Call({self.key!r})'
+
+
+def published_at(video):
+    '''
+    Local time a video was published, as the uploader saw it.
+    '''
+    stamp = dt.strptime(video['snippet']['publishedAt'][:19],
+                        '%Y-%m-%dT%H:%M:%S')
+    return stamp.replace(tzinfo=timezone.utc).astimezone()
+
+
+def wanted_video(text, uid, options, when=None):
+    '''
+    The snippet and status a row's video should have.
+
+    Parameters
+    ----------
+    text : VideoText
+        Titles and descriptions rendered for the table.
+    uid : string
+        UID of the row.
+    options : Namespace
+        Category, keywords and privacy, see `upload_video.upload_options`.
+    when : datetime, optional
+        When the video was published, for the dates in the description.
+
+    Returns
+    -------
+    dict
+    '''
+    tags = options.keywords.split(',') if options.keywords else []
+    return dict(snippet=dict(title=text.title(uid),
+                             description=text.description(uid, when),
+                             tags=tags, categoryId=options.category),
+                status=dict(privacyStatus=options.privacyStatus))
+
+
+def fetch_videos(youtube, ids, quota=None):
+    '''
+    Current snippet and status of each video, 50 ids to a call.
+
+    Returns
+    -------
+    dict
+        video_id -> video resource, videos that are gone are left out.
+    '''
+    ids = list(ids)
+    videos = {}
+    for start in range(0, len(ids), PAGE_SIZE):
+        page = youtube.videos().list(part='snippet,status',
+                                     id=','.join(ids[start:start + PAGE_SIZE]),
+                                     maxResults=PAGE_SIZE).execute()
+        if quota is not None:
+            quota.charge(LIST_COST)
+        for video in page.get('items', []):
+            videos[video['id']] = video
+    return videos
+
+
+def playlist_videos(youtube, playlist_id, quota=None):
+    '''
+    Ids of every video in a playlist.
+    '''
+    ids = set()
+    token = None
+    while True:
+        page = youtube.playlistItems().list(part='snippet',
+                                            playlistId=playlist_id,
+                                            maxResults=PAGE_SIZE,
+                                            pageToken=token).execute()
+        if quota is not None:
+            quota.charge(LIST_COST)
+        ids.update(item['snippet']['resourceId']['videoId']
+                   for item in page.get('items', []))
+        token = page.get('nextPageToken')
+        if not token:
+            return ids
+
+
+def video_update(video, wanted):
+    '''
+    Body of the `videos().update` that gives `video` the wanted metadata.
+
+    Parameters
+    ----------
+    video : dict
+        Video resource as listed by `fetch_videos`.
+    wanted : dict
+        Result of `wanted_video`.
+
+    Returns
+    -------
+    dict or None
+        None when nothing needs to change.
+    '''
+    changed = False
+    body = dict(id=video['id'])
+    for part, fields in (('snippet', SNIPPET_FIELDS),
+                         ('status', STATUS_FIELDS)):
+        current = video.get(part, {})
+        new = {f: current[f] for f in fields if f in current}
+        for field, value in wanted[part].items():
+            if current.get(field, [] if field == 'tags' else None) != value:
+                changed = True
+            new[field] = value
+        body[part] = new
+    return body if changed else None
+
+
+def plan(tbl, ledger, youtube, options, quota=None, title=TITLE,
+         description=TEXT):
+    '''
+    Work out the calls that bring the uploaded rows in line with the table.
+    Rows whose title or description YouTube would turn down are left as
+    they are.
+
+    Returns
+    -------
+    list
+        `Call`s for the videos that need an update and the playlist items
+        that need to be added.
+    '''
+    text = VideoText(tbl, title, description)
+    uploaded = ledger.uploaded()
+    rows = {}
+    for uid in tbl.index:
+        if uid in text.problems:
+            print(f"UID: <{uid}> {text.problems[uid]}, skipping.")
+        elif str(uid) in uploaded:
+            rows[uploaded[str(uid)]] = uid
+    videos = fetch_videos(youtube, rows, quota)
+    calls = []
+    for video_id, uid in rows.items():
+        if video_id not in videos:
+            print(f"UID: <{uid}> video {video_id} isn't on the channel, "
+                  "skipping.")
+            continue
+        video = videos[video_id]
+        body = video_update(video, wanted_video(text, uid, options,
+                                                published_at(video)))
+        if body is not None:
+            calls.append(Call(f'update {video_id}', UPDATE_COST,
+                              lambda yt, body=body: yt.videos().update(
+                                  part='snippet,status', body=body)))
+    playlists = {}
+    for video_id, uid in rows.items():
+        playlist = tbl.Playlist[uid] if 'Playlist' in tbl else None
+        if isinstance(playlist, str) and playlist.strip():
+            playlists.setdefault(playlist.strip(), []).append(video_id)
+    for playlist, ids in playlists.items():
+        members = playlist_videos(youtube, playlist, quota)
+        for video_id in ids:
+            if video_id in members:
+                continue
+            body = dict(snippet=dict(playlistId=playlist, resourceId=dict(
+                kind='youtube#video', videoId=video_id)))
+            calls.append(Call(f'add {video_id} to {playlist}',
+                              PLAYLIST_INSERT_COST,
+                              lambda yt, body=body: yt.playlistItems().insert(
+                                  part='snippet', body=body)))
+    return calls
+
+
+def is_retriable(e):
+    '''
+    Whether a call that failed with `e` is worth making again, decided the
+    same way as for the uploads, see errors.classify.
+    '''
+    return classify(e, session=False).action == RETRY
+
+
+def execute_batches(youtube, calls, batch_size=BATCH_SIZE, quota=None):
+    '''
+    Make every call in batches of `batch_size`. Calls that fail with a
+    retriable error are gathered up and sent again in the next round with
+    the same exponential backoff as an upload, the rest keep their result.
+
+    Parameters
+    ----------
+    youtube : Resource
+        Authenticated YouTube service.
+    calls : list
+        `Call`s to make.
+    batch_size : int
+        Most calls in a single batch request.
+    quota : QuotaTracker, optional
+        Charged for every call, calls it can't afford today aren't made.
+
+    Returns
+    -------
+    results : dict
+        key -> the response, or the exception the call ended with. Calls left
+        for lack of quota aren't in it.
+    '''
+    results = {}
+    pending = list(calls)
+    retry = 0
+    while pending:
+        failed = []
+        out_of_quota = False
+        for start in range(0, len(pending), batch_size):
+            group = []
+            for call in pending[start:start + batch_size]:
+                if quota is not None and not quota.reserve(call.cost):
+                    out_of_quota = True
+                    break
+                group.append(call)
+            if group:
+                failed += _execute(youtube, group, results)
+            if any(isinstance(results.get(call.key), HttpError)
+                   and is_quota_error(results[call.key]) for call in group):
+                # YouTube's count wins over ours
+                if quota is not None:
+                    quota.exhaust()
+                out_of_quota = True
+            if out_of_quota:
+                left = len(pending) - start - len(group) + len(failed)
+                print(f'Quota used up, {left} changes left for the next run.')
+                logging.warning('Quota used up with %d changes left', left)
+                return results
+        if not failed:
+            break
+        retry += 1
+        if retry > MAX_RETRIES:
+            for call, e in failed:
+                results[call.key] = UploadError('No longer attempting to '
+                                                f'retry: {e}')
+            break
+        sleep_seconds = random.random() * 2 ** retry
+        print(f'{len(failed)} calls hit a retriable error, sleeping '
+              f'{sleep_seconds:f} seconds and then retrying...')
+        time.sleep(sleep_seconds)
+        pending = [call for call, _ in failed]
+    return results
+
+
+def _execute(youtube, group, results):
+    '''
+    Send one batch, returning the (call, error) of each call to try again.
+    '''
+    failed = []
+
+    def callback(request_id, response, exception):
+        call = group[int(request_id)]
+        if exception is not None and is_retriable(exception):
+            failed.append((call, exception))
+        else:
+            results[call.key] = exception if exception is not None \
+                else response
+
+    batch = youtube.new_batch_http_request(callback=callback)
+    for i, call in enumerate(group):
+        batch.add(call.build(youtube), request_id=str(i))
+    try:
+        batch.execute()
+    except (HttpError,) + RETRIABLE_EXCEPTIONS as e:
+        # the batch request itself failed, e.g. a 503 from the batch
+        # endpoint, every call without an answer goes again
+        if not is_retriable(e):
+            raise
+        done = {call for call, _ in failed}
+        failed += [(call, e) for call in group
+                   if call.key not in results and call not in done]
+    return failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='metadata.py')
+    parser.add_argument('file', help='path/to/xl/or/csv/table.xlsx')
+    parser.add_argument('--driver', choices=DRIVERS, required=True,
+                        help='script the table was uploaded with, its '
+                        'templates and category are used')
+    parser.add_argument('--category', default=None,
+                        help="numeric video category, the driver's by "
+                        'default, see category_list.py')
+    parser.add_argument('--keywords', default=DEFAULT_OPTIONS['keywords'],
+                        help='tags, comma separated')
+    parser.add_argument('--privacyStatus', choices=VALID_PRIVACY_STATUSES,
+                        default=DEFAULT_OPTIONS['privacyStatus'])
+    parser.add_argument('--title-template', default=None,
+                        help="title of each video, {fields} are columns of "
+                        "the table, the driver's by default")
+    parser.add_argument('--description-template', default=None,
+                        help='file holding the template of the description, '
+                        "the driver's by default")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='calls sent in each batch request')
+    parser.add_argument('--quota', type=int, default=DAILY_BUDGET,
+                        help='daily quota units available to the project')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the changes but don't make them")
+    args = parser.parse_args()
+    if not os.path.exists('./.logging'):
+        os.mkdir('./.logging')
+    fn = f".logging/metadata_{dt.now().strftime('%s')}.log"
+    logging.basicConfig(level=logging.INFO, filename=fn,
+                        format='%(levelname)s: %(message)s')
+    logging.info('DATE: %s', dt.now())
+    logging.info('This script was run by: %s', getpass.getuser())
+    logging.info('FILE_ARG: %s', args.file)
+
+    title, description, category = DRIVERS[args.driver]
+    logging.info('DRIVER: %s', args.driver)
+    options = upload_options(category=args.category or category,
+                             keywords=args.keywords,
+                             privacyStatus=args.privacyStatus)
+    youtube = get_authenticated_service(
+        options, scopes=YOUTUBE_SCOPES + [YOUTUBE_MANAGE_SCOPE])
+    quota = QuotaTracker(args.quota)
+    ledger = Ledger()
+    calls = plan(read_table(args.file), ledger, youtube, options, quota,
+                 args.title_template or title,
+                 read_template(args.description_template, description))
+    ledger.close()
+    print(f'{len(calls)} changes to make.')
+    for call in calls:
+        print(f'\t{call.key}')
+    if args.dry_run or not calls:
+        sys.exit()
+    results = execute_batches(youtube, calls, args.batch_size, quota)
+    failed = 0
+    for key, result in results.items():
+        if isinstance(result, Exception):
+            failed += 1
+            print(f'{key} failed: {result}')
+            logging.error('%s failed: %s', key, result)
+        else:
+            logging.info('%s done', key)
+    print(f'{len(results) - failed} changes made, {failed} failed.')
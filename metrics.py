@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of every upload in a run: bytes per second, time for each chunk,
+retries and the seconds spent backing off, time spent waiting on quota and
+the number of API calls made. Each finished upload is written as one JSON line
+next to the run's log file, and a summary of the run with the p50/p95
+throughput and the time left for the rest of the queue is printed at the end.
+While the run goes, `MetricsLog.snapshot` gives the queue, the uploads going
+and the totals so far, see status.py.
+
+@author: rick
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import deque, Counter
+from datetime import datetime as dt
+
+# chunks the current rate of an upload is worked out over
+RECENT_CHUNKS = 5
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of a list of numbers, None if it's empty.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def human_time(seconds):
+    if seconds >= 86400:
+        return f'{seconds / 86400:.1f} days'
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+
+class UploadMetrics:
+    '''
+    Counters for a single upload, passed down into `resumable_upload`.
+    '''
+
+    def __init__(self, uid, path=None, size=None):
+        self.uid = uid
+        self.path = path
+        self.size = size
+        self.started = time.time()
+        self.finished = None
+        self.bytes_sent = 0
+        self.chunks = []
+        self.recent = deque(maxlen=RECENT_CHUNKS)
+        self.retries = 0
+        self.backoff = 0.0
+        self.quota_wait = 0.0
+        # blocked until the quota is reset right now
+        self.waiting = False
+        self.api_calls = 0
+        self.status = None
+        self.error = None
+        self.project = None
+
+    def chunk(self, nbytes, seconds):
+        self.api_calls += 1
+        self.bytes_sent += max(nbytes, 0)
+        self.chunks.append(round(seconds, 3))
+        self.recent.append((max(nbytes, 0), seconds))
+
+    def retry(self, sleep_seconds):
+        self.api_calls += 1
+        self.retries += 1
+        self.backoff += sleep_seconds
+
+    def call(self, n=1):
+        self.api_calls += n
+
+    def waited(self, seconds):
+        self.quota_wait += seconds
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        '''
+        Bytes per second while actually sending, leaving out time blocked on
+        the quota.
+        '''
+        sending = self.elapsed - self.quota_wait
+        return self.bytes_sent / sending if sending > 0 else 0.0
+
+    @property
+    def current_rate(self):
+        '''
+        Bytes per second over the last few chunks.
+        '''
+        recent = list(self.recent)
+        seconds = sum(s for _, s in recent)
+        return sum(n for n, _ in recent) / seconds if seconds > 0 else 0.0
+
+    def as_dict(self):
+        return dict(uid=str(self.uid), path=self.path, size=self.size,
+                    status=self.status, error=self.error,
+                    project=self.project,
+                    started=dt.fromtimestamp(self.started).isoformat(),
+                    seconds=round(self.elapsed, 3),
+                    bytes_sent=self.bytes_sent,
+                    bytes_per_second=round(self.rate, 1),
+                    chunk_seconds=self.chunks, retries=self.retries,
+                    backoff_seconds=round(self.backoff, 3),
+                    quota_wait_seconds=round(self.quota_wait, 3),
+                    api_calls=self.api_calls)
+
+
+class MetricsLog:
+    '''
+    Collects the metrics of every upload in a run and appends them to `fn`
+    as JSON lines.
+
+    Parameters
+    ----------
+    fn : string
+        Path of the .jsonl file written to.
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.uploads = []
+        # UID -> UploadMetrics of the uploads going now
+        self.running = {}
+        self.queued = 0
+        self.done = 0
+        self.rows_queued = 0
+
+    def queue(self, nbytes):
+        '''
+        Count a file of `nbytes` towards what's left to send in the run.
+        '''
+        with self.lock:
+            self.queued += nbytes or 0
+            self.rows_queued += 1
+
+    def skip(self, nbytes):
+        '''
+        Take a queued file back out because it won't be uploaded after all.
+        '''
+        with self.lock:
+            self.queued -= nbytes or 0
+            self.rows_queued -= 1
+
+    def start(self, uid, path=None, size=None):
+        metrics = UploadMetrics(uid, path, size)
+        with self.lock:
+            self.running[uid] = metrics
+        return metrics
+
+    def finish(self, metrics, status):
+        metrics.finished = time.time()
+        metrics.status = status
+        with self.lock:
+            self.running.pop(metrics.uid, None)
+            self.uploads.append(metrics)
+            self.done += metrics.size or 0
+            with open(self.fn, 'a') as f:
+                f.write(json.dumps(metrics.as_dict()) + '\n')
+        eta = self.eta()
+        if eta is not None:
+            print(f'UID: <{metrics.uid}> {status} at '
+                  f'{metrics.rate / 1048576:.2f} MB/s, about '
+                  f'{human_time(eta)} left in the queue.')
+
+    @property
+    def throughput(self):
+        '''
+        Bytes per second over the whole run so far, counting every upload
+        running at the same time.
+        '''
+        elapsed = time.time() - self.started
+        return self.sent() / elapsed if elapsed > 0 else 0.0
+
+    def sent(self):
+        '''
+        Bytes sent in the run, including what the running uploads have sent.
+        '''
+        with self.lock:
+            uploads = self.uploads + list(self.running.values())
+        return sum(m.bytes_sent for m in uploads)
+
+    def eta(self):
+        '''
+        Seconds left to send what is still in the queue at the current rate.
+        '''
+        rate = self.throughput
+        if not rate:
+            return None
+        with self.lock:
+            going = sum(m.bytes_sent for m in self.running.values())
+        return max(self.queued - self.done - going, 0) / rate
+
+    def snapshot(self):
+        '''
+        Where the run is up to, for the status endpoint.
+
+        Returns
+        -------
+        dict
+            The queue, the uploads going now and the totals of the run.
+        '''
+        with self.lock:
+            finished = list(self.uploads)
+            running = list(self.running.values())
+            queued, done, rows = self.queued, self.done, self.rows_queued
+        uploads = finished + running
+        return dict(
+            started=dt.fromtimestamp(self.started).isoformat(),
+            queue=dict(rows=max(rows - len(uploads), 0),
+                       bytes=max(queued - done
+                                 - sum(m.bytes_sent for m in running), 0)),
+            in_flight=[dict(uid=str(m.uid), path=m.path, size=m.size,
+                            project=m.project, bytes_sent=m.bytes_sent,
+                            bytes_per_second=round(m.current_rate, 1),
+                            retries=m.retries,
+                            waiting_for_quota=m.waiting,
+                            seconds=round(m.elapsed, 3))
+                       for m in running],
+            finished=dict(Counter(m.status for m in finished)),
+            bytes_sent=sum(m.bytes_sent for m in uploads),
+            bytes_per_second=round(self.throughput, 1),
+            retries=sum(m.retries for m in uploads),
+            api_calls=sum(m.api_calls for m in uploads),
+            eta_seconds=self.eta())
+
+    def summary(self):
+        '''
+        Print and log the totals for the run.
+        '''
+        rates = [m.rate for m in self.uploads if m.bytes_sent]
+        p50, p95 = percentile(rates, 50), percentile(rates, 95)
+        lines = [f'Uploads: {len(self.uploads)}, '
+                 f'sent {sum(m.bytes_sent for m in self.uploads) / 1048576:.1f}'
+                 f' MB in {human_time(time.time() - self.started)}',
+                 f'Retries: {sum(m.retries for m in self.uploads)} '
+                 f'({sum(m.backoff for m in self.uploads):.1f}s backing off), '
+                 f'quota wait: '
+                 f'{human_time(sum(m.quota_wait for m in self.uploads))}, '
+                 f'API calls: {sum(m.api_calls for m in self.uploads)}']
+        if p50 is not None:
+            lines.append(f'Throughput p50: {p50 / 1048576:.2f} MB/s, '
+                         f'p95: {p95 / 1048576:.2f} MB/s')
+        eta = self.eta()
+        if eta is not None and self.queued > self.done:
+            lines.append(f'Estimated time for the rest of the queue: '
+                         f'{human_time(eta)}')
+        for line in lines:
+            print(line)
+            logging.info(line)
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps a copy of what is on the channel in a local SQLite file, so questions
+like what's already up, which videos are still processing or which are
+public are answered from disk instead of with more list calls. The uploads,
+the playlists and their items and the video categories are mirrored.
+
+Syncing only fetches what changed. YouTube lists a channel's uploads newest
+first, so paging through them stops at the first page that has nothing new
+on it, and the details of only the new videos are fetched along with those
+of videos that were still being processed last time. Every page is asked for
+with the ETag it had last time, and a page that hasn't changed comes back as
+a 304 with no body, the same goes for the playlists and the categories.
+`--full` walks every page again and drops videos that are no longer on the
+channel.
+
+Example:
+     $ python mirror.py
+     $ python mirror.py --full
+
+@author: rick
+"""
+
+import json
+import sqlite3
+import logging
+from datetime import datetime as dt
+from argparse import ArgumentParser
+
+from apiclient.errors import HttpError
+
+from upload_video import get_authenticated_service, upload_options
+from dedup import uploads_playlist, PAGE_SIZE, LIST_COST
+
+MIRROR_FILE = '.channel_mirror.sqlite'
+
+# parts of each video kept in the mirror
+VIDEO_PARTS = 'snippet,status,fileDetails,processingDetails'
+
+# processing states a video doesn't leave once it's in them
+SETTLED = ('succeeded', 'failed', 'terminated')
+
+# region the category names are listed for
+REGION = 'US'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS videos (
+        id                 TEXT PRIMARY KEY,
+        title              TEXT,
+        description        TEXT,
+        published_at       TEXT,
+        privacy_status     TEXT,
+        upload_status      TEXT,
+        processing_status  TEXT,
+        file_name          TEXT,
+        file_size          INTEGER,
+        etag               TEXT,
+        synced             TEXT
+    );
+    CREATE INDEX IF NOT EXISTS videos_title ON videos (title);
+    CREATE INDEX IF NOT EXISTS videos_file ON videos (file_name, file_size);
+    CREATE TABLE IF NOT EXISTS playlists (
+        id          TEXT PRIMARY KEY,
+        title       TEXT,
+        item_count  INTEGER,
+        etag        TEXT,
+        synced      TEXT
+    );
+    CREATE TABLE IF NOT EXISTS playlist_items (
+        playlist_id  TEXT,
+        video_id     TEXT,
+        position     INTEGER,
+        PRIMARY KEY (playlist_id, video_id)
+    );
+    CREATE INDEX IF NOT EXISTS playlist_items_video
+        ON playlist_items (video_id);
+    CREATE TABLE IF NOT EXISTS categories (
+        id          TEXT PRIMARY KEY,
+        title       TEXT,
+        assignable  INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS pages (
+        resource    TEXT,
+        token       TEXT,
+        etag        TEXT,
+        ids         TEXT,
+        next_token  TEXT,
+        PRIMARY KEY (resource, token)
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key    TEXT PRIMARY KEY,
+        value  TEXT
+    )'''
+
+
+def conditional(request, etag=None):
+    '''
+    Execute a list request, sent with the ETag of the last response.
+
+    Returns
+    -------
+    dict or None
+        None when YouTube says nothing has changed since `etag`.
+    '''
+    if etag:
+        request.headers['If-None-Match'] = etag
+    try:
+        return request.execute()
+    except HttpError as e:
+        if e.resp.status == 304:
+            return None
+        raise
+
+
+class Mirror:
+    '''
+    The local copy of the channel.
+
+    Parameters
+    ----------
+    fn : string
+        SQLite file the mirror is kept in.
+    '''
+
+    def __init__(self, fn=MIRROR_FILE):
+        self.conn = sqlite3.connect(fn)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.calls = 0
+        self.unchanged = 0
+
+    def _get(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+
+    def _page(self, resource, token):
+        return self.conn.execute('SELECT etag, ids, next_token FROM pages '
+                                 'WHERE resource = ? AND token = ?',
+                                 (resource, token or '')).fetchone()
+
+    def _list(self, request, resource=None, token=None):
+        '''
+        Make one list call, conditional on the page saved for `resource`.
+
+        Returns
+        -------
+        (response, saved)
+            `response` is None if the saved page is still current.
+        '''
+        saved = self._page(resource, token) if resource else None
+        response = conditional(request, saved[0] if saved else None)
+        self.calls += 1
+        if response is None:
+            self.unchanged += 1
+        return response, saved
+
+    def _save_page(self, resource, token, response, ids):
+        self.conn.execute('INSERT OR REPLACE INTO pages VALUES '
+                          '(?, ?, ?, ?, ?)',
+                          (resource, token or '', response.get('etag'),
+                           json.dumps(ids), response.get('nextPageToken')))
+
+    def known(self, video_id):
+        return self.conn.execute('SELECT 1 FROM videos WHERE id = ?',
+                                 (video_id,)).fetchone() is not None
+
+    def sync(self, youtube, quota=None, full=False, playlists=True,
+             categories=True):
+        '''
+        Bring the mirror up to date with the channel.
+
+        Parameters
+        ----------
+        youtube : Resource
+            Authenticated YouTube service of the channel's owner.
+        quota : QuotaTracker, optional
+            Charged for every list call made.
+        full : bool
+            Look at every page of uploads, not just the new ones.
+        playlists, categories : bool
+            Sync these too.
+
+        Returns
+        -------
+        int
+            Number of list calls made.
+        '''
+        self.calls = self.unchanged = 0
+        self.sync_uploads(youtube, full)
+        if playlists:
+            self.sync_playlists(youtube)
+        if categories:
+            self.sync_categories(youtube)
+        self._set('synced', dt.now().isoformat())
+        self.conn.commit()
+        if quota is not None:
+            quota.charge(self.calls * LIST_COST)
+        logging.info('%s -- Mirror synced with %d calls, %d unchanged',
+                     dt.now(), self.calls, self.unchanged)
+        return self.calls
+
+    def sync_uploads(self, youtube, full=False):
+        '''
+        Page through the uploads until a page has nothing new on it, then
+        fetch the videos that are new or were still being processed.
+        '''
+        playlist = self._get('uploads')
+        if playlist is None:
+            playlist = uploads_playlist(youtube)
+            self.calls += 1
+            if playlist is None:
+                return
+            self._set('uploads', playlist)
+        listed = []
+        new = []
+        token = None
+        while True:
+            request = youtube.playlistItems().list(part='contentDetails',
+                                                   playlistId=playlist,
+                                                   maxResults=PAGE_SIZE,
+                                                   pageToken=token)
+            response, saved = self._list(request, 'uploads', token)
+            if response is None:
+                ids, next_token = json.loads(saved[1]), saved[2]
+            else:
+                ids = [item['contentDetails']['videoId']
+                       for item in response.get('items', [])]
+                next_token = response.get('nextPageToken')
+                self._save_page('uploads', token, response, ids)
+            listed.extend(ids)
+            fresh = [i for i in ids if not self.known(i)]
+            new.extend(fresh)
+            # uploads are newest first, past a page that is unchanged or has
+            # nothing new on it everything is already in the mirror
+            if not next_token or (not full and (response is None
+                                                or not fresh)):
+                break
+            token = next_token
+        if full:
+            gone = set(self.video_ids()) - set(listed)
+            self.conn.executemany('DELETE FROM videos WHERE id = ?',
+                                  [(i,) for i in gone])
+            if gone:
+                logging.info('%d videos are no longer on the channel',
+                             len(gone))
+        self.fetch_videos(youtube, new + [i for i in self.unsettled()
+                                          if i not in set(new)])
+
+    def fetch_videos(self, youtube, ids):
+        '''
+        Fetch and store the videos with these ids, 50 to a call.
+        '''
+        for start in range(0, len(ids), PAGE_SIZE):
+            chunk = ids[start:start + PAGE_SIZE]
+            request = youtube.videos().list(part=VIDEO_PARTS,
+                                            id=','.join(chunk),
+                                            maxResults=PAGE_SIZE)
+            response, _ = self._list(request)
+            for video in response.get('items', []):
+                self.store_video(video)
+
+    def store_video(self, video):
+        snippet = video.get('snippet', {})
+        status = video.get('status', {})
+        details = video.get('fileDetails', {})
+        processing = video.get('processingDetails', {})
+        size = details.get('fileSize')
+        self.conn.execute('INSERT OR REPLACE INTO videos VALUES '
+                          '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (video['id'], snippet.get('title'),
+                           snippet.get('description'),
+                           snippet.get('publishedAt'),
+                           status.get('privacyStatus'),
+                           status.get('uploadStatus'),
+                           processing.get('processingStatus'),
+                           details.get('fileName'),
+                           int(size) if size else None, video.get('etag'),
+                           dt.now().isoformat()))
+
+    def sync_playlists(self, youtube):
+        '''
+        Fetch the channel's playlists, and the items of the ones that
+        changed.
+        '''
+        token = None
+        listed = []
+        while True:
+            request = youtube.playlists().list(part='snippet,contentDetails',
+                                               mine=True, maxResults=PAGE_SIZE,
+                                               pageToken=token)
+            response, saved = self._list(request, 'playlists', token)
+            if response is None:
+                ids, token = json.loads(saved[1]), saved[2]
+                listed.extend(ids)
+            else:
+                items = response.get('items', [])
+                ids = [item['id'] for item in items]
+                listed.extend(ids)
+                self._save_page('playlists', token, response, ids)
+                for item in items:
+                    self._sync_playlist(youtube, item)
+                token = response.get('nextPageToken')
+            if not token:
+                break
+        gone = set(r[0] for r in self.conn.execute('SELECT id FROM playlists'))
+        gone -= set(listed)
+        for playlist in gone:
+            self.conn.execute('DELETE FROM playlists WHERE id = ?', (playlist,))
+            self.conn.execute('DELETE FROM playlist_items WHERE '
+                              'playlist_id = ?', (playlist,))
+
+    def _sync_playlist(self, youtube, item):
+        row = self.conn.execute('SELECT etag FROM playlists WHERE id = ?',
+                                (item['id'],)).fetchone()
+        if row and row[0] == item.get('etag'):
+            return
+        videos = []
+        token = None
+        while True:
+            request = youtube.playlistItems().list(part='contentDetails',
+                                                   playlistId=item['id'],
+                                                   maxResults=PAGE_SIZE,
+                                                   pageToken=token)
+            response, _ = self._list(request)
+            videos.extend(i['contentDetails']['videoId']
+                          for i in response.get('items', []))
+            token = response.get('nextPageToken')
+            if not token:
+                break
+        self.conn.execute('DELETE FROM playlist_items WHERE playlist_id = ?',
+                          (item['id'],))
+        self.conn.executemany('INSERT OR REPLACE INTO playlist_items VALUES '
+                              '(?, ?, ?)', [(item['id'], video, position)
+                                            for position, video
+                                            in enumerate(videos)])
+        self.conn.execute('INSERT OR REPLACE INTO playlists VALUES '
+                          '(?, ?, ?, ?, ?)',
+                          (item['id'], item['snippet'].get('title'),
+                           item.get('contentDetails', {}).get('itemCount'),
+                           item.get('etag'), dt.now().isoformat()))
+
+    def sync_categories(self, youtube, region=REGION):
+        request = youtube.videoCategories().list(part='snippet',
+                                                 regionCode=region)
+        response, _ = self._list(request, 'categories', region)
+        if response is None:
+            return
+        self._save_page('categories', region, response,
+                        [item['id'] for item in response.get('items', [])])
+        self.conn.execute('DELETE FROM categories')
+        self.conn.executemany('INSERT INTO categories VALUES (?, ?, ?)',
+                              [(item['id'], item['snippet'].get('title'),
+                                int(item['snippet'].get('assignable', False)))
+                               for item in response.get('items', [])])
+
+    def video_ids(self):
+        return [r[0] for r in self.conn.execute('SELECT id FROM videos')]
+
+    def unsettled(self):
+        '''
+        Ids of videos that were still being uploaded or processed.
+        '''
+        cur = self.conn.execute('SELECT id FROM videos WHERE processing_status '
+                                'IS NULL OR processing_status NOT IN '
+                                f'({",".join("?" * len(SETTLED))})', SETTLED)
+        return [r[0] for r in cur]
+
+    def videos(self):
+        '''
+        (id, title, file_name, file_size) of every video on the channel,
+        leaving out the ones YouTube failed, rejected or couldn't process,
+        like processing.video_state.
+        '''
+        return self.conn.execute('SELECT id, title, file_name, file_size '
+                                 'FROM videos WHERE (upload_status IS NULL OR '
+                                 "upload_status NOT IN ('failed', 'rejected', "
+                                 "'deleted')) AND (processing_status IS NULL "
+                                 "OR processing_status NOT IN ('failed', "
+                                 "'terminated'))").fetchall()
+
+    def categories(self):
+        return self.conn.execute('SELECT id, title, assignable FROM categories '
+                                 'ORDER BY CAST(id AS INTEGER)').fetchall()
+
+    def summary(self):
+        '''
+        Lines describing what's on the channel.
+        '''
+        total = self.conn.execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+        lines = [f'{total} videos, last synced {self._get("synced")}']
+        for column in ('privacy_status', 'processing_status'):
+            counts = self.conn.execute(f'SELECT {column}, COUNT(*) FROM videos '
+                                       f'GROUP BY {column} ORDER BY 2 DESC')
+            lines.append(column.replace('_', ' ') + ': ' + ', '.join(
+                f'{value or "unknown"} {n}' for value, n in counts))
+        playlists = self.conn.execute('SELECT COUNT(*) FROM playlists')
+        categories = self.conn.execute('SELECT COUNT(*) FROM categories')
+        lines.append(f'{playlists.fetchone()[0]} playlists, '
+                     f'{categories.fetchone()[0]} categories')
+        return lines
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='mirror.py')
+    parser.add_argument('--full', action='store_true',
+                        help='look at every page of uploads and drop videos '
+                        "that aren't on the channel any more")
+    parser.add_argument('--no-playlists', action='store_true',
+                        help="don't sync the playlists")
+    args = parser.parse_args()
+    mirror = Mirror()
+    youtube = get_authenticated_service(upload_options())
+    calls = mirror.sync(youtube, full=args.full,
+                        playlists=not args.no_playlists)
+    print(f'Synced with {calls} calls, {mirror.unchanged} of them unchanged.')
+    for line in mirror.summary():
+        print(line)
+    mirror.close()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Overlaps the disk and CPU work of an upload with sending it. A plain
+`MediaFileUpload` reads each chunk from the file while the request is being
+sent, so the connection sits idle while the disk catches up and the file is
+hashed again separately. `PipelineMedia` hands chunks to the API client from a
+small queue instead, which an asyncio reader keeps filled ahead of the sender,
+while a hashing stage runs over the same blocks. The queues between stages are
+bounded, so a slow connection holds the reader back, and the blocks are views
+of the file mapped into memory (see media.py) so only the few blocks in the
+queues are held at a time.
+
+The sending side is still `upload_video.resumable_upload`, which calls
+`getbytes` through `next_chunk()` as usual, so retries behave exactly as they
+do without the pipeline. When the server asks for bytes from before what is
+queued, after an error or on a resumed session, the reader is restarted from
+that offset.
+
+@author: rick
+"""
+
+import os
+import asyncio
+import hashlib
+import threading
+
+from apiclient.http import MediaUpload
+
+from media import map_range
+
+# blocks read ahead of the one being sent
+DEPTH = 2
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    '''
+    The event loop every pipeline runs on, started in a daemon thread the
+    first time it's needed and shared by all upload threads.
+    '''
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, daemon=True,
+                                      name='upload-pipeline')
+            thread.start()
+        return _loop
+
+
+class PipelineMedia(MediaUpload):
+    '''
+    Resumable media that reads ahead of the upload and hashes as it goes.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the file to upload.
+    chunksize : int
+        Bytes sent per request, also the size of the blocks read.
+    mimetype : string, optional
+        Sent as the content type of the upload.
+    depth : int
+        Most blocks read ahead of the one being sent.
+    hash_file : bool
+        Compute the sha256 of the file from the blocks as they're read.
+    '''
+
+    def __init__(self, filename, chunksize, mimetype='application/octet-stream',
+                 depth=DEPTH, hash_file=True):
+        if chunksize <= 0:
+            raise ValueError('The upload pipeline needs a chunk size.')
+        self._filename = filename
+        self._chunksize = chunksize
+        self._mimetype = mimetype
+        self._fd = open(filename, 'rb')
+        self._size = os.fstat(self._fd.fileno()).st_size
+        self.depth = depth
+        self.loop = event_loop()
+        self._sha = hashlib.sha256() if hash_file else None
+        self._hashed = 0
+        self._current = None
+        self._reader = None
+        self._hasher = None
+        self._blocks = None
+        self._hash_queue = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    @property
+    def sha256(self):
+        '''
+        Hex digest of the file, None unless every byte went through the
+        hashing stage in order.
+        '''
+        if self._sha is None or self._hashed != self._size:
+            return None
+        return self._sha.hexdigest()
+
+    def _read(self, offset):
+        # a block is a view of the file mapped in and read ahead by the
+        # kernel, so the blocks in the queues aren't copies on the heap
+        return map_range(self._fd, offset,
+                         min(offset + self._chunksize, self._size), True)
+
+    def _hash(self, offset, data):
+        # blocks read again after a restart are only counted past what has
+        # been hashed already
+        if offset <= self._hashed < offset + len(data):
+            self._sha.update(data[self._hashed - offset:])
+            self._hashed = offset + len(data)
+
+    async def _read_from(self, offset):
+        while True:
+            data = await self.loop.run_in_executor(None, self._read, offset)
+            if self._hash_queue is not None and data:
+                await self._hash_queue.put((offset, data))
+            await self._blocks.put((offset, data))
+            if not data:
+                return
+            offset += len(data)
+
+    async def _hash_blocks(self):
+        while True:
+            offset, data = await self._hash_queue.get()
+            await self.loop.run_in_executor(None, self._hash, offset, data)
+            self._hash_queue.task_done()
+
+    async def _restart(self, offset):
+        if self._reader is not None:
+            self._reader.cancel()
+        self._blocks = asyncio.Queue(self.depth)
+        if self._sha is not None and self._hash_queue is None:
+            self._hash_queue = asyncio.Queue(self.depth)
+            self._hasher = self.loop.create_task(self._hash_blocks())
+        self._current = None
+        self._reader = self.loop.create_task(self._read_from(offset))
+
+    async def _take(self, begin, length):
+        if self._reader is None or (self._current is not None
+                                    and begin < self._current[0]):
+            await self._restart(begin)
+        pieces = []
+        position = begin
+        end = min(begin + length, self._size)
+        while position < end:
+            if self._current is None or \
+                    position >= self._current[0] + len(self._current[1]):
+                self._current = await self._blocks.get()
+                if not self._current[1]:
+                    break
+            offset, data = self._current
+            if offset > position:
+                await self._restart(position)
+                continue
+            piece = data[position - offset:end - offset]
+            pieces.append(piece)
+            position += len(piece)
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def getbytes(self, begin, length):
+        '''
+        Called by the API client from the sending thread, blocks until the
+        reader has the bytes.
+        '''
+        future = asyncio.run_coroutine_threadsafe(self._take(begin, length),
+                                                  self.loop)
+        return future.result()
+
+    async def _stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._hasher is not None:
+            # finish hashing the blocks that were already read
+            await self._hash_queue.join()
+            self._hasher.cancel()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self._fd.close()
+
+    def to_json(self):
+        raise NotImplementedError('PipelineMedia is not serializable.')
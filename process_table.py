@@ -19,10 +19,19 @@ import sys
 import getpass
 import logging
 import argparse
-import pandas as pd
-from subprocess import call
 from datetime import datetime as dt
 
+from upload_video import (get_authenticated_service, upload_options,
+                          upload_row, CHUNKSIZE)
+from table import read_table
+from templates import render_text
+from validate import validate_files
+from dedup import channel_index, table_duplicates, find_duplicate
+from mirror import Mirror
+from metrics import MetricsLog
+from ledger import Ledger, fingerprint, STARTED, FAILED, UPLOADED
+from leases import Leases, leased, DONE
+
 DESCRIPTION = '''
     Reads in a table that describe each video recorded that will be uploaded
     to YouTube. Currently, there is no standard on which columns are needed
@@ -33,40 +42,38 @@ DESCRIPTION = '''
 EPILOG = '''Example:
      $ python process_table.py /home/rick/projects/youtube_upload/table.xlsx'''
 
-# text in the caption, args to format are drawn in from the table
-TEXT = (f"Published on { dt.now().strftime('%B %d, %Y') }\n\n"
+# templates of the title and the text in the caption, fields are filled from
+# the columns of the table, see templates.py for the others
+TITLE = '{StudyName} -- {UID}'
+# category the videos go up in, 22 is People & Blogs
+CATEGORY = '22'
+TEXT = ("Published on {published}\n\n"
 "NOTE: No captions are provided because all sound is underwater or background"
-"noise.\n\n\nThis video was collected in {0} as part of the EPA Environmental "
+"noise.\n\n\nThis video was collected in {year} as part of the EPA "
+"Environmental "
 "Assessment Research Programs.\n\n\nFor more information about EPA: "
 "http://www.epa.gov/ We accept comments according to out comment policy: "
 "http://blog.epa.gov/blog/comment-policy/")
 
 
-def process(fn):
-
-    if fn.split('.')[-1] == 'xlsx':
-        is_xl = True
-        tbl = pd.read_excel(fn)
+def process(fn, hash_files=True, dedup=True, metrics_fn=None, leases=None):
 
-    if fn.split('.')[-1] == 'csv':
-        is_xl = False
-        tbl = pd.read_csv(fn)
-        tbl.DateCollected = tbl.DateCollected.str.slice(stop=4)
+    # only the 'yes' rows of the columns we use, cached after the first read
+    tbl = read_table(fn)
 
     uid_col = 'UID'
     path_col = 'Path'
-    date_col = 'DateCollected'
-    tbl = tbl.loc[tbl.NewforMapViewer == 'yes']
 
     validate_column_uniqueness([uid_col, path_col], tbl)
 
-    tbl.set_index('UID', inplace=True, drop=False)
-    for uid, location in tbl.Path.iteritems():
-        miss = 0
-        # print ('HERE:', location)
-        if not os.path.exists(location):
-            print (f"UID: <{uid}> doesn't exist in the given location:")
-            print ('\t' + f"{location}")
+    files = validate_files(tbl.Path, hash_files)
+    miss = 0
+    for uid, info in files.items():
+        if info.error is not None:
+            print (f"UID: <{uid}> doesn't exist or can't be read in the given "
+                   "location:")
+            print ('\t' + f"{info.path}")
+            logging.error('UID: %s -- %s', uid, info.error)
             miss += 1
     if miss:
         print ('Either find these files and update, '
@@ -74,18 +81,98 @@ def process(fn):
         logging.critical('Failed due to videos missing from where '
                          'they were stated to be!')
         sys.exit()
+    text = render_text(tbl, TITLE, TEXT)
     print ('Table validation passed, begin calling YouTube API...')
+    ledger = Ledger()
+    youtube = get_authenticated_service(upload_options())
+    metrics = MetricsLog(metrics_fn or
+                         f".logging/metrics_{dt.now().strftime('%s')}.jsonl")
+    for info in files.values():
+        metrics.queue(info.size)
+    dupes = table_duplicates(files)
+    index = None
+    if dedup:
+        # only what changed on the channel since the last run is fetched
+        mirror = Mirror()
+        index = channel_index(youtube, mirror=mirror)
+        mirror.close()
+    if leases is not None:
+        # rows are claimed from the other machines first, see leases.py
+        leases.start()
     for uid, row in tbl.iterrows():
-
-        # csv format won't be read-in as datetime objects like excel
-        desc = TEXT.format(row[date_col].year if is_xl else row[date_col])
-        response = call(['python', 'upload_video.py',
-                          '--file',row.Path,
-                          '--description', desc,
-                          '--title', f'{row.StudyName} -- {row.UID}',
-                          '--privacyStatus','unlisted'])
-        print (response)
+        fp = fingerprint(row.Path)
+        if ledger.is_done(uid, fp):
+            print (f"UID: <{uid}> already uploaded, skipping.")
+            metrics.skip(files[uid].size)
+            continue
+        video_id = leases and leases.done(uid, fp)
+        if video_id:
+            print (f"UID: <{uid}> already uploaded by another machine, "
+                   "skipping.")
+            metrics.skip(files[uid].size)
+            ledger.record(uid, fp, row.Path, UPLOADED, video_id)
+            continue
+        title = text.title(uid)
+        dupe = find_duplicate(uid, fp, title, files[uid], ledger, index, dupes)
+        if dupe is not None:
+            reason, video_id = dupe
+            print (f"UID: <{uid}> {reason}, skipping.")
+            logging.warning('UID: %s -- %s, skipping.', uid, reason)
+            metrics.skip(files[uid].size)
+            if video_id is not None:
+                ledger.record(uid, fp, row.Path, UPLOADED, video_id)
+            continue
+
+        options = upload_options(file=row.Path,
+                                 description=text.description(uid),
+                                 title=title,
+                                 category=CATEGORY,
+                                 privacyStatus='unlisted')
+        session = ledger.session(uid, fp)
+        progress = None
+        if leases is not None:
+            holder = leases.claim(uid, fp)
+            if holder == DONE:
+                # finished elsewhere since the table was read
+                print (f"UID: <{uid}> already uploaded by another machine, "
+                       "skipping.")
+                metrics.skip(files[uid].size)
+                ledger.record(uid, fp, row.Path, UPLOADED,
+                              leases.done(uid, fp))
+                continue
+            if holder is not None:
+                print (f"UID: <{uid}> claimed by {holder}, skipping.")
+                logging.info('UID: %s -- claimed by %s, skipping.', uid,
+                             holder)
+                metrics.skip(files[uid].size)
+                continue
+            session = leases.session(uid, fp, session)
+            # sent in chunks so a lease taken over by another machine stops
+            # the upload at the next one
+            options.chunksize = CHUNKSIZE
+            progress = leased(leases, uid, fp)
+        ledger.record(uid, fp, row.Path, STARTED)
+        m = metrics.start(uid, row.Path, files[uid].size)
+        result = upload_row(youtube, uid, options, progress, session, m)
+        print (result)
+        metrics.finish(m, UPLOADED if result.ok else FAILED)
+        if leases is not None:
+            if result.ok:
+                leases.complete(uid, fp, result.video_id)
+            else:
+                leases.release(uid, fp)
+        if not result.ok:
+            ledger.record(uid, fp, row.Path, FAILED)
+            logging.error('%s -- UID: %s failed to upload: %s', dt.now(),
+                          row.UID, result.error)
+            continue
+        ledger.record(uid, fp, row.Path, UPLOADED, result.video_id,
+                      result.bytes_sent)
         logging.info('%s -- UID: %s successfully uploaded.', dt.now(), row.UID)
+    if leases is not None:
+        leases.close()
+    ledger.close()
+    metrics.summary()
 
 def is_valid_file(parser, arg):
     '''
@@ -144,6 +231,9 @@ if __name__ == '__main__':
              epilog=EPILOG)
     parser.add_argument("file", help="path/to/xl/or/csv/table.xlsx",
                         type=lambda x: is_valid_file(parser, x))
+    parser.add_argument("--leases", default=None,
+                        help="SQLite file on a share where machines working "
+                        "on the same videos claim rows, see leases.py")
     args = parser.parse_args()
     if not os.path.exists('./.logging'):
         os.mkdir('./.logging')
@@ -159,5 +249,6 @@ if __name__ == '__main__':
         print ('Please run this file in the directory where it is located!\n'
                 'so that the .logging/ directory can be found if needed later!')
         sys.exit()
-    process(args.file)
+    leases = Leases(args.leases) if args.leases else None
+    process(args.file, metrics_fn=fn[:-len('.log')] + '.jsonl', leases=leases)
     logging.info('Script finished successfully')
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Follows uploaded videos through YouTube's processing. An upload counts as
+done as soon as YouTube hands back an id, but a video can still fail
+processing or be rejected afterwards, and that used to go unnoticed until
+someone on the Map Viewer found a dead link. The tracker takes the ids of
+uploaded videos from the ledger and asks about up to 50 of them per
+`videos().list` call, so 500 fresh uploads cost 10 calls a round rather than
+500. A video is looked at again after the time YouTube estimates it has left,
+or after a wait that doubles every time it's still going, between
+`MIN_INTERVAL` and `MAX_INTERVAL`, so videos that take hours don't use up
+calls. Videos that failed or were rejected for a reason uploading again
+could fix are put back in the upload queue, they go up again on the next run
+of bulk_upload_video.py, which looks at the videos due a check before it
+starts, or the next poll of watch.py.
+
+Example:
+     $ python processing.py
+     $ python processing.py --once
+
+@author: rick
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime as dt
+from argparse import ArgumentParser
+
+from upload_video import get_authenticated_service, upload_options
+from dedup import PAGE_SIZE, LIST_COST
+from errors import classify, RETRY
+from ledger import Ledger
+from quota import QuotaTracker
+
+PARTS = 'status,processingDetails'
+
+# what YouTube made of a video
+PROCESSING = 'processing'
+PROCESSED = 'processed'
+FAILED = 'failed'
+REJECTED = 'rejected'
+# the id isn't on the channel any more
+MISSING = 'missing'
+SETTLED = (PROCESSED, FAILED, REJECTED, MISSING)
+
+# rejections that uploading the same file again won't get past
+FINAL_REJECTIONS = ('duplicate', 'copyright', 'trademark', 'termsOfUse',
+                    'inappropriate', 'legal', 'uploaderAccountClosed',
+                    'uploaderAccountSuspended')
+
+# times a row goes back in the queue before it's left for a person to
+# look at
+MAX_REQUEUES = 2
+
+# seconds between looks at a video that's still processing
+MIN_INTERVAL = 60
+MAX_INTERVAL = 60 * 60
+
+
+def video_state(video):
+    '''
+    Where a video is in processing, from its `status` and
+    `processingDetails`.
+
+    Returns
+    -------
+    (state, reason, seconds_left)
+        `reason` is YouTube's for a failure or rejection, `seconds_left` its
+        estimate of how long processing will take, if it gave one.
+    '''
+    status = video.get('status', {})
+    details = video.get('processingDetails', {})
+    upload = status.get('uploadStatus')
+    if upload == 'failed':
+        return FAILED, status.get('failureReason'), None
+    if upload == 'rejected':
+        return REJECTED, status.get('rejectionReason'), None
+    if upload == 'deleted':
+        return MISSING, 'deleted', None
+    processing = details.get('processingStatus')
+    if processing in ('failed', 'terminated'):
+        return FAILED, details.get('processingFailureReason', processing), None
+    if upload == 'processed' or processing == 'succeeded':
+        return PROCESSED, None, None
+    left = details.get('processingProgress', {}).get('timeLeftMs')
+    return PROCESSING, None, int(left) / 1000 if left else None
+
+
+def next_interval(checks, seconds_left=None):
+    '''
+    Seconds until a video still processing is looked at again.
+    '''
+    wait = seconds_left or MIN_INTERVAL * 2 ** checks
+    return min(max(wait, MIN_INTERVAL), MAX_INTERVAL)
+
+
+class StatusTracker:
+    '''
+    Checks on uploaded videos until YouTube has finished with them.
+
+    Parameters
+    ----------
+    ledger : Ledger
+        Where the uploads and their processing states are kept.
+    quota : QuotaTracker, optional
+        Charged for every list call made.
+    batch_size : int
+        Ids asked about per call, YouTube takes up to 50.
+    '''
+
+    def __init__(self, ledger, quota=None, batch_size=PAGE_SIZE):
+        self.ledger = ledger
+        self.quota = quota
+        self.batch_size = batch_size
+        self.calls = 0
+
+    def due(self):
+        return self.ledger.unchecked(time.time(), SETTLED)
+
+    def next_check(self):
+        '''
+        Epoch seconds the next check is due, None if nothing is processing.
+        '''
+        return self.ledger.next_check(SETTLED)
+
+    def poll(self, youtube):
+        '''
+        Look at every video whose check is due.
+
+        Returns
+        -------
+        list
+            (uid, video_id) of the rows put back in the upload queue.
+        '''
+        due = self.due()
+        requeued = []
+        for start in range(0, len(due), self.batch_size):
+            batch = {row[0]: row for row in due[start:start + self.batch_size]}
+            try:
+                response = youtube.videos().list(part=PARTS,
+                                                 id=','.join(batch),
+                                                 maxResults=PAGE_SIZE
+                                                 ).execute()
+            except Exception as e:
+                outcome = classify(e)
+                logging.warning('%s -- Processing check failed (%s): %s',
+                                dt.now(), outcome.kind, outcome.detail)
+                if outcome.action == RETRY:
+                    continue
+                break
+            finally:
+                self.calls += 1
+                if self.quota is not None:
+                    self.quota.charge(LIST_COST)
+            found = {video['id']: video for video in response.get('items', [])}
+            for video_id, (_, uid, fp, checks) in batch.items():
+                video = found.get(video_id)
+                if video is None:
+                    state, reason, left = MISSING, 'not on the channel', None
+                else:
+                    state, reason, left = video_state(video)
+                if self._record(video_id, uid, fp, checks, state, reason,
+                                left):
+                    requeued.append((uid, video_id))
+        if due:
+            logging.info('%s -- Checked %d videos with %d calls, %d put back '
+                         'in the queue', dt.now(), len(due),
+                         -(-len(due) // self.batch_size), len(requeued))
+        return requeued
+
+    def _record(self, video_id, uid, fp, checks, state, reason, left):
+        '''
+        Save the state of one video, putting its row back in the queue if
+        it should be uploaded again. Returns whether it was.
+        '''
+        next_check = None
+        if state == PROCESSING:
+            next_check = time.time() + next_interval(checks, left)
+        self.ledger.record_processing(video_id, uid, fp, state, reason,
+                                      checks + 1, next_check)
+        if state == PROCESSED or state == PROCESSING:
+            return False
+        retry = state == FAILED or (state == REJECTED
+                                    and reason not in FINAL_REJECTIONS)
+        if retry and self.ledger.processing_failures(
+                uid, (FAILED, REJECTED)) > MAX_REQUEUES:
+            retry = False
+        action = 'put back in the queue' if retry else 'left alone'
+        print (f"UID: <{uid}> video {video_id} {state} ({reason}), {action}.")
+        logging.warning('%s -- UID: %s video %s %s (%s), %s', dt.now(), uid,
+                        video_id, state, reason, action)
+        if retry:
+            self.ledger.requeue(uid, fp)
+        return retry
+
+    def run(self, youtube, stopped=None, once=False):
+        '''
+        Poll until every video has finished processing, or `stopped` is set.
+        '''
+        stopped = stopped or threading.Event()
+        while not stopped.is_set():
+            self.poll(youtube)
+            following = self.next_check()
+            if once or following is None:
+                return
+            # a check that failed is due again straight away
+            stopped.wait(max(following - time.time(), MIN_INTERVAL / 6))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='processing.py')
+    parser.add_argument('--once', action='store_true',
+                        help='check the videos that are due and stop, rather '
+                        'than waiting until every one is processed')
+    args = parser.parse_args()
+    ledger = Ledger()
+    tracker = StatusTracker(ledger, QuotaTracker())
+    youtube = get_authenticated_service(upload_options())
+    try:
+        tracker.run(youtube, once=args.once)
+    except KeyboardInterrupt:
+        pass
+    print(f'{tracker.calls} calls made.')
+    ledger.close()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Spreads uploads over more than one Google Cloud project. Each project has its
+own OAuth client, its own token store and its own daily quota, so a backlog
+that would take weeks on one project's 10,000 units goes about as many times
+faster as there are projects authorized for the channel. Every upload is
+charged to the project with the most quota left, and when YouTube says a
+project is out the upload moves on to the next one that still has some.
+
+The projects are listed in a JSON file:
+
+    [{"name": "epa-1", "client_secrets": "client_secrets.json",
+      "credentials": "upload_video.py-oauth2.json"},
+     {"name": "epa-2", "client_secrets": "client_secrets_2.json",
+      "credentials": "epa-2-oauth2.json", "budget": 10000}]
+
+`budget` and `quota_file` are optional, the quota of each project is kept in
+.quota-<name>.json unless told otherwise.
+
+@author: rick
+"""
+
+import json
+import logging
+import threading
+
+from upload_video import (get_authenticated_service, get_credentials,
+                          CLIENT_SECRETS_FILE, CREDENTIALS_FILE)
+from quota import QuotaTracker, QUOTA_FILE, DAILY_BUDGET, INSERT_COST
+
+
+class Project:
+    '''
+    One OAuth client and the quota that goes with it.
+
+    Parameters
+    ----------
+    name : string
+        Label used in the logs and for the quota file.
+    secrets : string
+        Path of the project's client_secrets.json.
+    credentials : string
+        Path of the token store for the project.
+    budget : int
+        Daily quota units available to the project.
+    quota_fn : string, optional
+        Where the project's quota count is kept.
+    connect : callable, optional
+        Called with the upload options to build a service instead of going
+        through OAuth, for the local test server.
+    '''
+
+    def __init__(self, name, secrets=CLIENT_SECRETS_FILE,
+                 credentials=CREDENTIALS_FILE, budget=DAILY_BUDGET,
+                 quota_fn=None, connect=None):
+        self.name = name
+        self.secrets = secrets
+        self.credentials = credentials
+        self.quota = QuotaTracker(budget, quota_fn or f'.quota-{name}.json')
+        self.connect = connect
+
+    def __repr__(self):
+        return f'Project({self.name!r})'
+
+    def authorize(self, args):
+        '''
+        Load the project's token, running the browser flow if there isn't a
+        good one yet.
+        '''
+        if self.connect is None:
+            get_credentials(args, secrets_file=self.secrets,
+                            credentials_file=self.credentials)
+
+    def service(self, args):
+        if self.connect is not None:
+            return self.connect(args)
+        return get_authenticated_service(args, self.secrets, self.credentials)
+
+
+class ProjectPool:
+    '''
+    Projects that uploads can be charged to. Has the same `remaining`,
+    `reserve` and `wait_for_reset` as a `QuotaTracker` so it can stand in for
+    one, but `reserve` hands back the project that was charged.
+    '''
+
+    def __init__(self, projects):
+        if not projects:
+            raise ValueError('A project pool needs at least one project.')
+        self.projects = list(projects)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def single(cls, budget=DAILY_BUDGET):
+        '''
+        The one project in client_secrets.json, with the quota file the
+        scripts have always used.
+        '''
+        return cls([Project('default', budget=budget, quota_fn=QUOTA_FILE)])
+
+    @classmethod
+    def load(cls, fn, budget=DAILY_BUDGET):
+        '''
+        Read the list of projects from a JSON file.
+
+        Parameters
+        ----------
+        fn : string
+            Path of the JSON file.
+        budget : int
+            Daily quota of any project that doesn't give its own.
+
+        Returns
+        -------
+        ProjectPool
+        '''
+        with open(fn) as f:
+            entries = json.load(f)
+        names = [entry['name'] for entry in entries]
+        if len(set(names)) != len(names):
+            raise ValueError(f'Project names in {fn} are not unique.')
+        return cls([Project(entry['name'],
+                            entry.get('client_secrets', CLIENT_SECRETS_FILE),
+                            entry.get('credentials',
+                                      f"{entry['name']}-oauth2.json"),
+                            entry.get('budget', budget),
+                            entry.get('quota_file'))
+                    for entry in entries])
+
+    def __len__(self):
+        return len(self.projects)
+
+    @property
+    def first(self):
+        return self.projects[0]
+
+    @property
+    def remaining(self):
+        return sum(project.quota.remaining for project in self.projects)
+
+    def get(self, name):
+        '''
+        The project called `name`, None if there isn't one in the pool.
+        '''
+        for project in self.projects:
+            if project.name == name:
+                return project
+        return None
+
+    def authorize(self, args):
+        '''
+        Get a token for every project up front, so any browser flows happen
+        before the uploads start rather than in the middle of a worker.
+        '''
+        for project in self.projects:
+            project.authorize(args)
+
+    def reserve(self, cost=INSERT_COST):
+        '''
+        Charge `cost` to the project with the most quota left.
+
+        Returns
+        -------
+        Project or None
+            None if no project has enough left today.
+        '''
+        with self.lock:
+            ranked = sorted(self.projects,
+                            key=lambda p: p.quota.remaining, reverse=True)
+            for project in ranked:
+                if project.quota.reserve(cost):
+                    return project
+        return None
+
+    def exhaust(self, project):
+        '''
+        YouTube says `project` is out, stop charging anything else to it.
+        '''
+        project.quota.exhaust()
+        logging.warning('Project %s is out of quota, %d units left across '
+                        'the other projects', project.name, self.remaining)
+
+    def wait_for_reset(self):
+        '''
+        Every project's quota is reset at midnight Pacific time, so waiting on
+        any one of them waits on them all.
+        '''
+        self.first.quota.wait_for_reset()
+
+
+class ProjectServices:
+    '''
+    The services of one worker thread, one for each project, built the first
+    time the thread uploads with that project.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.services = {}
+
+    def __getitem__(self, project):
+        if project.name not in self.services:
+            self.services[project.name] = project.service(self.args)
+        return self.services[project.name]
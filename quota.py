@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps count of the YouTube Data API quota units spent each day so that the
+bulk uploader can stop right before it runs out and wake back up when the
+quota is reset at midnight Pacific time. The running total is written to disk
+after every charge so a restarted process knows how much budget is left, and
+if that file can't be read the day's budget is taken to be spent.
+
+@author: rick
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime as dt, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+    PACIFIC = ZoneInfo('America/Los_Angeles')
+except ImportError:
+    # python < 3.9, close enough outside of the DST switch
+    PACIFIC = timezone(timedelta(hours=-8))
+
+QUOTA_FILE = '.quota.json'
+
+# default daily allotment for a project in the developer console
+DAILY_BUDGET = 10000
+
+# quota cost of a single call to videos().insert
+INSERT_COST = 1600
+
+# reasons in the 403 error payload that mean the quota is gone for the day
+QUOTA_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+
+# reasons that only mean slow down for a moment, even from the usageLimits
+# domain
+RATE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def quota_day(now=None):
+    '''
+    The date that quota is being counted against, which rolls over at
+    midnight Pacific time.
+
+    Parameters
+    ----------
+    now : datetime, optional
+        Timezone aware time to check, defaults to right now.
+
+    Returns
+    -------
+    string
+        ISO formatted date in Pacific time.
+    '''
+    now = now or dt.now(timezone.utc)
+    return now.astimezone(PACIFIC).date().isoformat()
+
+
+def seconds_until_reset(now=None):
+    '''
+    Number of seconds left until the next midnight Pacific time.
+
+    Parameters
+    ----------
+    now : datetime, optional
+        Timezone aware time to count from, defaults to right now.
+
+    Returns
+    -------
+    float
+    '''
+    now = (now or dt.now(timezone.utc)).astimezone(PACIFIC)
+    midnight = dt.combine(now.date() + timedelta(days=1),
+                          dt.min.time()).replace(tzinfo=PACIFIC)
+    return (midnight - now).total_seconds()
+
+
+def error_reasons(e):
+    '''
+    Pull the `domain` and `reason` out of each error in an HttpError payload.
+
+    Parameters
+    ----------
+    e : HttpError
+        Error raised from the API client.
+
+    Returns
+    -------
+    list
+        (domain, reason) tuples, empty if the payload can't be decoded.
+    '''
+    content = e.content
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    try:
+        errors = json.loads(content)['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+    return [(err.get('domain'), err.get('reason')) for err in errors]
+
+
+def is_quota_error(e):
+    '''
+    Check if an HttpError is YouTube telling us the daily quota is used up.
+
+    Parameters
+    ----------
+    e : HttpError
+        Error raised from the API client.
+
+    Returns
+    -------
+    bool
+    '''
+    if e.resp.status != 403:
+        return False
+    return any(reason in QUOTA_REASONS
+               or (domain in ('youtube.quota', 'usageLimits')
+                   and reason not in RATE_REASONS)
+               for domain, reason in error_reasons(e))
+
+
+class QuotaTracker:
+    '''
+    Daily quota accounting that is persisted to `fn` as JSON. Safe to share
+    between upload threads.
+    '''
+
+    def __init__(self, budget=DAILY_BUDGET, fn=QUOTA_FILE):
+        self.budget = budget
+        self.fn = fn
+        self.lock = threading.RLock()
+        self.day = quota_day()
+        self.used = 0
+        try:
+            with open(fn) as f:
+                state = json.load(f)
+        except IOError:
+            # nothing spent yet on this machine
+            return
+        except ValueError as e:
+            self._unreadable(e)
+            return
+        try:
+            if state['day'] == self.day:
+                self.used = int(state['used'])
+        except (KeyError, TypeError, ValueError) as e:
+            self._unreadable(e)
+
+    def _unreadable(self, e):
+        # starting again from nothing could spend a day's quota twice, so
+        # nothing more is sent before the reset
+        print (f"Can't read the quota used today from {self.fn}, assuming "
+               "it's all spent until the reset.")
+        logging.error('%s -- Quota file %s unreadable (%r), treating the '
+                      'budget as spent', dt.now(), self.fn, e)
+        self.used = self.budget
+
+    def _rollover(self):
+        with self.lock:
+            today = quota_day()
+            if today != self.day:
+                self.day = today
+                self.used = 0
+                self.save()
+
+    def save(self):
+        # written beside the file and moved over it so a crash part way
+        # through never leaves half a count behind
+        with open(self.fn + '.tmp', 'w') as f:
+            json.dump(dict(day=self.day, used=self.used), f)
+        os.replace(self.fn + '.tmp', self.fn)
+
+    @property
+    def remaining(self):
+        self._rollover()
+        return max(self.budget - self.used, 0)
+
+    def can_afford(self, cost=INSERT_COST):
+        return self.remaining >= cost
+
+    def charge(self, cost=INSERT_COST):
+        '''
+        Count `cost` units against today's budget and write it to disk.
+        '''
+        with self.lock:
+            self._rollover()
+            self.used += cost
+            self.save()
+
+    def reserve(self, cost=INSERT_COST):
+        '''
+        Charge `cost` only if it fits in what is left of today's budget.
+
+        Returns
+        -------
+        bool
+            False if there wasn't enough budget and nothing was charged.
+        '''
+        with self.lock:
+            if not self.can_afford(cost):
+                return False
+            self.charge(cost)
+            return True
+
+    def exhaust(self):
+        '''
+        YouTube says we are out, trust it over our own count.
+        '''
+        with self.lock:
+            self._rollover()
+            self.used = max(self.used, self.budget)
+            self.save()
+
+    def wait_for_reset(self):
+        '''
+        Block until the quota is reset at midnight Pacific time, plus a minute
+        to stay clear of clock skew with Google's servers.
+        '''
+        wait = seconds_until_reset() + 60
+        resume = dt.now() + timedelta(seconds=wait)
+        print(f'Quota used up, sleeping until {resume:%Y-%m-%d %H:%M}...')
+        logging.info('%s -- Quota exhausted (%d of %d used), resuming at %s',
+                     dt.now(), self.used, self.budget, resume)
+        time.sleep(wait)
+        self._rollover()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Decides the order that rows are handed to the upload workers. By default rows
+go in table order, but they can be sorted smallest file first, by a Priority
+column in the table, or packed to fit what is left of the day's quota so the
+most videos are published per quota day. Rows that can't be sent before the
+end of the time window at the rate seen so far are held back for the next run
+rather than started and left unfinished.
+
+@author: rick
+"""
+
+import math
+import time
+import logging
+from datetime import datetime as dt
+
+POLICIES = ('table', 'smallest', 'priority', 'fit')
+
+# used for time estimates until a run has measured its own rate, 1 MB/s
+DEFAULT_RATE = 1024 * 1024
+
+
+class Scheduler:
+    '''
+    Orders upload jobs and holds back any that can't finish in time.
+
+    Parameters
+    ----------
+    policy : string
+        One of `POLICIES`.
+    sizes : dict
+        UID -> size of the file in bytes.
+    priorities : dict, optional
+        UID -> priority from the table, higher goes first.
+    quota : QuotaTracker or ProjectPool, optional
+        Used by the 'fit' policy to see how many inserts are left today.
+    cost : int
+        Quota cost of one upload.
+    deadline : datetime, optional
+        Uploads that won't be done by then aren't started.
+    rate : callable, optional
+        Returns the current bytes per second of the run, see
+        `metrics.MetricsLog.throughput`.
+    '''
+
+    def __init__(self, policy='table', sizes=None, priorities=None,
+                 quota=None, cost=0, deadline=None, rate=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown scheduling policy: {policy}')
+        self.policy = policy
+        self.sizes = sizes or {}
+        self.priorities = priorities or {}
+        self.quota = quota
+        self.cost = cost
+        self.deadline = deadline
+        self.rate = rate
+        self.deferred = []
+
+    def _size(self, uid):
+        return self.sizes.get(uid) or 0
+
+    def _priority(self, uid):
+        try:
+            priority = float(self.priorities.get(uid) or 0)
+        except (TypeError, ValueError):
+            return 0.0
+        # a blank cell in the table comes through as NaN, which can't be
+        # sorted
+        return 0.0 if math.isnan(priority) else priority
+
+    def order(self, jobs):
+        '''
+        Sort (uid, job) pairs according to the policy. In table order the
+        jobs are passed through as they come, so a generator of them is only
+        run as far as the uploads have got, the other policies need every
+        job before the first can be handed out.
+
+        Parameters
+        ----------
+        jobs : iterable
+            (uid, job) pairs in table order.
+
+        Returns
+        -------
+        iterator or list
+        '''
+        if self.policy == 'table':
+            return iter(jobs)
+        jobs = list(jobs)
+        if self.policy == 'smallest':
+            jobs.sort(key=lambda j: self._size(j[0]))
+        elif self.policy == 'priority':
+            jobs.sort(key=lambda j: (-self._priority(j[0]), self._size(j[0])))
+        elif self.policy == 'fit':
+            jobs = self._fit(jobs)
+        return jobs
+
+    def _fit(self, jobs):
+        '''
+        Fill today's remaining inserts with the highest priority rows, the
+        smallest first among equals, and put the rest after them in table
+        order for once the quota comes back.
+        '''
+        if self.quota is None or not self.cost:
+            return sorted(jobs, key=lambda j: (-self._priority(j[0]),
+                                               self._size(j[0])))
+        slots = self.quota.remaining // self.cost
+        ranked = sorted(range(len(jobs)),
+                        key=lambda i: (-self._priority(jobs[i][0]),
+                                       self._size(jobs[i][0])))
+        today = set(ranked[:slots])
+        first = [jobs[i] for i in ranked[:slots]]
+        later = [job for i, job in enumerate(jobs) if i not in today]
+        return first + later
+
+    def seconds_for(self, uid):
+        rate = (self.rate() if self.rate else 0) or DEFAULT_RATE
+        return self._size(uid) / rate
+
+    def fits(self, uid):
+        '''
+        Whether the upload could be finished before the deadline.
+        '''
+        if self.deadline is None:
+            return True
+        left = (self.deadline - dt.now()).total_seconds()
+        return self.seconds_for(uid) <= left
+
+    def __call__(self, jobs):
+        '''
+        Yield jobs in order, holding back the ones that wouldn't finish
+        before the deadline. Checked as each job is handed out so the
+        estimate uses the rate measured so far.
+        '''
+        for uid, job in self.order(jobs):
+            if not self.fits(uid):
+                eta = time.strftime('%H:%M:%S',
+                                    time.gmtime(self.seconds_for(uid)))
+                print (f"UID: <{uid}> needs about {eta}, more than is left "
+                       "before the deadline, holding it for the next run.")
+                logging.info('UID: %s -- deferred, would not finish before '
+                             '%s', uid, self.deadline)
+                self.deferred.append(uid)
+                continue
+            yield uid, job
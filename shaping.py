@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the uploads from taking over the office link. Every upload draws from
+its own token bucket and from one shared by the whole process, so neither a
+single upload nor all of them together go faster than allowed, and the
+allowance can change with the time of day, e.g. the whole link overnight and
+a fifth of it during business hours.
+
+The limits can be given on the command line or in a JSON file:
+
+    {"max_rate": 10, "upload_rate": 4,
+     "windows": [{"start": "08:00", "end": "18:00", "rate": "20%"},
+                 {"start": "18:00", "end": "22:00", "rate": 6}]}
+
+Rates are in MB/s, or a percentage of `max_rate` in a window. Outside every
+window the uploads go at `max_rate`, which can be left out for no cap. The
+file is read again whenever it's saved and the new limits apply to the
+uploads already going, so they can be changed without stopping anything.
+
+The buckets are charged for each chunk once it has been sent, so the rate
+is shaped a chunk at a time, smaller chunks give a smoother rate.
+
+@author: rick
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import weakref
+from datetime import datetime as dt
+
+MB = 1024 * 1024
+
+# seconds between checks of the clock and the limits file
+CHECK_SECONDS = 5
+
+# longest sleep before a bucket looks at its rate again, so a raised limit
+# is picked up by uploads that are already waiting
+MAX_SLEEP = 1.0
+
+
+class TokenBucket:
+    '''
+    Bytes per second allowance that fills up to `burst` bytes while idle.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Bytes per second, None for no limit.
+    burst : float, optional
+        Most bytes that can be sent at once after a pause, a second's worth
+        by default.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self._capacity()
+        self.stamp = time.monotonic()
+
+    def _capacity(self):
+        return self.burst or self.rate or 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._capacity(),
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if rate is None:
+                self.tokens = 0
+            else:
+                self.tokens = min(self.tokens, self._capacity())
+
+    def consume(self, nbytes):
+        '''
+        Take `nbytes` out of the bucket, sleeping until it's out of debt.
+        '''
+        with self.lock:
+            self._refill()
+            self.tokens -= nbytes
+        while True:
+            with self.lock:
+                self._refill()
+                if not self.rate or self.tokens >= 0:
+                    if not self.rate:
+                        self.tokens = 0
+                    return
+                wait = -self.tokens / self.rate
+            time.sleep(min(wait, MAX_SLEEP))
+
+
+def parse_clock(text):
+    return dt.strptime(text, '%H:%M').time()
+
+
+class Window:
+    '''
+    Part of the day with its own limit, may run past midnight.
+
+    Parameters
+    ----------
+    start, end : string
+        HH:MM.
+    rate : float or string
+        MB/s, or a percentage of the full rate such as '20%'.
+    '''
+
+    def __init__(self, start, end, rate):
+        self.start = parse_clock(start)
+        self.end = parse_clock(end)
+        self.rate = rate
+
+    def covers(self, when):
+        now = when.time()
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+    def limit(self, max_rate):
+        '''
+        Bytes per second allowed in the window.
+        '''
+        if isinstance(self.rate, str) and self.rate.strip().endswith('%'):
+            if max_rate is None:
+                raise ValueError('A percentage rate needs a max_rate.')
+            return max_rate * float(self.rate.strip()[:-1]) / 100
+        return float(self.rate) * MB
+
+
+def parse_window(arg):
+    '''
+    A `Window` from the command line, e.g. 08:00-18:00=20% or 18:00-22:00=6.
+    '''
+    try:
+        hours, rate = arg.split('=')
+        start, end = hours.split('-')
+        return Window(start, end, rate if rate.endswith('%') else float(rate))
+    except ValueError:
+        raise ValueError(f'{arg} is not HH:MM-HH:MM=rate')
+
+
+class Shaper:
+    '''
+    The process-wide bucket and the buckets of the uploads going now, with
+    their rates kept in line with the time of day and the limits file.
+
+    Parameters
+    ----------
+    max_rate : float, optional
+        Bytes per second for the whole process outside of any window.
+    upload_rate : float, optional
+        Bytes per second for any one upload.
+    windows : list, optional
+        `Window`s, the first one covering the time wins.
+    fn : string, optional
+        JSON file of limits to follow, see above.
+    '''
+
+    def __init__(self, max_rate=None, upload_rate=None, windows=(), fn=None):
+        self.max_rate = max_rate
+        self.upload_rate = upload_rate
+        self.windows = list(windows)
+        self.fn = fn
+        self.stamp = None
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.total = TokenBucket()
+        self.uploads = weakref.WeakSet()
+        self.refresh(force=True)
+
+    @property
+    def active(self):
+        return bool(self.max_rate or self.upload_rate or self.windows
+                    or self.fn)
+
+    def _load(self):
+        '''
+        Read the limits file again if it has been saved since the last look,
+        keeping the limits in force if it can't be read.
+        '''
+        try:
+            st = os.stat(self.fn)
+            if (st.st_mtime_ns, st.st_size) == self.stamp:
+                return
+            with open(self.fn) as f:
+                limits = json.load(f)
+            windows = [Window(w['start'], w['end'], w['rate'])
+                       for w in limits.get('windows', [])]
+            max_rate = limits.get('max_rate')
+            max_rate = max_rate * MB if max_rate else None
+            for window in windows:
+                window.limit(max_rate)
+            upload_rate = limits.get('upload_rate')
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("%s -- Can't read the limits in %s, keeping the "
+                            "current ones: %r", dt.now(), self.fn, e)
+            return
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.max_rate = max_rate
+        self.upload_rate = upload_rate * MB if upload_rate else None
+        self.windows = windows
+        logging.info('%s -- Limits read from %s', dt.now(), self.fn)
+
+    def rate(self, when=None):
+        '''
+        Bytes per second allowed for the whole process at `when`.
+        '''
+        when = when or dt.now()
+        for window in self.windows:
+            if window.covers(when):
+                limit = window.limit(self.max_rate)
+                return min(limit, self.max_rate) if self.max_rate else limit
+        return self.max_rate
+
+    def refresh(self, force=False):
+        '''
+        Bring every bucket up to date with the clock and the limits file,
+        at most every `CHECK_SECONDS`.
+        '''
+        with self.lock:
+            if not force and time.monotonic() - self.checked < CHECK_SECONDS:
+                return
+            self.checked = time.monotonic()
+            if self.fn:
+                self._load()
+            rate = self.rate()
+            if rate != self.total.rate:
+                print (f'Upload rate now {_describe(rate)}.')
+                logging.info('%s -- Upload rate now %s', dt.now(),
+                             _describe(rate))
+                self.total.set_rate(rate)
+            for bucket in list(self.uploads):
+                if bucket.rate != self.upload_rate:
+                    bucket.set_rate(self.upload_rate)
+
+    def bucket(self):
+        '''
+        A bucket for one upload, kept up to date while it's in use.
+        '''
+        bucket = TokenBucket(self.upload_rate)
+        with self.lock:
+            self.uploads.add(bucket)
+        return bucket
+
+    def progress(self):
+        '''
+        Build a callback for `resumable_upload` that charges the bytes sent
+        by each chunk to the upload's bucket and the shared one.
+        '''
+        bucket = self.bucket()
+        last = [0]
+
+        def report(status):
+            sent = status.resumable_progress
+            # goes back when the server asks for a chunk again
+            nbytes = max(sent - last[0], 0)
+            self.refresh()
+            bucket.consume(nbytes)
+            self.total.consume(nbytes)
+            last[0] = sent
+        return report
+
+
+def _describe(rate):
+    return f'{rate / MB:.2f} MB/s' if rate else 'unlimited'
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+A small HTTP server showing how a run is going while it goes, so a stalled
+upload or a drop in throughput can be seen straight away rather than in the
+logs the next day. It answers on two paths:
+
+    /status     JSON of the queue, the uploads going now with the bytes sent
+                and the rate of each, the retries, the quota left in every
+                project with the time it's reset and the time left for the
+                whole table
+    /metrics    the same numbers in the Prometheus text format, for scraping
+
+It only listens on localhost unless told otherwise.
+
+Example:
+     $ python bulk_upload_video.py table.xlsx --status-port 8750
+     $ curl localhost:8750/status
+
+@author: rick
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PREFIX = 'youtube_upload'
+
+# name -> (type, help) of every metric written to /metrics
+METRICS = {
+    'queue_rows': ('gauge', 'Rows waiting to be uploaded.'),
+    'queue_bytes': ('gauge', 'Bytes left to send for the rows in the queue.'),
+    'in_flight': ('gauge', 'Uploads going now.'),
+    'waiting_for_quota': ('gauge', 'Uploads blocked until the quota is '
+                          'reset.'),
+    'in_flight_bytes_sent': ('gauge', 'Bytes sent so far by an upload.'),
+    'in_flight_bytes_per_second': ('gauge', 'Rate of an upload over its last '
+                                   'few chunks.'),
+    'finished_total': ('counter', 'Uploads finished, by how they ended.'),
+    'bytes_sent_total': ('counter', 'Bytes sent in the run.'),
+    'bytes_per_second': ('gauge', 'Rate of the whole run so far.'),
+    'retries_total': ('counter', 'Chunks sent again after an error.'),
+    'api_calls_total': ('counter', 'Calls made to the API by the uploads.'),
+    'quota_remaining': ('gauge', 'Quota units left today in a project.'),
+    'quota_budget': ('gauge', 'Daily quota units of a project.'),
+    'quota_reset_seconds': ('gauge', 'Seconds until the quota is reset.'),
+    'held_seconds': ('gauge', "Seconds until uploads go again after the "
+                     "channel's upload limit was hit."),
+    'eta_seconds': ('gauge', 'Seconds left to send the queue at the rate of '
+                    'the run.'),
+}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    text = ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for key, value in labels.items())
+    return '{' + text + '}'
+
+
+def _value(value):
+    # counters of bytes run past what %g shows exactly
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def prometheus_text(status):
+    '''
+    Write a status from `BulkUploader.status` in the Prometheus text format.
+
+    Parameters
+    ----------
+    status : dict
+
+    Returns
+    -------
+    string
+    '''
+    samples = {name: [] for name in METRICS}
+    samples['queue_rows'].append((None, status['queue']['rows']))
+    samples['queue_bytes'].append((None, status['queue']['bytes']))
+    samples['in_flight'].append((None, len(status['in_flight'])))
+    samples['waiting_for_quota'].append(
+        (None, sum(u['waiting_for_quota'] for u in status['in_flight'])))
+    for upload in status['in_flight']:
+        labels = dict(uid=upload['uid'])
+        samples['in_flight_bytes_sent'].append((labels, upload['bytes_sent']))
+        samples['in_flight_bytes_per_second'].append(
+            (labels, upload['bytes_per_second']))
+    for state, count in status['finished'].items():
+        samples['finished_total'].append((dict(status=state), count))
+    samples['bytes_sent_total'].append((None, status['bytes_sent']))
+    samples['bytes_per_second'].append((None, status['bytes_per_second']))
+    samples['retries_total'].append((None, status['retries']))
+    samples['api_calls_total'].append((None, status['api_calls']))
+    quota = status['quota']
+    for project in quota['projects']:
+        labels = dict(project=project['name'])
+        samples['quota_remaining'].append((labels, project['remaining']))
+        samples['quota_budget'].append((labels, project['budget']))
+    samples['quota_reset_seconds'].append((None, quota['reset_seconds']))
+    samples['held_seconds'].append((None, quota['held_seconds'] or 0))
+    if status['eta_seconds'] is not None:
+        samples['eta_seconds'].append((None, status['eta_seconds']))
+    lines = []
+    for name, (kind, text) in METRICS.items():
+        if not samples[name]:
+            continue
+        lines.append(f'# HELP {PREFIX}_{name} {text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+        for labels, value in samples[name]:
+            lines.append(f'{PREFIX}_{name}{_labels(labels)} {_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serves the status of a run from a background thread.
+
+    Parameters
+    ----------
+    status : callable
+        Returns the status to show, see `BulkUploader.status`.
+    port : int
+        Port to listen on, 0 picks a free one.
+    host : string
+        Address to listen on.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, status, port, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.status = status
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True,
+                                  name='status-server')
+        thread.start()
+        print (f'Status at {self.url}/status and {self.url}/metrics')
+        logging.info('%s -- Status served at %s', dt.now(), self.url)
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path not in ('', '/status', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            status = self.server.status()
+        except Exception as e:
+            logging.error('%s -- Status failed: %r', dt.now(), e)
+            self.send_error(500)
+            return
+        if path == '/metrics':
+            body = prometheus_text(status).encode()
+            kind = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(status, indent=2).encode()
+            kind = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would bury the upload output
+        pass
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Reads the inventory of videos from an .xlsx or .csv table. Only the columns
+the upload scripts use are read and rows that aren't `yes` in NewforMapViewer
+are dropped while reading, a chunk at a time, so only the rows that will be
+uploaded are held in memory rather than the whole sheet. The filtered table
+is pickled next to the .logging/ directory keyed on the table's mtime so a
+rerun on the same table skips parsing it again.
+
+@author: rick
+"""
+
+import os
+import glob
+import logging
+import pandas as pd
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+# every column read from the table, anything else is left on disk. Priority
+# is optional, higher numbers are uploaded first with --order priority, and so
+# is Playlist, the id of a playlist metadata.py adds the video to
+COLUMNS = ['UID', 'NewforMapViewer', 'Path', 'DateCollected', 'StudyName',
+           'Youtube name', 'Priority', 'Playlist']
+
+DTYPES = {'NewforMapViewer': str,
+          'Path': str,
+          'StudyName': str,
+          'Youtube name': str}
+
+CACHE_DIR = '.table_cache'
+
+# bump whenever COLUMNS or the parsing changes so old caches aren't used
+CACHE_VERSION = 3
+
+# rows parsed before a chunk is handed back
+CHUNK_ROWS = 500
+
+
+def _wanted(col):
+    return col in COLUMNS
+
+
+def _filter(chunk):
+    return chunk.loc[chunk.NewforMapViewer == 'yes']
+
+
+def _iter_csv(fn, chunksize):
+    for chunk in pd.read_csv(fn, usecols=_wanted, dtype=dict(DTYPES,
+                             DateCollected=str), chunksize=chunksize):
+        chunk = _filter(chunk).copy()
+        # csv format won't be read-in as datetime objects like excel
+        chunk.DateCollected = chunk.DateCollected.str.slice(stop=4)
+        yield chunk
+
+
+def _iter_xlsx(fn, chunksize):
+    if load_workbook is None:
+        tbl = pd.read_excel(fn, usecols=_wanted, dtype=DTYPES)
+        yield _filter(tbl)
+        return
+    wb = load_workbook(fn, read_only=True, data_only=True)
+    rows = wb.worksheets[0].iter_rows(values_only=True)
+    header = next(rows)
+    keep = [i for i, col in enumerate(header) if _wanted(col)]
+    cols = [header[i] for i in keep]
+    flag = header.index('NewforMapViewer')
+    buf = []
+    for values in rows:
+        if values[flag] != 'yes':
+            continue
+        buf.append([values[i] for i in keep])
+        if len(buf) >= chunksize:
+            yield _frame(buf, cols)
+            buf = []
+    if buf:
+        yield _frame(buf, cols)
+    wb.close()
+
+
+def _frame(buf, cols):
+    chunk = pd.DataFrame(buf, columns=cols)
+    if 'DateCollected' in chunk:
+        chunk.DateCollected = pd.to_datetime(chunk.DateCollected)
+    return chunk.astype({c: t for c, t in DTYPES.items() if c in chunk})
+
+
+def cache_path(fn):
+    '''
+    Location of the parsed copy of a table, which changes along with the
+    table's modification time.
+
+    Parameters
+    ----------
+    fn : string
+        Absolute path to CSV or Excel file.
+
+    Returns
+    -------
+    string
+    '''
+    stat = os.stat(fn)
+    return os.path.join(CACHE_DIR, f'{_cache_name(fn)}-v{CACHE_VERSION}-'
+                                   f'{stat.st_mtime_ns}-{stat.st_size}.pkl')
+
+
+def _cache_name(fn):
+    return os.path.basename(fn).replace('.', '_')
+
+
+def iter_table(fn, chunksize=CHUNK_ROWS):
+    '''
+    Yield the rows of the table that are new for the Map Viewer in chunks.
+    The parsed copy is used when there is one and is written once the table
+    has been read all the way through, so the rows yielded are kept until
+    then, only the rows dropped are let go as the file is read.
+
+    Parameters
+    ----------
+    fn : string
+        Absolute path to CSV or Excel file.
+    chunksize : int
+        Number of rows read from the file before they are yielded.
+
+    Yields
+    ------
+    DataFrame
+    '''
+    cached = cache_path(fn)
+    if os.path.exists(cached):
+        yield pd.read_pickle(cached)
+        return
+    if fn.split('.')[-1] == 'csv':
+        chunks = _iter_csv(fn, chunksize)
+    else:
+        chunks = _iter_xlsx(fn, chunksize)
+    parsed = []
+    for chunk in chunks:
+        parsed.append(chunk)
+        yield chunk
+    if not os.path.exists(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+    stale = glob.glob(os.path.join(CACHE_DIR,
+                                   glob.escape(_cache_name(fn)) + '-*.pkl'))
+    for old in stale:
+        os.remove(old)
+    _concat(parsed).to_pickle(cached)
+    logging.info('Parsed table cached at %s', cached)
+
+
+def _concat(chunks):
+    if not chunks:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(chunks)
+
+
+def read_table(fn):
+    '''
+    The whole filtered table at once, indexed by UID.
+
+    Parameters
+    ----------
+    fn : string
+        Absolute path to CSV or Excel file.
+
+    Returns
+    -------
+    tbl : DataFrame
+    '''
+    tbl = _concat(list(iter_table(fn)))
+    return tbl.set_index('UID', drop=False)
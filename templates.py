@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Titles and descriptions built from the table. A template is ordinary
+`str.format` text whose fields name columns of the table, e.g.
+'{StudyName} -- {UID}', along with a few fields worked out here: `year`, the
+year of DateCollected however the table stored it, and `published`, today's
+date. The template is parsed once and every row of the filtered table is
+rendered a column at a time up front, so each title and description can be
+checked against YouTube's limits before any bytes or quota are spent. Fields
+like `published` that depend on when the video goes up are left as gaps in
+the rendered text and filled in when it's asked for.
+
+@author: rick
+"""
+
+import sys
+import logging
+from string import Formatter
+from datetime import datetime as dt
+
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+
+# longest title YouTube takes, in characters
+TITLE_LIMIT = 100
+
+# longest description YouTube takes, in bytes of UTF-8
+DESCRIPTION_LIMIT = 5000
+
+# YouTube rejects either in a title or description
+FORBIDDEN = '<>'
+
+
+def published_date(when=None):
+    return (when or dt.now()).strftime('%B %d, %Y')
+
+
+# fields filled in at render time -> (function of the time, longest result)
+DYNAMIC = {'published': (published_date, len('September 30, 2020'))}
+
+
+def derived_fields(tbl):
+    '''
+    Columns that templates can use besides the table's own.
+
+    Parameters
+    ----------
+    tbl : DataFrame
+        Table from `read_table`.
+
+    Returns
+    -------
+    DataFrame
+        `tbl` with the derived columns added.
+    '''
+    tbl = tbl.copy()
+    # xlsx tables have full datetimes, csv tables only keep the year and
+    # rows from a drop folder (see watch.py) can be a mix of both
+    if 'DateCollected' in tbl:
+        dates = tbl.DateCollected
+        if is_datetime64_any_dtype(dates):
+            years = dates.dt.year
+        else:
+            years = pd.to_numeric(dates.map(lambda d: getattr(d, 'year', d)),
+                                  errors='coerce')
+        tbl['year'] = years.astype('Int64')
+    return tbl
+
+
+class TemplateError(Exception):
+    """A template can't be parsed or uses columns the table doesn't have."""
+
+
+class Template:
+    '''
+    A title or description template, parsed once.
+
+    Parameters
+    ----------
+    text : string
+        `str.format` template, fields name columns or `DYNAMIC` fields.
+    '''
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                self.parts.append(('text', literal, None, None))
+            if field is None:
+                continue
+            if field == '' or field.isdigit():
+                raise TemplateError(f'Template fields need a name: {text!r}')
+            kind = 'dynamic' if field in DYNAMIC else 'column'
+            self.parts.append((kind, field, spec, conversion))
+
+    @property
+    def columns(self):
+        return [field for kind, field, _, _ in self.parts if kind == 'column']
+
+    @property
+    def dynamic(self):
+        return [field for kind, field, _, _ in self.parts if kind == 'dynamic']
+
+    def render(self, tbl):
+        '''
+        Render the template for every row of the table.
+
+        Parameters
+        ----------
+        tbl : DataFrame
+            Table with the `derived_fields` added.
+
+        Returns
+        -------
+        Rendered
+        '''
+        missing = [col for col in self.columns if col not in tbl]
+        if missing:
+            raise TemplateError(f"Template {self.text!r} uses columns that "
+                                f"aren't in the table: {', '.join(missing)}")
+        blank = pd.Series(False, index=tbl.index)
+        segments = []
+        current = pd.Series('', index=tbl.index, dtype=object)
+        for kind, field, spec, conversion in self.parts:
+            if kind == 'text':
+                current = current + field
+            elif kind == 'column':
+                values = tbl[field]
+                blank |= values.isna()
+                current = current + _format(values, spec, conversion)
+            else:
+                segments.append(current)
+                current = pd.Series('', index=tbl.index, dtype=object)
+        segments.append(current)
+        return Rendered(self, segments, blank)
+
+
+def _format(values, spec, conversion):
+    convert = {'r': repr, 's': str, 'a': ascii}.get(conversion)
+    if not spec and convert in (None, str):
+        return values.astype(str)
+    return values.map(lambda v: format(convert(v) if convert else v, spec))
+
+
+class Rendered:
+    '''
+    A template rendered for every row, with the dynamic fields still to
+    fill. Indexed by UID like the table.
+    '''
+
+    def __init__(self, template, segments, blank):
+        self.template = template
+        self.segments = segments
+        self.blank = blank
+
+    def __call__(self, uid, when=None):
+        '''
+        Text for one row with the dynamic fields filled in for `when`,
+        defaults to right now.
+        '''
+        parts = [self.segments[0][uid]]
+        for field, segment in zip(self.template.dynamic, self.segments[1:]):
+            parts.append(DYNAMIC[field][0](when))
+            parts.append(segment[uid])
+        return ''.join(parts)
+
+    def lengths(self, encoded=False):
+        '''
+        Longest each row's text can be once the dynamic fields are filled.
+        '''
+        if encoded:
+            sizes = [s.str.encode('utf-8').str.len() for s in self.segments]
+        else:
+            sizes = [s.str.len() for s in self.segments]
+        return sum(sizes) + sum(DYNAMIC[f][1] for f in self.template.dynamic)
+
+    def problems(self, limit, encoded=False, what='text'):
+        '''
+        Rows whose text is blank, too long or has characters YouTube won't
+        take.
+
+        Returns
+        -------
+        dict
+            UID -> description of what is wrong.
+        '''
+        lengths = self.lengths(encoded)
+        empty = lengths == 0
+        bad_chars = pd.Series(False, index=lengths.index)
+        for segment in self.segments:
+            bad_chars |= segment.str.contains(f'[{FORBIDDEN}]', regex=True)
+        found = {}
+        unit = 'bytes' if encoded else 'characters'
+        for uid in lengths.index[self.blank]:
+            found[uid] = f'{what} uses a column that is blank for this row'
+        for uid in lengths.index[empty]:
+            found.setdefault(uid, f'{what} is empty')
+        for uid in lengths.index[lengths > limit]:
+            found.setdefault(uid, f'{what} would be {int(lengths[uid])} '
+                                  f'{unit}, more than the {limit} YouTube '
+                                  'allows')
+        for uid in lengths.index[bad_chars]:
+            found.setdefault(uid, f'{what} has a {FORBIDDEN[0]} or '
+                                  f'{FORBIDDEN[1]} in it')
+        return found
+
+
+class VideoText:
+    '''
+    Titles and descriptions of every row of a table, checked against
+    YouTube's limits when built.
+
+    Parameters
+    ----------
+    tbl : DataFrame
+        Table from `read_table`.
+    title : string
+        Template for the titles.
+    description : string
+        Template for the descriptions.
+
+    Attributes
+    ----------
+    title, description : Rendered
+        Called with a UID for the text of that row.
+    problems : dict
+        UID -> what is wrong with the row's title or description.
+    '''
+
+    def __init__(self, tbl, title, description):
+        tbl = derived_fields(tbl)
+        self.title = Template(title).render(tbl)
+        self.description = Template(description).render(tbl)
+        self.problems = self.description.problems(DESCRIPTION_LIMIT, True,
+                                                  'description')
+        self.problems.update(self.title.problems(TITLE_LIMIT, False, 'title'))
+
+
+def render_text(tbl, title, description):
+    '''
+    Render the title and description of every row, failing gracefully with
+    print statements and additions to the log file if any of them can't be
+    rendered or YouTube would turn them down.
+
+    Parameters
+    ----------
+    tbl : DataFrame
+        Table of data.
+    title : string
+        Template for the titles.
+    description : string
+        Template for the descriptions.
+
+    Returns
+    -------
+    VideoText
+    '''
+    try:
+        text = VideoText(tbl, title, description)
+    except TemplateError as e:
+        logging.critical('%s FAIL!', e)
+        print (f'{e} FAIL!')
+        sys.exit()
+    for uid, problem in text.problems.items():
+        print (f"UID: <{uid}> {problem}.")
+        logging.error('UID: %s -- %s', uid, problem)
+    if text.problems:
+        print ('Fix these rows in the table, or the templates, before '
+               'uploading.')
+        logging.critical('Failed due to titles or descriptions that YouTube '
+                         'would reject!')
+        sys.exit()
+    return text
@@ -0,0 +1,38 @@
+from scheduler import Scheduler
+
+NAN = float('nan')
+
+
+def jobs():
+    return [(uid, None) for uid in 'abcdef']
+
+
+def test_blank_priorities_sort_last():
+    priorities = dict(a=NAN, b=5, c=NAN, d=1, e=NAN, f=3)
+    scheduler = Scheduler('priority', priorities=priorities)
+    order = [uid for uid, _ in scheduler.order(jobs())]
+    assert order == ['b', 'f', 'd', 'a', 'c', 'e']
+
+
+def test_blank_priorities_fit():
+    class Quota:
+        remaining = 3
+
+    priorities = dict(a=NAN, b=5, c=NAN, d=1, e=NAN, f=3)
+    scheduler = Scheduler('fit', priorities=priorities, quota=Quota(), cost=1)
+    order = [uid for uid, _ in scheduler.order(jobs())]
+    assert order == ['b', 'f', 'd', 'a', 'c', 'e']
+
+
+def test_table_order_is_lazy():
+    seen = []
+
+    def rows():
+        for uid in 'abc':
+            seen.append(uid)
+            yield uid, None
+
+    scheduler = Scheduler('table')
+    queued = scheduler(rows())
+    assert next(queued) == ('a', None)
+    assert seen == ['a']
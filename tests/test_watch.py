@@ -0,0 +1,53 @@
+import pandas as pd
+
+from watch import Watcher
+
+
+class Result:
+    ok = True
+
+
+class Metrics:
+    def summary(self):
+        pass
+
+
+class Uploader:
+    '''
+    Stands in for BulkUploader, putting back in the queue whatever UIDs are
+    set in `requeue`, as strings like the ledger hands them back.
+    '''
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.uploaded = []
+        self.requeue = []
+
+    def check_processing(self):
+        requeued, self.requeue = self.requeue, []
+        return requeued
+
+    def upload(self, rows, files, text):
+        self.uploaded.append(list(rows.index))
+        return {uid: Result() for uid in rows.index}
+
+
+def test_requeued_rows_with_integer_uids_go_up_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = []
+    for n in (1, 2):
+        path = tmp_path / f'{n}.mp4'
+        path.write_bytes(b'video %d' % n)
+        paths.append(str(path))
+    tbl = pd.DataFrame({'UID': [1, 2], 'Path': paths,
+                        'Youtube name': ['one', 'two']}).set_index(
+                            'UID', drop=False)
+    uploader = Uploader()
+    watcher = Watcher(uploader, description='test', hash_files=False)
+    monkeypatch.setattr(watcher, 'rows', lambda: tbl)
+
+    assert watcher.poll() == 2
+    assert watcher.poll() == 0
+    uploader.requeue = ['1']
+    assert watcher.poll() == 1
+    assert uploader.uploaded == [[1, 2], [1]]
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Shrinks the videos before they're sent. The DVR files come off the recorders
+at far higher bitrates than YouTube keeps, in containers it's slow to process,
+so re-encoding them to a sensible bitrate, or just remuxing them to an mp4
+with the index at the front, means much less to push through the uplink and
+fewer half-sent uploads of several hundred MB.
+
+The work is done by ffmpeg, or anything that takes the same arguments, run
+from a pool of processes spread over every core. Rows are started in the
+order they'll be uploaded, a pool's worth ahead of the uploads, and each
+upload waits only for its own file, so later files are converted while the
+earlier ones are being sent. The output is kept in `TRANSCODE_DIR` under the hash of the
+source and the settings, so a file is only converted once however many runs
+it takes to get it up, and deleted once it's up so a bulk run doesn't leave a
+second copy of every video behind. When the output isn't any smaller than the source, or
+the conversion fails, the original file is sent instead.
+
+@author: rick
+"""
+
+import os
+import re
+import shutil
+import logging
+import subprocess
+from datetime import datetime as dt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ledger import fingerprint
+
+TRANSCODE_DIR = '.transcoded'
+
+# copy the streams into a new mp4 container without re-encoding them
+REMUX = 'remux'
+
+# left in a row's directory when its output wasn't worth sending
+ORIGINAL_MARKER = 'use-original'
+
+# audio bitrate of re-encoded videos
+AUDIO_BITRATE = '128k'
+
+
+def find_ffmpeg(path=None):
+    '''
+    Full path of the ffmpeg binary, `path` if it was given and is runnable.
+
+    Returns
+    -------
+    string or None
+        None if there isn't one.
+    '''
+    return shutil.which(path or 'ffmpeg')
+
+
+def is_valid_profile(arg):
+    '''
+    Whether `arg` is `REMUX` or a video bitrate ffmpeg takes, e.g. 2500k or 4M.
+    '''
+    return arg == REMUX or re.fullmatch(r'\d+(\.\d+)?[kKmM]?', arg) is not None
+
+
+def ffmpeg_command(ffmpeg, src, dst, profile=REMUX, threads=1):
+    '''
+    Arguments to run ffmpeg with to convert `src` into the mp4 `dst`.
+
+    Parameters
+    ----------
+    ffmpeg : string
+        Path of the binary.
+    src, dst : string
+        Paths of the source and the output.
+    profile : string
+        `REMUX` or the bitrate to re-encode the video at.
+    threads : int
+        Threads each ffmpeg may use, the pool already keeps every core busy.
+
+    Returns
+    -------
+    list
+    '''
+    cmd = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+           '-i', src]
+    if profile == REMUX:
+        cmd += ['-c', 'copy']
+    else:
+        bufsize = re.sub(r'^\d+(\.\d+)?',
+                         lambda m: f'{float(m.group()) * 2:g}', profile)
+        cmd += ['-c:v', 'libx264', '-b:v', profile, '-maxrate', profile,
+                '-bufsize', bufsize, '-pix_fmt', 'yuv420p',
+                '-c:a', 'aac', '-b:a', AUDIO_BITRATE]
+    # the index goes at the front so YouTube can start processing sooner
+    cmd += ['-threads', str(threads), '-movflags', '+faststart', '-f', 'mp4',
+            dst]
+    return cmd
+
+
+def convert(ffmpeg, src, directory, profile=REMUX, threads=1):
+    '''
+    Convert one video into `directory`, run in a worker process.
+
+    Returns
+    -------
+    string
+        Path of the file to upload, `src` if the output wasn't smaller.
+    '''
+    if os.path.exists(os.path.join(directory, ORIGINAL_MARKER)):
+        return src
+    name = os.path.splitext(os.path.basename(src))[0] + '.mp4'
+    dst = os.path.join(directory, name)
+    if os.path.exists(dst):
+        return dst
+    os.makedirs(directory, exist_ok=True)
+    # written under another name first so only finished outputs are found
+    partial = os.path.join(directory, '.partial.mp4')
+    subprocess.run(ffmpeg_command(ffmpeg, src, partial, profile, threads),
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.PIPE)
+    if os.path.getsize(partial) >= os.path.getsize(src):
+        os.remove(partial)
+        open(os.path.join(directory, ORIGINAL_MARKER), 'w').close()
+        return src
+    os.replace(partial, dst)
+    return dst
+
+
+class Transcoder:
+    '''
+    Pool of processes converting videos ahead of their uploads.
+
+    Parameters
+    ----------
+    ffmpeg : string
+        Path of the binary, see `find_ffmpeg`.
+    profile : string
+        `REMUX` or the bitrate to re-encode the video at.
+    workers : int, optional
+        Videos converted at the same time, one per core by default.
+    directory : string
+        Where converted videos are kept.
+    '''
+
+    def __init__(self, ffmpeg, profile=REMUX, workers=None,
+                 directory=TRANSCODE_DIR):
+        self.ffmpeg = ffmpeg
+        self.profile = profile
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self.directory = directory
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.futures = {}
+
+    def submit(self, uid, info):
+        '''
+        Start converting a row's file, unless it already has been.
+
+        Parameters
+        ----------
+        uid : string
+            UID of the row.
+        info : FileInfo
+            Of the source, from `validate_files`.
+        '''
+        if uid in self.futures:
+            return
+        # the sha256 is only missing when hashing was turned off
+        key = info.sha256 or fingerprint(info.path)
+        directory = os.path.join(self.directory, f'{key}-{self.profile}')
+        self.futures[uid] = self.pool.submit(convert, self.ffmpeg, info.path,
+                                             directory, self.profile,
+                                             self.threads)
+
+    def ahead(self, jobs, files):
+        '''
+        Pass (uid, job) pairs through in the same order, starting the
+        conversion of each row as many rows ahead of its upload as there are
+        processes in the pool.
+
+        Parameters
+        ----------
+        jobs : iterable
+            (uid, job) pairs in the order they're uploaded.
+        files : dict
+            UID -> FileInfo of every row, from `validate_files`.
+
+        Yields
+        ------
+        (uid, job)
+        '''
+        queued = deque()
+        for uid, job in jobs:
+            self.submit(uid, files[uid])
+            queued.append((uid, job))
+            if len(queued) > self.workers:
+                yield queued.popleft()
+        yield from queued
+
+    def result(self, uid, path):
+        '''
+        Path of the file to upload for the row, waiting for its conversion
+        if that's still going. Falls back to the original `path` if the row
+        wasn't submitted or the conversion failed.
+        '''
+        future = self.futures.pop(uid, None)
+        if future is None:
+            return path
+        try:
+            return future.result()
+        except Exception as e:
+            detail = getattr(e, 'stderr', None) or e
+            if isinstance(detail, bytes):
+                detail = detail.decode(errors='replace').strip()
+            print (f"UID: <{uid}> couldn't be converted, sending the "
+                   "original.")
+            logging.warning('%s -- UID: %s conversion failed: %s', dt.now(),
+                            uid, detail)
+            return path
+
+    def remove(self, path):
+        '''
+        Delete a converted file once its upload is recorded, along with its
+        directory. Anything outside the directory of converted videos, such
+        as an original sent because converting it didn't help, is left.
+        '''
+        directory = os.path.dirname(os.path.abspath(path))
+        if os.path.dirname(directory) != os.path.abspath(self.directory):
+            return
+        try:
+            os.remove(path)
+            os.rmdir(directory)
+        except OSError as e:
+            logging.warning('%s -- %s not removed: %r', dt.now(), path, e)
+
+    def discard(self, uid):
+        '''
+        Forget a row that won't be uploaded from here after all, deleting
+        whatever was converted for it.
+        '''
+        future = self.futures.pop(uid, None)
+        if future is None or future.cancel():
+            return
+        future.add_done_callback(
+            lambda f: f.exception() is None and self.remove(f.result()))
+
+    def close(self):
+        '''
+        Stop the pool, dropping conversions that haven't started.
+        '''
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.pool.shutdown()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Runs several uploads at once in a pool of threads. `httplib2.Http` isn't
+thread-safe so every worker thread builds its own authorized service the first
+time it picks up a job and keeps it for the rest of the run. The threads live
+as long as the engine, so a caller running batch after batch only pays for the
+services once. The results of every job are collected on the engine, keyed by
+the job's UID.
+
+@author: rick
+"""
+
+import logging
+import threading
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from shaping import Shaper
+
+
+class UploadEngine:
+    '''
+    Bounded pool of upload workers.
+
+    Parameters
+    ----------
+    connect : callable
+        Called with no arguments once in each worker thread to build that
+        thread's authenticated YouTube service.
+    workers : int
+        Number of uploads to run at the same time.
+    max_rate : float, optional
+        Cap on the bytes per second sent by the whole run.
+    shaper : Shaper, optional
+        Limits to follow instead of `max_rate`, see shaping.py.
+    '''
+
+    def __init__(self, connect, workers=4, max_rate=None, shaper=None):
+        self.connect = connect
+        self.workers = workers
+        self.shaper = shaper or Shaper(max_rate)
+        self.local = threading.local()
+        self.results = {}
+        self.pool = None
+
+    def service(self):
+        '''
+        The authenticated service belonging to the calling thread.
+        '''
+        if getattr(self.local, 'youtube', None) is None:
+            self.local.youtube = self.connect()
+        return self.local.youtube
+
+    def progress(self):
+        '''
+        Build a callback for `resumable_upload` that holds each upload to
+        the rate limits.
+        '''
+        if not self.shaper.active:
+            return None
+        return self.shaper.progress()
+
+    def _work(self, upload, job):
+        return upload(self.service(), job, self.progress())
+
+    def run(self, jobs, upload):
+        '''
+        Upload every job, never holding more than twice the worker count of
+        jobs in memory so a generator of jobs is consumed lazily.
+
+        Parameters
+        ----------
+        jobs : iterable
+            (uid, job) pairs.
+        upload : callable
+            Called as `upload(youtube, job, progress)` in a worker thread,
+            whatever it returns is stored as the result for that uid.
+
+        Returns
+        -------
+        results : dict
+            uid -> return value of `upload`, or the exception it raised.
+        '''
+        pending = {}
+        jobs = iter(jobs)
+        self.results = {}
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        while True:
+            for uid, job in jobs:
+                pending[self.pool.submit(self._work, upload, job)] = uid
+                if len(pending) >= self.workers * 2:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                uid = pending.pop(future)
+                try:
+                    self.results[uid] = future.result()
+                except Exception as e:
+                    logging.error('%s -- UID: %s raised %r', dt.now(),
+                                  uid, e)
+                    self.results[uid] = e
+        return self.results
+
+    def close(self):
+        '''
+        Stop the worker threads once the jobs they have are done.
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -2,20 +2,30 @@
 
 #!/usr/bin/python
 
-import http.client
 import httplib2
 import os
 import random
 import sys
 import time
+import threading
+from argparse import Namespace
+from collections import namedtuple
+from datetime import datetime, timedelta
 
 from apiclient.discovery import build
 from apiclient.errors import HttpError
-from apiclient.http import MediaFileUpload
-from oauth2client.client import flow_from_clientsecrets
+from apiclient.http import MediaFileUpload, build_http
+from googleapiclient.discovery_cache.base import Cache
+from oauth2client.client import flow_from_clientsecrets, AccessTokenRefreshError
 from oauth2client.file import Storage
 from oauth2client.tools import argparser, run_flow
 
+from chunking import AdaptiveChunker, DEFAULT_CHUNKSIZE
+from errors import (classify, UploadError, RETRY, REAUTH, DEFER, FAIL,
+                    RETRIABLE_EXCEPTIONS)
+from media import MappedMedia
+from pipeline import PipelineMedia
+
 
 # Explicitly tell the underlying HTTP transport library not to retry, since
 # we are handling retry logic ourselves.
@@ -24,15 +34,12 @@ httplib2.RETRIES = 1
 # Maximum number of times to retry before giving up.
 MAX_RETRIES = 10
 
-# Always retry when these exceptions are raised.
-RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, http.client.NotConnected,
-  http.client.IncompleteRead, http.client.ImproperConnectionState,
-  http.client.CannotSendRequest, http.client.CannotSendHeader,
-  http.client.ResponseNotReady, http.client.BadStatusLine)
+# Which errors are retried is decided in errors.py, along with what to do
+# about the rest.
 
-# Always retry when an apiclient.errors.HttpError with one of these status
-# codes is raised.
-RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+# Chunk size used when the upload rate is capped, the throttle can only pause
+# between chunks so the whole file can't go in a single request.
+CHUNKSIZE = DEFAULT_CHUNKSIZE
 
 # The CLIENT_SECRETS_FILE variable specifies the name of a file that contains
 # the OAuth 2.0 information for this application, including its client_id and
@@ -49,6 +56,10 @@ CLIENT_SECRETS_FILE = "client_secrets.json"
 # This OAuth 2.0 access scope allows an application to upload files to the
 # authenticated user's YouTube channel, but doesn't allow other types of access.
 YOUTUBE_UPLOAD_SCOPE = "https://www.googleapis.com/auth/youtube.upload"
+YOUTUBE_READONLY_SCOPE = "https://www.googleapis.com/auth/youtube.readonly"
+YOUTUBE_SCOPES = [YOUTUBE_UPLOAD_SCOPE, YOUTUBE_READONLY_SCOPE]
+# Editing videos after they're up needs full access to the channel.
+YOUTUBE_MANAGE_SCOPE = "https://www.googleapis.com/auth/youtube"
 YOUTUBE_API_SERVICE_NAME = "youtube"
 YOUTUBE_API_VERSION = "v3"
 
@@ -72,22 +83,137 @@ https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
 
 VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
 
+# Every script shares the one token store, this is the name it had back when
+# the table drivers called this file in a subprocess.
+CREDENTIALS_FILE = "upload_video.py-oauth2.json"
+
+# Access tokens expiring within this window are refreshed before an upload
+# starts so that a long upload never has to stop for a refresh.
+REFRESH_MARGIN = timedelta(minutes=15)
+
+# Discovery documents are saved here and reused for a week so building the
+# service doesn't need a round trip to Google.
+DISCOVERY_CACHE_DIR = ".discovery"
+DISCOVERY_CACHE_AGE = 7 * 24 * 60 * 60
+
+# Options used when uploading from a table rather than the command line, these
+# include the flags that run_flow expects if the user needs to authorize.
+DEFAULT_OPTIONS = dict(auth_host_name='localhost',
+                       auth_host_port=[8080, 8090],
+                       category='28', # 28 is Science & Technology
+                       description='',
+                       file=None,
+                       keywords='',
+                       logging_level='ERROR',
+                       noauth_local_webserver=False,
+                       privacyStatus='unlisted',
+                       title='',
+                       chunksize=-1,
+                       adaptive=False,
+                       pipeline=False,
+                       mmap=False,
+                       sha256=None)
+
+
+class UploadResult(namedtuple('UploadResult',
+                              'uid video_id bytes_sent error')):
+  """Outcome of uploading one row, `error` is None when it succeeded."""
+
+  @property
+  def ok(self):
+    return self.error is None
+
+
+class DiscoveryCache(Cache):
+  """On disk cache of discovery documents, keyed by their url."""
+
+  def __init__(self, directory=DISCOVERY_CACHE_DIR, max_age=DISCOVERY_CACHE_AGE):
+    self.directory = directory
+    self.max_age = max_age
+    self.memory = {}
+
+  def _path(self, url):
+    name = "".join(c if c.isalnum() else "_" for c in url)
+    return os.path.join(self.directory, name + ".json")
+
+  def get(self, url):
+    if url in self.memory:
+      return self.memory[url]
+    path = self._path(url)
+    try:
+      if time.time() - os.path.getmtime(path) > self.max_age:
+        return None
+      with open(path) as f:
+        content = f.read()
+    except (IOError, OSError):
+      return None
+    self.memory[url] = content
+    return content
+
+  def set(self, url, content):
+    self.memory[url] = content
+    if not os.path.exists(self.directory):
+      os.mkdir(self.directory)
+    path = self._path(url)
+    with open(path + ".tmp", "w") as f:
+      f.write(content if isinstance(content, str) else content.decode())
+    os.replace(path + ".tmp", path)
+
+_discovery_cache = DiscoveryCache()
 
-def get_authenticated_service(args):
-  flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
-    scope=YOUTUBE_UPLOAD_SCOPE,
-    message=MISSING_CLIENT_SECRETS_MESSAGE)
+# Credentials are loaded once per process for each token store and shared by
+# every service built from them, each service still gets its own Http since it
+# isn't thread-safe.
+_credentials = {}
+_credentials_lock = threading.Lock()
 
-  storage = Storage("%s-oauth2.json" % sys.argv[0])
-  credentials = storage.get()
+def refresh_if_expiring(credentials, margin=REFRESH_MARGIN):
+  expiry = credentials.token_expiry
+  if expiry is None or expiry - datetime.utcnow() < margin:
+    credentials.refresh(httplib2.Http())
+
+# Refresh every token in use, `force` refreshes them even if they're fresh,
+# for when YouTube has turned one down anyway.
+def refresh_credentials(force=False):
+  with _credentials_lock:
+    for credentials in _credentials.values():
+      if force:
+        credentials.refresh(httplib2.Http())
+      else:
+        refresh_if_expiring(credentials)
 
-  if credentials is None or credentials.invalid:
-    credentials = run_flow(flow, storage, args)
+# `secrets_file` and `credentials_file` pick the OAuth client, and with it the
+# project whose quota is spent, see projects.py.
+def get_credentials(args, scopes=YOUTUBE_SCOPES,
+                    secrets_file=CLIENT_SECRETS_FILE,
+                    credentials_file=CREDENTIALS_FILE):
+  with _credentials_lock:
+    credentials = _credentials.get(credentials_file)
+    if (credentials is None or credentials.invalid or
+        not credentials.has_scopes(scopes)):
+      storage = Storage(credentials_file)
+      credentials = storage.get()
+      if (credentials is None or credentials.invalid or
+          not credentials.has_scopes(scopes)):
+        flow = flow_from_clientsecrets(secrets_file,
+          scope=scopes,
+          message=MISSING_CLIENT_SECRETS_MESSAGE)
+        credentials = run_flow(flow, storage, args)
+      _credentials[credentials_file] = credentials
+    refresh_if_expiring(credentials)
+    return credentials
 
+# build_http() keeps httplib2 from treating the 308s of a resumable upload as
+# redirects.
+def get_authenticated_service(args, secrets_file=CLIENT_SECRETS_FILE,
+                              credentials_file=CREDENTIALS_FILE,
+                              scopes=YOUTUBE_SCOPES):
+  credentials = get_credentials(args, scopes, secrets_file, credentials_file)
   return build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-    http=credentials.authorize(httplib2.Http()))
+    http=credentials.authorize(build_http()), cache=_discovery_cache)
 
-def initialize_upload(youtube, options):
+def initialize_upload(youtube, options, progress=None, session=None,
+                      metrics=None):
   tags = None
   if options.keywords:
     tags = options.keywords.split(",")
@@ -104,6 +230,25 @@ def initialize_upload(youtube, options):
     )
   )
 
+  # With adaptive chunking the size given is only where the chunker starts.
+  chunker = None
+  chunksize = getattr(options, "chunksize", -1)
+  if getattr(options, "adaptive", False):
+    chunker = AdaptiveChunker(chunksize if chunksize > 0 else DEFAULT_CHUNKSIZE)
+    chunksize = chunker.size
+
+  # The pipeline reads and hashes the next chunk while this one is sent, and
+  # a mapped file only maps the chunk being sent, so both always send in
+  # chunks.
+  if getattr(options, "pipeline", False):
+    media = PipelineMedia(options.file,
+      chunksize if chunksize > 0 else DEFAULT_CHUNKSIZE)
+  elif getattr(options, "mmap", False):
+    media = MappedMedia(options.file,
+      chunksize if chunksize > 0 else DEFAULT_CHUNKSIZE)
+  else:
+    media = MediaFileUpload(options.file, chunksize=chunksize, resumable=True)
+
   # Call the API's videos.insert method to create and upload the video.
   insert_request = youtube.videos().insert(
     part=",".join(list(body.keys())),
@@ -119,46 +264,151 @@ def initialize_upload(youtube, options):
     # practice, but if you're using Python older than 2.6 or if you're
     # running on App Engine, you should set the chunksize to something like
     # 1024 * 1024 (1 megabyte).
-    media_body=MediaFileUpload(options.file, chunksize=-1, resumable=True)
+    media_body=media
   )
 
-  resumable_upload(insert_request)
+  if isinstance(media, MediaFileUpload):
+    return resumable_upload(insert_request, progress, chunker, session, metrics)
+  try:
+    response = resumable_upload(insert_request, progress, chunker, session,
+                                metrics)
+  finally:
+    media.close()
+  expected = getattr(options, "sha256", None)
+  streamed = getattr(media, "sha256", None)
+  if expected and streamed and streamed != expected:
+    print("WARNING: %s changed while it was being uploaded, video id '%s' "
+          "may not match the file." % (options.file, response['id']))
+  return response
 
 # This method implements an exponential backoff strategy to resume a
-# failed upload.
-def resumable_upload(insert_request):
+# failed upload. What is done about each error is decided by
+# errors.classify: retriable ones are sent again, a turned down token is
+# refreshed once, and the rest are raised for the caller to deal with.
+# `progress` is called with the upload status after every chunk that is sent.
+# `chunker` resizes every chunk before it is sent, and `session` (see
+# ledger.UploadSession) keeps the session URI and confirmed offset so that an
+# upload from a process that died can pick up where it stopped. `metrics` (see
+# metrics.UploadMetrics) is told about every chunk and retry.
+def resumable_upload(insert_request, progress=None, chunker=None, session=None,
+                     metrics=None):
   response = None
-  error = None
   retry = 0
+  reauthorized = False
+  outcome = None
+  resumed = session is not None and session.uri is not None
+  if resumed:
+    insert_request.resumable_uri = session.uri
+    insert_request.resumable_progress = session.offset
+    # makes the client ask the server for the offset it really has before
+    # sending anything
+    insert_request._in_error_state = True
   while response is None:
+    error = None
+    if chunker is not None:
+      # MediaFileUpload has no setter, it reads this on every next_chunk()
+      insert_request.resumable._chunksize = chunker.size
+    sent = insert_request.resumable_progress
+    started = time.time()
+    if metrics is not None and insert_request.resumable_uri is None:
+      # the first chunk also makes the call that opens the session
+      metrics.call()
     try:
       print("Uploading file...")
       status, response = insert_request.next_chunk()
+      if chunker is not None:
+        chunker.success(insert_request.resumable_progress - sent,
+                        time.time() - started)
+      if metrics is not None:
+        # a finished upload leaves resumable_progress at the last chunk
+        done = (insert_request.resumable.size() if response is not None
+                else insert_request.resumable_progress)
+        metrics.chunk(done - sent, time.time() - started)
+      if session is not None and response is None:
+        session.save(insert_request.resumable_uri,
+                     insert_request.resumable_progress)
+      if progress is not None and status is not None:
+        progress(status)
+      if status is not None:
+        retry = 0
       if response is not None:
         if 'id' in response:
           print("Video id '%s' was successfully uploaded." % response['id'])
         else:
-          exit("The upload failed with an unexpected response: %s" % response)
-    except HttpError as e:
-      if e.resp.status in RETRIABLE_STATUS_CODES:
+          raise UploadError("The upload failed with an unexpected "
+                            "response: %s" % response, "unexpected_response",
+                            FAIL)
+    except (HttpError, AccessTokenRefreshError) + RETRIABLE_EXCEPTIONS as e:
+      outcome = classify(e)
+      if outcome.action == REAUTH and not reauthorized:
+        refresh_credentials(force=True)
+        reauthorized = True
+        error = "The access token was turned down, refreshed it (%s)" % (
+          outcome.detail)
+      elif outcome.action != RETRY:
+        raise
+      elif outcome.kind == "session_expired":
+        if insert_request.resumable_uri is None:
+          raise
+        # the session is gone on YouTube's end, start the file over in a new
+        # one
+        if session is not None:
+          session.clear()
+        insert_request.resumable_uri = None
+        insert_request.resumable_progress = 0
+        insert_request._in_error_state = False
+        error = "The resumable session has expired, starting over."
+      elif isinstance(e, HttpError):
         error = "A retriable HTTP error %d occurred:\n%s" % (e.resp.status,
                                                              e.content)
       else:
-        raise
-    except RETRIABLE_EXCEPTIONS as e:
-      error = "A retriable error occurred: %s" % e
+        error = "A retriable error occurred: %s" % e
 
     if error is not None:
       print(error)
+      if chunker is not None:
+        chunker.failure()
+      if session is not None and insert_request.resumable_uri is not None:
+        session.save(insert_request.resumable_uri,
+                     insert_request.resumable_progress)
       retry += 1
       if retry > MAX_RETRIES:
-        exit("No longer attempting to retry.")
+        # whatever kept failing may well have cleared up by the next run
+        raise UploadError("No longer attempting to retry.", outcome.kind,
+                          DEFER)
 
       max_sleep = 2 ** retry
       sleep_seconds = random.random() * max_sleep
       print("Sleeping %f seconds and then retrying..." % sleep_seconds)
+      if metrics is not None:
+        metrics.retry(sleep_seconds)
       time.sleep(sleep_seconds)
 
+  if session is not None:
+    session.clear()
+  return response
+
+def upload_options(**kwargs):
+  """Build the options for one upload, anything not given uses the defaults."""
+  options = dict(DEFAULT_OPTIONS)
+  options.update(kwargs)
+  return Namespace(**options)
+
+def upload_row(youtube, uid, options, progress=None, session=None,
+               metrics=None):
+  """
+  Upload a single row of a table with an already authenticated service.
+  HttpErrors, failed uploads and files that can't be read are handed back in
+  the result rather than raised so the caller can decide what to do with the
+  rest of the table, see errors.classify.
+  """
+  try:
+    refresh_credentials()
+    response = initialize_upload(youtube, options, progress, session, metrics)
+  except (HttpError, UploadError, AccessTokenRefreshError, OSError) as e:
+    return UploadResult(uid, None, 0, e)
+  return UploadResult(uid, response['id'], os.path.getsize(options.file), None)
+
 if __name__ == '__main__':
   argparser.add_argument("--file", required=True, help="Video file to upload")
   argparser.add_argument("--title", help="Video title", default="Test Title")
@@ -171,6 +421,10 @@ if __name__ == '__main__':
     default="")
   argparser.add_argument("--privacyStatus", choices=VALID_PRIVACY_STATUSES,
     default=VALID_PRIVACY_STATUSES[0], help="Video privacy status.")
+  argparser.add_argument("--pipeline", action="store_true",
+    help="Read the next chunk from disk while sending the current one")
+  argparser.add_argument("--mmap", action="store_true",
+    help="Send chunks straight from a memory map of the file")
   args = argparser.parse_args()
 
   if not os.path.exists(args.file):
@@ -180,4 +434,7 @@ if __name__ == '__main__':
   try:
     initialize_upload(youtube, args)
   except HttpError as e:
-    print("An HTTP error %d occurred:\n%s" % (e.resp.status, e.content))
\ No newline at end of file
+    print("An HTTP error %d occurred:\n%s" % (e.resp.status, e.content))
+    sys.exit(1)
+  except UploadError as e:
+    exit(str(e))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Checks every video named in the table before any uploads begin. The files
+are looked at in a pool of threads since they usually sit on network drives,
+and every file that is missing or can't be read is reported together rather
+than one per run. The size, modification time and SHA-256 of each file are
+kept in a cache keyed by path so the videos are only read in full once for as
+long as they don't change.
+
+@author: rick
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_FILE = '.file_cache.sqlite'
+
+# bytes read at a time when hashing
+BLOCK_SIZE = 1024 * 1024
+
+# files looked at the same time
+WORKERS = 16
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS files (
+        path    TEXT PRIMARY KEY,
+        size    INTEGER,
+        mtime   INTEGER,
+        sha256  TEXT
+    )'''
+
+FileInfo = namedtuple('FileInfo', 'path size mtime sha256 error')
+
+
+def sha256(path):
+    '''
+    Hash the whole file a block at a time.
+
+    Parameters
+    ----------
+    path : string
+        Absolute path to the video file.
+
+    Returns
+    -------
+    string
+        Hex digest of the contents.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FileCache:
+    '''
+    Size, mtime and hash of files already seen, only trusted while the size
+    and mtime on disk still match.
+    '''
+
+    def __init__(self, fn=CACHE_FILE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def get(self, path, size, mtime):
+        with self.lock:
+            cur = self.conn.execute('SELECT sha256 FROM files WHERE path = ? '
+                                    'AND size = ? AND mtime = ?',
+                                    (path, size, mtime))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def set(self, path, size, mtime, digest):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES '
+                              '(?, ?, ?, ?)', (path, size, mtime, digest))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def inspect_file(path, cache=None, hash_file=True):
+    '''
+    Stat a single file and hash it unless the cache already knows the hash.
+
+    Parameters
+    ----------
+    path : string
+        Absolute path to the video file.
+    cache : FileCache, optional
+        Where hashes are looked up and saved.
+    hash_file : bool
+        Read the whole file to hash it, otherwise only check it can be opened.
+
+    Returns
+    -------
+    FileInfo
+        `error` holds the reason the file can't be used, None if it's fine.
+    '''
+    try:
+        st = os.stat(path)
+        digest = cache.get(path, st.st_size, st.st_mtime_ns) if cache else None
+        if digest is None and hash_file:
+            digest = sha256(path)
+            if cache is not None:
+                cache.set(path, st.st_size, st.st_mtime_ns, digest)
+        elif digest is None:
+            with open(path, 'rb') as f:
+                f.read(1)
+    except (OSError, IOError, TypeError, ValueError) as e:
+        return FileInfo(path, None, None, None, e)
+    return FileInfo(path, st.st_size, st.st_mtime_ns, digest, None)
+
+
+def validate_files(paths, hash_files=True, workers=WORKERS, fn=CACHE_FILE):
+    '''
+    Inspect every file at once in a pool of threads.
+
+    Parameters
+    ----------
+    paths : Series or dict
+        Paths to the videos keyed by UID.
+    hash_files : bool
+        Hash the contents of any file not already in the cache.
+    workers : int
+        Number of files looked at the same time.
+    fn : string
+        Location of the cache.
+
+    Returns
+    -------
+    files : dict
+        UID -> FileInfo, in the same order as `paths`.
+    '''
+    cache = FileCache(fn)
+    uids, locations = zip(*paths.items()) if len(paths) else ((), ())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        infos = pool.map(lambda p: inspect_file(p, cache, hash_files),
+                         locations)
+        files = dict(zip(uids, infos))
+    cache.close()
+    return files
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps uploading as new footage turns up instead of being run by hand for each
+table. The inventory table is read again whenever it's saved, and videos
+copied into a drop folder are picked up once they have stopped growing, so
+new field footage goes out within a poll or two of landing. Only rows that
+are new or whose file has changed since the last look are handed to the
+uploader, which is kept between batches along with its authorized services,
+the ledger, the channel index and the quota count, so there's no start-up
+cost after the first batch. Stop it with Ctrl-C or SIGTERM, the batch being
+uploaded is finished first.
+
+Videos in the drop folder don't need a row in the table: the file name is
+used as the UID and the title, the folder name as the StudyName and the day
+the file was written as the date collected.
+
+Example:
+     $ python watch.py --table table.xlsx --drop /data/dvr/incoming --workers 4
+
+@author: rick
+"""
+
+import os
+import sys
+import time
+import signal
+import getpass
+import logging
+import threading
+from datetime import datetime as dt
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from bulk_upload_video import BulkUploader, TITLE, TEXT, read_template
+from leases import Leases
+from projects import ProjectPool
+from scheduler import POLICIES
+from shaping import Shaper, parse_window
+from quota import DAILY_BUDGET
+from table import read_table
+from templates import VideoText, TemplateError
+from transcode import find_ffmpeg, is_valid_profile, REMUX
+from validate import validate_files
+
+# seconds between looks at the table and the drop folder
+POLL_SECONDS = 60
+
+# seconds before a row that failed to upload is tried again
+RETRY_SECONDS = 60 * 60
+
+# files in the drop folder that are taken to be videos
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.avi', '.mkv', '.mpg', '.mpeg',
+                    '.wmv')
+
+
+class DropFolder:
+    '''
+    Videos copied into a directory, each one only reported once its size and
+    modification time are the same on two looks in a row so that files still
+    being copied in are left alone.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.last = {}
+
+    def scan(self):
+        '''
+        Rows for every video in the folder that has settled.
+
+        Returns
+        -------
+        DataFrame
+            Laid out like the table from `read_table`.
+        '''
+        now = {}
+        rows = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or \
+                    not entry.name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            st = entry.stat()
+            now[entry.path] = (st.st_size, st.st_mtime_ns)
+            if self.last.get(entry.path) != now[entry.path]:
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            rows.append(dict(UID=stem, NewforMapViewer='yes',
+                             Path=os.path.abspath(entry.path),
+                             DateCollected=dt.fromtimestamp(st.st_mtime),
+                             StudyName=os.path.basename(
+                                 os.path.abspath(self.directory)),
+                             **{'Youtube name': stem}))
+        self.last = now
+        tbl = pd.DataFrame(rows, columns=['UID', 'NewforMapViewer', 'Path',
+                                          'DateCollected', 'StudyName',
+                                          'Youtube name'])
+        return tbl.set_index('UID', drop=False)
+
+
+class Watcher:
+    '''
+    Polls the table and the drop folder and uploads what has changed.
+
+    Parameters
+    ----------
+    uploader : BulkUploader
+        Kept for as long as the watcher runs.
+    table : string, optional
+        Path of the inventory table to watch.
+    drop : string, optional
+        Directory to watch for new videos.
+    interval : float
+        Seconds between polls.
+    title, description : string
+        Templates of the titles and descriptions.
+    hash_files : bool
+        Hash files that haven't been seen before, see `validate_files`.
+    track : bool
+        Check how YouTube's processing of the uploads went, putting the ones
+        that failed back in the queue.
+    '''
+
+    def __init__(self, uploader, table=None, drop=None, interval=POLL_SECONDS,
+                 title=TITLE, description=TEXT, hash_files=True, track=True):
+        self.uploader = uploader
+        self.table = table
+        self.drop = DropFolder(drop) if drop else None
+        self.interval = interval
+        self.title = title
+        self.description = description
+        self.hash_files = hash_files
+        self.track = track
+        self.stopped = threading.Event()
+        self.table_stamp = None
+        self.tbl = None
+        # UID -> (path, size, mtime) of every row that has been dealt with,
+        # keyed by the UID as a string like the ledger, the table's may be
+        # numbers
+        self.seen = {}
+        # UID -> (path, size, mtime, time it failed)
+        self.failed = {}
+        # problems already reported, so they aren't logged on every poll
+        self.reported = set()
+
+    def _report(self, uid, problem):
+        if (uid, problem) in self.reported:
+            return
+        self.reported.add((uid, problem))
+        print (f"UID: <{uid}> {problem}, leaving it for now.")
+        logging.warning('UID: %s -- %s', uid, problem)
+
+    def _read_table(self):
+        '''
+        The rows of the table, read again only when it has been saved.
+        '''
+        try:
+            st = os.stat(self.table)
+        except OSError as e:
+            self._report('-', f"table can't be read: {e}")
+            return self.tbl
+        if (st.st_mtime_ns, st.st_size) != self.table_stamp:
+            try:
+                self.tbl = read_table(self.table)
+                self.table_stamp = (st.st_mtime_ns, st.st_size)
+            except Exception as e:
+                # most likely caught halfway through being saved
+                self._report('-', f"table can't be read yet: {e!r}")
+        return self.tbl
+
+    def rows(self):
+        '''
+        Every row from the table and the drop folder, the table wins when a
+        UID or a file is in both.
+        '''
+        frames = []
+        if self.table:
+            tbl = self._read_table()
+            if tbl is not None:
+                frames.append(tbl)
+        if self.drop is not None:
+            dropped = self.drop.scan()
+            if frames:
+                known = set(frames[0].UID.astype(str)) | set(frames[0].Path)
+                dropped = dropped.loc[~dropped.UID.isin(known)
+                                      & ~dropped.Path.isin(known)]
+            frames.append(dropped)
+        if not frames:
+            return None
+        rows = pd.concat(frames) if len(frames) > 1 else frames[0]
+        return rows.loc[~rows.index.duplicated()]
+
+    def pending(self):
+        '''
+        Rows that are new or have changed since they were last dealt with,
+        along with their files and text.
+
+        Returns
+        -------
+        tuple or None
+            (rows, files, text) or None if there's nothing to do.
+        '''
+        rows = self.rows()
+        if rows is None or rows.empty:
+            return None
+        files = validate_files(rows.Path, self.hash_files)
+        keep = []
+        for uid, info in files.items():
+            if info.error is not None:
+                self._report(uid, f"file can't be read: {info.error}")
+                continue
+            stamp = (info.path, info.size, info.mtime)
+            if self.seen.get(str(uid)) == stamp:
+                continue
+            failed = self.failed.get(str(uid))
+            if failed and failed[:3] == stamp and \
+                    time.time() - failed[3] < RETRY_SECONDS:
+                continue
+            keep.append(uid)
+        if not keep:
+            return None
+        rows = rows.loc[keep]
+        try:
+            text = VideoText(rows, self.title, self.description)
+        except TemplateError as e:
+            self._report('-', str(e))
+            return None
+        for uid, problem in text.problems.items():
+            self._report(uid, problem)
+        rows = rows.loc[[uid for uid in keep if uid not in text.problems]]
+        if rows.empty:
+            return None
+        return rows, {uid: files[uid] for uid in rows.index}, text
+
+    def poll(self):
+        '''
+        Upload whatever has changed, returns the number of rows looked at.
+        '''
+        if self.track:
+            for uid in self.uploader.check_processing():
+                # so it's picked up again below
+                self.seen.pop(str(uid), None)
+                self.failed.pop(str(uid), None)
+        found = self.pending()
+        if found is None:
+            return 0
+        rows, files, text = found
+        print (f'{dt.now():%Y-%m-%d %H:%M} -- {len(rows)} new or changed '
+               'rows, uploading...')
+        logging.info('%s -- %d new or changed rows', dt.now(), len(rows))
+        results = self.uploader.upload(rows, files, text)
+        for uid, info in files.items():
+            stamp = (info.path, info.size, info.mtime)
+            result = results.get(uid)
+            if result is not None and (isinstance(result, Exception)
+                                       or not result.ok):
+                self.failed[str(uid)] = stamp + (time.time(),)
+            else:
+                # uploaded, or skipped as already up
+                self.seen[str(uid)] = stamp
+                self.failed.pop(str(uid), None)
+        self.uploader.metrics.summary()
+        return len(rows)
+
+    def run(self):
+        '''
+        Poll until `stop` is called.
+        '''
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def stop(self, *args):
+        print ('Stopping once the current uploads are done...')
+        logging.info('%s -- Stop requested', dt.now())
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='watch.py')
+    parser.add_argument('--table', default=None,
+                        help='inventory table to upload from as it changes')
+    parser.add_argument('--drop', default=None,
+                        help='directory new videos are copied into')
+    parser.add_argument('--interval', type=float, default=POLL_SECONDS,
+                        help='seconds between looks for new videos')
+    parser.add_argument('--workdir', default=None,
+                        help='where the ledger, caches and .logging/ live, '
+                        "the script's own directory by default")
+    parser.add_argument('--quota', type=int, default=DAILY_BUDGET,
+                        help='daily quota units available to the project')
+    parser.add_argument('--projects', default=None,
+                        help='JSON file listing the projects to spread '
+                        'uploads over, see projects.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of videos to upload at the same time')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='cap on the upload rate in MB/s')
+    parser.add_argument('--upload-rate', type=float, default=None,
+                        help='cap on the rate of each upload in MB/s')
+    parser.add_argument('--window', action='append', default=[],
+                        metavar='HH:MM-HH:MM=RATE',
+                        help='different cap for part of the day, in MB/s or '
+                        'as a percentage of --max-rate, e.g. 08:00-18:00=20%%')
+    parser.add_argument('--limits', default=None,
+                        help="JSON file of rate limits, read again whenever "
+                        "it's saved, see shaping.py")
+    parser.add_argument('--order', choices=POLICIES, default='table',
+                        help='order the rows of each batch go in, see '
+                        'scheduler.py')
+    parser.add_argument('--transcode', default=None, metavar='PROFILE',
+                        help="'remux' or a video bitrate such as 2500k, "
+                        'see transcode.py')
+    parser.add_argument('--ffmpeg', default=None,
+                        help='ffmpeg binary used by --transcode')
+    parser.add_argument('--title-template', default=TITLE,
+                        help='title of each video, {fields} are columns of '
+                        'the table')
+    parser.add_argument('--description-template', default=None,
+                        help='file holding the template of the description')
+    parser.add_argument('--leases', default=None,
+                        help='SQLite file on a share where machines working '
+                        'on the same videos claim rows, see leases.py')
+    parser.add_argument('--status-port', type=int, default=None,
+                        help='port on localhost to serve the status of the '
+                        'uploads on, see status.py')
+    parser.add_argument('--no-hash', action='store_true',
+                        help="don't hash files that haven't been seen before")
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="don't check the channel for videos already up")
+    parser.add_argument('--no-track', action='store_true',
+                        help="don't check on YouTube's processing of the "
+                        'videos uploaded')
+    args = parser.parse_args()
+    if not args.table and not args.drop:
+        parser.error('Give a --table, a --drop folder or both to watch.')
+    try:
+        windows = [parse_window(w) for w in args.window]
+    except ValueError as e:
+        parser.error(str(e))
+    if any(str(w.rate).endswith('%') for w in windows) and not args.max_rate:
+        parser.error('A percentage --window needs a --max-rate.')
+    if args.transcode and not is_valid_profile(args.transcode):
+        parser.error(f"--transcode takes '{REMUX}' or a bitrate, not "
+                     f'{args.transcode}')
+    ffmpeg = find_ffmpeg(args.ffmpeg) if args.transcode else None
+    if args.transcode and not ffmpeg:
+        parser.error(f"Can't find {args.ffmpeg or 'ffmpeg'} to transcode with.")
+    # paths given on the command line are relative to where it was run
+    table = os.path.abspath(args.table) if args.table else None
+    drop = os.path.abspath(args.drop) if args.drop else None
+    projects = os.path.abspath(args.projects) if args.projects else None
+    limits = os.path.abspath(args.limits) if args.limits else None
+    leases = Leases(os.path.abspath(args.leases)) if args.leases else None
+    description = read_template(args.description_template)
+    # everything else is found relative to the working directory, so it
+    # doesn't matter where this is started from
+    os.chdir(args.workdir or os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists('./.logging'):
+        os.mkdir('./.logging')
+    fn = f".logging/watch_{dt.now().strftime('%s')}.log"
+    logging.basicConfig(level=logging.INFO, filename=fn,
+                        format='%(levelname)s: %(message)s')
+    logging.info('DATE: %s', dt.now())
+    logging.info('This script was run by: %s', getpass.getuser())
+    logging.info('WATCHING: %s', ', '.join(filter(None, [table, drop])))
+    if leases is not None:
+        logging.info('LEASES: %s as %s', leases.fn, leases.owner)
+
+    pool = ProjectPool.load(projects, args.quota) if projects else None
+    max_rate = args.max_rate * 1024 * 1024 if args.max_rate else None
+    upload_rate = args.upload_rate * 1024 * 1024 if args.upload_rate else None
+    shaper = Shaper(max_rate, upload_rate, windows, limits)
+    uploader = BulkUploader(args.quota, args.workers, max_rate,
+                            dedup=not args.no_dedup,
+                            metrics_fn=fn[:-len('.log')] + '.jsonl',
+                            order=args.order, projects=pool,
+                            transcode=args.transcode, ffmpeg=ffmpeg,
+                            shaper=shaper, leases=leases,
+                            status_port=args.status_port)
+    watcher = Watcher(uploader, table, drop, args.interval,
+                      args.title_template, description, not args.no_hash,
+                      not args.no_track)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    print (f'Watching {" and ".join(filter(None, [table, drop]))}, '
+           f'every {args.interval:g}s...')
+    try:
+        watcher.run()
+    finally:
+        uploader.close()
+    logging.info('Script finished successfully')
+    sys.exit(0)